@@ -1,121 +1,224 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+import atexit
 import os
-import tempfile
-import subprocess
-import uuid
+import re
+import sqlite3
 from decouple import config
 
+from gffindex import ensure_index, feature_summary, query_features
+from governor import Governor, QueueFull, cpu_slots
+from compressed import is_gzip
+from jobs import AnnotationJobs
+from lifecycle import UploadsJanitor, pin, unpin
+from metrics import record_job, update_pool, watch_governor
+from workers import WorkerPool, worker_factory_from_env
+
 
 app = Flask(__name__)
 
-@app.route('/annotate', methods=['POST'])
-def annotate():
+PROKKA_BACKEND = config('PROKKA_BACKEND', default='docker')
+PROKKA_WORKERS = config('PROKKA_WORKERS', default=2, cast=int)
+PROKKA_IMAGE = config('PROKKA_IMAGE', default='staphb/prokka:latest')
+PROKKA_HEALTH_INTERVAL = config('PROKKA_HEALTH_INTERVAL', default=30, cast=int)
+###admission control: PROKKA_SLOTS_PER_CPU x cpus are shared by the running prokka jobs, each gets
+###up to PROKKA_JOB_CPUS of them as --cpus; at most PROKKA_MAX_QUEUE jobs wait, more get a 429
+PROKKA_SLOTS = cpu_slots(config('PROKKA_SLOTS_PER_CPU', default=1.0, cast=float))
+PROKKA_JOB_CPUS = config('PROKKA_JOB_CPUS', default=max(1, PROKKA_SLOTS // PROKKA_WORKERS), cast=int)
+PROKKA_MAX_QUEUE = config('PROKKA_MAX_QUEUE', default=16, cast=int)
+JOB_KEEP_SECONDS = config('PROKKA_JOB_KEEP_SECONDS', default=3600, cast=int)
+###the mutation service sweeps the shared uploads volume, set UPLOADS_GC_INTERVAL to sweep from here instead
+UPLOADS_DIR = '/app/uploads'
+###the protein sets prokka gets as --proteins. prokka builds its blast database from the file inside every
+###run (a prepared one would have to be installed as a prokka genus database), so jobs are only checked
+###against the folder before they are queued
+REFERENCES_DIR = '/data/references'
+UPLOADS_MAX_BYTES = config('UPLOADS_MAX_BYTES', default=20 * 1024 ** 3, cast=int)
+UPLOADS_TTL_SECONDS = config('UPLOADS_TTL_SECONDS', default=7 * 24 * 3600, cast=int)
+UPLOADS_GC_INTERVAL = config('UPLOADS_GC_INTERVAL', default=0, cast=int)
+MAX_POLL_WAIT = 30
+MAX_PAGE_SIZE = 1000
+JOB_ID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+###long-lived prokka workers, started once with the service
+prokka_pool = WorkerPool(
+    worker_factory_from_env(PROKKA_BACKEND, PROKKA_IMAGE,
+                            os.getenv('HOST_UPLOADS_DIR', '/app/uploads'),
+                            os.getenv('HOST_REFERENCES_DIR', '/data/references')),
+    size=PROKKA_WORKERS,
+    health_interval=PROKKA_HEALTH_INTERVAL,
+    governor=Governor(PROKKA_SLOTS, PROKKA_MAX_QUEUE, PROKKA_JOB_CPUS),
+)
+prokka_pool.start()
+atexit.register(prokka_pool.stop)
+watch_governor(prokka_pool.governor)
+
+
+def pinned_names(job):
+    ###what a running prokka job needs on the uploads volume: its input and its output folder
+    return job.params['filename'], f'output_{job.id}'
+
+
+def job_finished(job):
+    ###the gff is parsed once into the feature index, before the output folder is unpinned
+    if job.status == 'done':
+        try:
+            ensure_index(os.path.join(UPLOADS_DIR, f'output_{job.id}'))
+        except (OSError, sqlite3.Error) as e:
+            print(f'Could not index the features of job {job.id}: {e}', flush=True)
+    for name in pinned_names(job):
+        unpin(UPLOADS_DIR, name, job.id)
+    record_job(job)
+
+
+annotation_jobs = AnnotationJobs(prokka_pool, keep_seconds=JOB_KEEP_SECONDS, on_finished=job_finished)
+if UPLOADS_GC_INTERVAL > 0:
+    UploadsJanitor(UPLOADS_DIR, UPLOADS_MAX_BYTES, UPLOADS_TTL_SECONDS, UPLOADS_GC_INTERVAL).start()
+
+
+def submit_from_request():
     ###the absolute path of the file was sent here, the flask app should have access to it
     data = request.get_json(force=True)
 
-    HOST_UPLOADS_DIR = os.getenv('HOST_UPLOADS_DIR', '/app/uploads')  # host path to uploads
-    HOST_REFERENCES_DIR = os.getenv('HOST_REFERENCES_DIR', '/data/references')  # host path to references
-    
-
     if not data or 'filename' not in data:
-        return jsonify({'error': 'Missing file_path in request.'}), 400
+        return None, (jsonify({'error': 'Missing file_path in request.'}), 400)
 
     filename = data['filename']
     reference_file = data.get('reference')
     file_path = f"/app/uploads/{filename}"
 
     if not os.path.isfile(file_path):
-        return jsonify({'error': f"File not found: {file_path}"}), 400
-
-    job_id = str(uuid.uuid4())
-    output_dir = f"/app/uploads/output_{job_id}"
-
-    prokka_cmd = [
-        'docker', 'run', '--rm',
-        '--platform', 'linux/amd64',
-        '-v', f'{HOST_UPLOADS_DIR}:/data',
-        '-v', f'{HOST_REFERENCES_DIR}:/data/references',
-        'staphb/prokka:latest',
-        'prokka',
-        '--outdir', f'/data/output_{job_id}',
-        '--prefix', 'annotated_genome',
-        '--proteins', '/data/references/{reference_file}',
-        f'/data/{filename}'
-    ]
+        return None, (jsonify({'error': f"File not found: {file_path}"}), 400)
+    if not reference_file or os.path.basename(reference_file) != reference_file or \
+            not os.path.isfile(os.path.join(REFERENCES_DIR, reference_file)):
+        return None, (jsonify({'error': f'Reference not found: {reference_file}'}), 400)
 
+    ###hand the job to a warm worker, unless too many are already waiting for one
     try:
-        result = subprocess.run(
-            prokka_cmd, capture_output=True, text=True, check=True
-        )
-        print("Prokka stdout:", result.stdout, flush=True)
-        print("Prokka stderr:", result.stderr, flush=True)
-
-    except subprocess.CalledProcessError as e:
-        print("Prokka failed:", e.stderr, flush=True)
-        return jsonify({'error': 'Prokka annotation failed', 'details': e.stderr}), 500
-
-    return jsonify({
-        'message': f'Prokka annotation completed for {filename}.',
-        'job_id': job_id
-    })
-
-    
-    
-
-
-
-
-
-
-#     if 'file' not in request.files:
-#         return jsonify({'error': 'No file part'}), 400
-    
-#     genome_file = request.files['file']
-#     if genome_file.filename == '':
-#         return jsonify({'error': 'No selected file'}), 400
-
-#     # Create a temp directory and save file there
-#     temp_dir = "/app/uploads"
-#     os.makedirs(temp_dir, exist_ok=True)
-#     file_path = os.path.join(temp_dir, genome_file.filename)
-#     genome_file.save(file_path)
-
-#     host_upload_dir = "/Users/gustavosganzerla/Documents/mpox_outbreak/genomics_net/annotation_service_api/uploads"
-
-    
-#     job_id = str(uuid.uuid4())
-#     output_dir = f"/data/output_{job_id}"
-
-#     prokka_cmd = [
-#     'docker', 'run', '--rm',
-#     '--platform', 'linux/amd64',   # for M1 Macs
-#     '-v', '/Users/gustavosganzerla/Documents/mpox_outbreak/genomics_net/annotation_service_api/uploads:/data',
-#     '-v', '/Users/gustavosganzerla/Documents/mpox_outbreak/genomics_net/references:/data/references',
-#     'staphb/prokka:latest',
-#     'prokka',
-#     '--outdir', f'/data/output_{job_id}',
-#     '--prefix', 'annotated_genome',
-#     '--proteins', '/data/references/NC_003310.faa',
-#     f'/data/{genome_file.filename}'
-# ]
-
-#     file_path = os.path.join(temp_dir, genome_file.filename)
-
-#     try:
-#         result = subprocess.run(
-#             prokka_cmd, capture_output=True, text=True, check=True
-#         )
-#         #print("Prokka stdout:", result.stdout, flush=True)
-#         #print("Prokka stderr:", result.stderr, flush=True)
-#     except subprocess.CalledProcessError as e:
-#         print("Prokka failed:", e.stderr, flush=True)
-#         return jsonify({'error': 'Prokka annotation failed', 'details': e.stderr}), 500
-
-#     return jsonify({'message': f'Prokka annotation completed for {genome_file.filename}.',
-#                     'job_id':job_id})
-
+        job = annotation_jobs.submit({'filename': filename, 'reference': reference_file,
+                                      'input_bytes': os.path.getsize(file_path),
+                                      'compressed': is_gzip(file_path)})
+    except QueueFull as e:
+        return None, (jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)})
+    ###keep the uploads sweeper away until the job is done (unpinned in job_finished)
+    with annotation_jobs.changed:
+        if not job.finished:
+            for name in pinned_names(job):
+                pin(UPLOADS_DIR, name, job.id)
+    return job, None
 
 
+@app.route('/annotate', methods=['POST'])
+def annotate():
+    ###blocking variant, waits for prokka and answers with the job id
+    job, error = submit_from_request()
+    if error:
+        return error
+    annotation_jobs.wait(job)
+    if job.status == 'failed':
+        return jsonify(job.error), 500
+    return jsonify(job.result)
+
+
+@app.route('/annotate/jobs', methods=['POST'])
+def submit_job():
+    job, error = submit_from_request()
+    if error:
+        return error
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/annotate/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = annotation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    ###?wait=<seconds>&since=<version> turns this into a long-poll
+    wait = min(request.args.get('wait', default=0, type=float), MAX_POLL_WAIT)
+    if wait > 0:
+        annotation_jobs.wait(job, since=request.args.get('since', type=int), timeout=wait)
+    return jsonify(job.to_dict())
+
+
+@app.route('/annotate/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = annotation_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if not job.finished:
+        return jsonify(job.to_dict()), 202
+    if job.status == 'failed':
+        return jsonify(job.error), 500
+    return jsonify(job.result)
+
+
+def feature_index(job_id):
+    ###(index path, error response); outputs outlive the in-memory jobs, so the folder is what counts
+    job = annotation_jobs.get(job_id)
+    if job is not None and not job.finished:
+        return None, (jsonify(job.to_dict()), 202)
+    index_path = ensure_index(os.path.join(UPLOADS_DIR, f'output_{job_id}')) if JOB_ID.fullmatch(job_id) else None
+    if index_path is None:
+        return None, (jsonify({'error': 'Unknown annotation'}), 404)
+    return index_path, None
+
+
+@app.route('/annotate/results/<job_id>/features', methods=['GET'])
+def features(job_id):
+    ###one page of the prokka features, filtered by ?seq_id=&start=&end= (overlapping range), ?locus_tag=,
+    ###?gene=, ?product= (substring), ?type= and ?q= (substring of locus tag, gene or product)
+    index_path, error = feature_index(job_id)
+    if error:
+        return error
+    offset = max(request.args.get('offset', default=0, type=int), 0)
+    limit = min(max(request.args.get('limit', default=100, type=int), 1), MAX_PAGE_SIZE)
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    if start is not None and end is not None and start > end:
+        return jsonify({'error': 'start must not be greater than end'}), 400
+    total, page = query_features(index_path, seq_id=request.args.get('seq_id'), start=start, end=end,
+                                 locus_tag=request.args.get('locus_tag'), gene=request.args.get('gene'),
+                                 product=request.args.get('product'), feature_type=request.args.get('type'),
+                                 q=request.args.get('q'), offset=offset, limit=limit)
+    return jsonify({'job_id': job_id, 'total': total, 'offset': offset, 'limit': limit, 'features': page})
+
+
+@app.route('/annotate/results/<job_id>/features/summary', methods=['GET'])
+def features_summary(job_id):
+    index_path, error = feature_index(job_id)
+    if error:
+        return error
+    return jsonify(dict(feature_summary(index_path), job_id=job_id))
+
+
+@app.route('/annotate/results/<job_id>/features/<locus_tag>', methods=['GET'])
+def feature(job_id, locus_tag):
+    index_path, error = feature_index(job_id)
+    if error:
+        return error
+    ###with --addgenes a locus tag has a gene and a cds feature
+    _, found = query_features(index_path, locus_tag=locus_tag, limit=MAX_PAGE_SIZE)
+    if not found:
+        return jsonify({'error': f'Unknown locus tag: {locus_tag}'}), 404
+    return jsonify({'job_id': job_id, 'locus_tag': locus_tag, 'features': found})
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    workers = prokka_pool.status()
+    healthy = any(worker['healthy'] for worker in workers)
+    return jsonify({'backend': PROKKA_BACKEND,
+                    'queue_depth': prokka_pool.queue_depth(),
+                    'governor': prokka_pool.governor.status(),
+                    'workers': workers}), 200 if healthy else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    ###prometheus text format
+    update_pool(prokka_pool.queue_depth(), prokka_pool.status(), prokka_pool.governor.status())
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+import threading
+from urllib.parse import unquote
+
+
+GFF_NAME = 'annotated_genome.gff'
+###a dotfile, so it is not offered with the prokka outputs for download
+INDEX_NAME = '.features.sqlite3'
+###bump when the table layout changes, older indexes are rebuilt on first use
+INDEX_VERSION = 1
+FEATURE_FIELDS = ('seq_id', 'source', 'type', 'start', 'end', 'strand', 'phase',
+                  'locus_tag', 'gene', 'product', 'ec_number', 'attributes')
+
+_build_lock = threading.Lock()
+
+
+def parse_attributes(text):
+    ###gff3 column 9: key=value pairs separated by ';', values percent-encoded
+    attributes = {}
+    for pair in text.strip().split(';'):
+        if '=' in pair:
+            key, value = pair.split('=', 1)
+            attributes[unquote(key)] = unquote(value)
+    return attributes
+
+
+def iter_gff(path):
+    ###feature rows of a prokka gff in file order; the sequences after ##FASTA are skipped
+    with open(path) as f:
+        for line in f:
+            if line.startswith('##FASTA'):
+                break
+            if not line.strip() or line.startswith('#'):
+                continue
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) != 9:
+                continue
+            seq_id, source, feature_type, start, end, _, strand, phase, text = columns
+            attributes = parse_attributes(text)
+            yield (unquote(seq_id), source, feature_type, int(start), int(end), strand, phase,
+                   attributes.get('locus_tag') or attributes.get('ID'), attributes.get('gene'),
+                   attributes.get('product'), attributes.get('eC_number') or attributes.get('ec_number'),
+                   json.dumps(attributes))
+
+
+def build_index(gff_path, index_path):
+    ###one table with the features in gff order plus indexes for the lookups the endpoints offer;
+    ###built under a temporary name so readers never see a half-written index
+    partial_path = f'{index_path}.part'
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    db = sqlite3.connect(partial_path)
+    try:
+        db.execute('CREATE TABLE features (seq_id TEXT, source TEXT, type TEXT, start INTEGER, "end" INTEGER, '
+                   'strand TEXT, phase TEXT, locus_tag TEXT, gene TEXT, product TEXT, ec_number TEXT, '
+                   'attributes TEXT)')
+        db.executemany('INSERT INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', iter_gff(gff_path))
+        db.execute('CREATE INDEX features_position ON features (seq_id, start)')
+        db.execute('CREATE INDEX features_locus_tag ON features (locus_tag)')
+        db.execute('CREATE INDEX features_gene ON features (gene COLLATE NOCASE)')
+        db.execute(f'PRAGMA user_version = {INDEX_VERSION}')
+        db.commit()
+    finally:
+        db.close()
+    os.replace(partial_path, index_path)
+
+
+def _index_current(gff_path, index_path):
+    try:
+        if os.path.getmtime(index_path) < os.path.getmtime(gff_path):
+            return False
+        db = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+        try:
+            return db.execute('PRAGMA user_version').fetchone()[0] == INDEX_VERSION
+        finally:
+            db.close()
+    except (OSError, sqlite3.Error):
+        return False
+
+
+def ensure_index(output_dir):
+    ###path of the feature index of a prokka output folder, built on first use;
+    ###None when the folder has no gff (unknown job, prokka failed or still running)
+    gff_path = os.path.join(output_dir, GFF_NAME)
+    index_path = os.path.join(output_dir, INDEX_NAME)
+    if not os.path.isfile(gff_path):
+        return None
+    if not _index_current(gff_path, index_path):
+        with _build_lock:
+            if not _index_current(gff_path, index_path):
+                build_index(gff_path, index_path)
+    return index_path
+
+
+def feature_dict(row):
+    feature = dict(zip(FEATURE_FIELDS, row))
+    feature['attributes'] = json.loads(feature['attributes'])
+    return feature
+
+
+def _like(text):
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def query_features(index_path, seq_id=None, start=None, end=None, locus_tag=None, gene=None, product=None,
+                   feature_type=None, q=None, offset=0, limit=100):
+    ###(total, features) of one page; start / end select the features overlapping that range,
+    ###gene is matched exactly (any case), product and q (locus tag, gene or product) as substrings
+    clauses, args = [], []
+    if seq_id:
+        clauses.append('seq_id = ?')
+        args.append(seq_id)
+    if end is not None:
+        clauses.append('start <= ?')
+        args.append(end)
+    if start is not None:
+        clauses.append('"end" >= ?')
+        args.append(start)
+    if locus_tag:
+        clauses.append('locus_tag = ?')
+        args.append(locus_tag)
+    if gene:
+        clauses.append('gene = ? COLLATE NOCASE')
+        args.append(gene)
+    if product:
+        clauses.append("product LIKE ? ESCAPE '\\'")
+        args.append(_like(product))
+    if feature_type:
+        clauses.append('type = ?')
+        args.append(feature_type)
+    if q:
+        clauses.append("(locus_tag LIKE ? ESCAPE '\\' OR gene LIKE ? ESCAPE '\\' OR product LIKE ? ESCAPE '\\')")
+        args += [_like(q)] * 3
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    columns = ', '.join(f'"{field}"' for field in FEATURE_FIELDS)
+    db = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+    try:
+        total = db.execute(f'SELECT COUNT(*) FROM features {where}', args).fetchone()[0]
+        rows = db.execute(f'SELECT {columns} FROM features {where} ORDER BY rowid LIMIT ? OFFSET ?',
+                          args + [limit, offset]).fetchall()
+    finally:
+        db.close()
+    return total, [feature_dict(row) for row in rows]
+
+
+def feature_summary(index_path):
+    ###feature counts per type and the sequences with their number of features
+    db = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True)
+    try:
+        types = dict(db.execute('SELECT type, COUNT(*) FROM features GROUP BY type ORDER BY type'))
+        sequences = [{'seq_id': seq_id, 'features': count} for seq_id, count in
+                     db.execute('SELECT seq_id, COUNT(*) FROM features GROUP BY seq_id ORDER BY MIN(rowid)')]
+    finally:
+        db.close()
+    return {'types': types, 'sequences': sequences}
@@ -0,0 +1,125 @@
+import subprocess
+import threading
+import time
+import uuid
+
+
+class AnnotationJob:
+    ###same json shape as the mutation service's jobs, with a single `prokka` stage
+    def __init__(self, params):
+        self.id = str(uuid.uuid4())
+        self.params = params
+        self.status = 'queued'
+        self.stage = {'status': 'pending'}
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stages': [dict(self.stage, name='prokka')],
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'version': self.version,
+        }
+
+
+class AnnotationJobs:
+    ###tracks prokka runs handed to the worker pool so they can be polled instead of waited on;
+    ###finished jobs are kept for `keep_seconds`
+    def __init__(self, pool, keep_seconds=3600, on_finished=None):
+        self.pool = pool
+        self.keep_seconds = keep_seconds
+        ###called with every finished job, e.g. to record metrics
+        self.on_finished = on_finished
+        self.changed = threading.Condition()
+        self._jobs = {}
+
+    def _update(self, job, **attrs):
+        with self.changed:
+            for name, value in attrs.items():
+                setattr(job, name, value)
+            job.version += 1
+            self.changed.notify_all()
+
+    def submit(self, params):
+        self._prune()
+        job = AnnotationJob(params)
+        with self.changed:
+            self._jobs[job.id] = job
+
+        def started():
+            now = time.time()
+            self._update(job, status='running', started_at=now, stage={'status': 'running', 'started_at': now})
+
+        ###the job id doubles as the prokka output folder name (output_<job_id>);
+        ###the worker puts the cpu / memory usage of the run into the dict
+        worker_job = dict(params, job_id=job.id)
+        try:
+            future = self.pool.submit(worker_job, on_start=started)
+        except Exception:
+            ###not admitted (queue full), nothing to poll for
+            with self.changed:
+                del self._jobs[job.id]
+            raise
+        future.add_done_callback(lambda future: self._finish(job, future, worker_job.get('usage')))
+        return job
+
+    def _finish(self, job, future, usage=None):
+        try:
+            self._complete(job, future, usage)
+        finally:
+            if self.on_finished:
+                try:
+                    self.on_finished(job)
+                except Exception as e:
+                    print(f'on_finished failed for job {job.id}: {e}', flush=True)
+
+    def _complete(self, job, future, usage):
+        now = time.time()
+        stage = dict(job.stage, **(usage or {}), seconds=round(now - (job.started_at or now), 3))
+        error = future.exception()
+        if error is None:
+            ###prokka's own output only matters when it fails
+            self._update(job, status='done', finished_at=now, stage=dict(stage, status='done'),
+                         result={'message': f"Prokka annotation completed for {job.params['filename']}.",
+                                 'job_id': job.id})
+            return
+        print("Prokka failed:", getattr(error, 'stderr', error), flush=True)
+        details = error.stderr if isinstance(error, subprocess.CalledProcessError) else str(error)
+        self._update(job, status='failed', finished_at=now, stage=dict(stage, status='failed'),
+                     error={'error': 'Prokka annotation failed', 'details': details})
+
+    def get(self, job_id):
+        with self.changed:
+            return self._jobs.get(job_id)
+
+    def wait(self, job, since=None, timeout=None):
+        ###long-poll: block until the job changes past `since` (or finishes)
+        deadline = None if timeout is None else time.time() + timeout
+        with self.changed:
+            while not job.finished and (since is None or job.version <= since):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+        return job
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_seconds
+        with self.changed:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
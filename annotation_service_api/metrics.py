@@ -0,0 +1,59 @@
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily
+
+
+SECONDS_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+BYTES_BUCKETS = tuple(2 ** power for power in range(16, 34, 2))
+
+JOBS = Counter('annotation_jobs_total', 'Finished annotation jobs', ['status'])
+QUEUE_DEPTH = Gauge('annotation_queue_depth', 'Jobs waiting for a prokka worker')
+WORKERS = Gauge('annotation_workers', 'Prokka workers', ['state'])
+QUEUE_WAIT = Histogram('annotation_queue_wait_seconds', 'Time from submission to start', buckets=SECONDS_BUCKETS)
+INPUT_BYTES = Histogram('annotation_input_bytes', 'Size of the annotated genome', buckets=BYTES_BUCKETS)
+STAGE_SECONDS = Histogram('annotation_stage_seconds', 'Wall time per stage', ['stage'], buckets=SECONDS_BUCKETS)
+STAGE_CPU = Counter('annotation_stage_cpu_seconds_total', 'Prokka cpu time per stage', ['stage', 'mode'])
+STAGE_MAX_RSS = Histogram('annotation_stage_max_rss_bytes', 'Peak resident memory per stage', ['stage'],
+                          buckets=BYTES_BUCKETS)
+SLOTS = Gauge('annotation_governor_slots', 'Cpu slots of the admission governor', ['state'])
+
+
+class RejectedCollector:
+    ###the governor keeps the count of its 429s, read at scrape time and exposed as a counter (_total)
+    def __init__(self, governor):
+        self.governor = governor
+
+    def collect(self):
+        yield CounterMetricFamily('annotation_governor_rejected', 'Submissions rejected with 429',
+                                  value=self.governor.status()['rejected'])
+
+
+def watch_governor(governor, registry=REGISTRY):
+    registry.register(RejectedCollector(governor))
+
+
+def record_job(job):
+    ###AnnotationJobs on_finished hook
+    JOBS.labels(status=job.status).inc()
+    if job.params.get('input_bytes') is not None:
+        INPUT_BYTES.observe(job.params['input_bytes'])
+    if job.started_at is None:
+        return
+    QUEUE_WAIT.observe(job.started_at - job.submitted_at)
+    info = job.stage
+    if 'seconds' in info:
+        STAGE_SECONDS.labels(stage='prokka').observe(info['seconds'])
+    if 'cpu_user_seconds' in info:
+        STAGE_CPU.labels(stage='prokka', mode='user').inc(info['cpu_user_seconds'])
+        STAGE_CPU.labels(stage='prokka', mode='system').inc(info['cpu_system_seconds'])
+    if 'max_rss_bytes' in info:
+        STAGE_MAX_RSS.labels(stage='prokka').observe(info['max_rss_bytes'])
+
+
+def update_pool(queue_depth, workers, governor=None):
+    QUEUE_DEPTH.set(queue_depth)
+    WORKERS.labels(state='busy').set(sum(1 for worker in workers if worker['busy']))
+    WORKERS.labels(state='healthy').set(sum(1 for worker in workers if worker['healthy']))
+    WORKERS.labels(state='total').set(len(workers))
+    if governor:
+        SLOTS.labels(state='total').set(governor['slots'])
+        SLOTS.labels(state='free').set(governor['free_slots'])
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import threading
+
+
+def _usage(rusage):
+    ###ru_maxrss is in kilobytes on linux
+    return {
+        'cpu_user_seconds': round(rusage.ru_utime, 3),
+        'cpu_system_seconds': round(rusage.ru_stime, 3),
+        'max_rss_bytes': rusage.ru_maxrss * 1024,
+    }
+
+
+def wait_with_usage(proc):
+    ###reaps the child with wait4 instead of Popen.wait, so the cpu time and peak rss
+    ###of exactly this process are known (RUSAGE_CHILDREN would mix concurrent jobs)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return _usage(rusage)
+
+
+def run_with_usage(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs):
+    ###subprocess.run without check, returns (CompletedProcess, usage); pipes are drained
+    ###by threads because communicate() would reap the child itself
+    proc = subprocess.Popen(cmd, stdout=stdout, stderr=stderr, text=True, **kwargs)
+    outputs = {}
+
+    def drain(name, stream):
+        outputs[name] = stream.read()
+        stream.close()
+    readers = [threading.Thread(target=drain, args=(name, stream), daemon=True)
+               for name, stream in (('stdout', proc.stdout), ('stderr', proc.stderr)) if stream]
+    for reader in readers:
+        reader.start()
+    usage = wait_with_usage(proc)
+    for reader in readers:
+        reader.join()
+    return subprocess.CompletedProcess(cmd, proc.returncode, outputs.get('stdout'), outputs.get('stderr')), usage
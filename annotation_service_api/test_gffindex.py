@@ -0,0 +1,104 @@
+import os
+import random
+import tempfile
+import unittest
+
+from gffindex import GFF_NAME, INDEX_NAME, ensure_index, feature_summary, query_features
+
+GFF = '''##gff-version 3
+##sequence-region contig_1 1 5000
+contig_1\tProkka\tCDS\t100\t400\t.\t+\t0\tID=LOC_00001;gene=dnaA;locus_tag=LOC_00001;product=Chromosomal replication initiator
+contig_1\tProkka\tCDS\t350\t900\t.\t-\t0\tID=LOC_00002;gene=DnaN;locus_tag=LOC_00002;product=100%25 beta_clamp
+contig_1\tProkka\ttRNA\t1000\t1075\t.\t+\t.\tID=LOC_00003;locus_tag=LOC_00003;product=tRNA-Leu(caa)
+contig%202\tProkka\tCDS\t1\t300\t.\t+\t0\tID=LOC_00004;locus_tag=LOC_00004;product=hypothetical protein;eC_number=3.1.1.1
+broken line
+##FASTA
+>contig_1
+ACGT
+'''
+
+
+class FeatureIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.index = self.write(GFF)
+
+    def write(self, text):
+        ###a fresh index every time, whatever the timestamp granularity of the file system
+        index_path = os.path.join(self.workdir.name, INDEX_NAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        with open(os.path.join(self.workdir.name, GFF_NAME), 'w') as f:
+            f.write(text)
+        return ensure_index(self.workdir.name)
+
+    def locus_tags(self, **kwargs):
+        return [feature['locus_tag'] for feature in query_features(self.index, **kwargs)[1]]
+
+    def test_rows_are_parsed(self):
+        total, features = query_features(self.index)
+        self.assertEqual(total, 4)
+        self.assertEqual(features[1]['product'], '100% beta_clamp')
+        self.assertEqual((features[3]['seq_id'], features[3]['ec_number']), ('contig 2', '3.1.1.1'))
+        self.assertEqual(features[0]['attributes']['gene'], 'dnaA')
+        self.assertEqual((features[1]['start'], features[1]['end'], features[1]['strand']), (350, 900, '-'))
+
+    def test_ranges_select_overlapping_features_inclusively(self):
+        self.assertEqual(self.locus_tags(seq_id='contig_1', start=360, end=380), ['LOC_00001', 'LOC_00002'])
+        self.assertEqual(self.locus_tags(seq_id='contig_1', start=400, end=400), ['LOC_00001', 'LOC_00002'])
+        self.assertEqual(self.locus_tags(seq_id='contig_1', start=901, end=999), [])
+        self.assertEqual(self.locus_tags(seq_id='contig_1', start=900), ['LOC_00002', 'LOC_00003'])
+        self.assertEqual(self.locus_tags(end=100), ['LOC_00001', 'LOC_00004'])
+
+    def test_ranges_match_a_naive_overlap_scan(self):
+        rng = random.Random(1)
+        features = []
+        for number in range(300):
+            start = rng.randint(1, 20000)
+            features.append((rng.choice(['c1', 'c2']), start, start + rng.randint(0, 1500), f'L{number:05d}'))
+        self.index = self.write(''.join(f'{seq_id}\tProkka\tCDS\t{start}\t{end}\t.\t+\t0\tlocus_tag={tag}\n'
+                                        for seq_id, start, end, tag in features))
+        for _ in range(50):
+            seq_id, start = rng.choice(['c1', 'c2']), rng.randint(1, 22000)
+            end = start + rng.randint(0, 3000)
+            expected = [tag for feature_seq, feature_start, feature_end, tag in features
+                        if feature_seq == seq_id and feature_start <= end and feature_end >= start]
+            total, page = query_features(self.index, seq_id=seq_id, start=start, end=end, limit=1000)
+            self.assertEqual((total, [feature['locus_tag'] for feature in page]), (len(expected), expected))
+
+    def test_text_filters(self):
+        self.assertEqual(self.locus_tags(gene='DNAN'), ['LOC_00002'])
+        self.assertEqual(self.locus_tags(product='beta_'), ['LOC_00002'])
+        ###% and _ are literal, not wildcards
+        self.assertEqual(self.locus_tags(product='0%'), ['LOC_00002'])
+        self.assertEqual(self.locus_tags(product='t_NA'), [])
+        self.assertEqual(self.locus_tags(q='dna'), ['LOC_00001', 'LOC_00002'])
+        self.assertEqual(self.locus_tags(feature_type='tRNA'), ['LOC_00003'])
+        self.assertEqual(self.locus_tags(locus_tag='LOC_00004'), ['LOC_00004'])
+
+    def test_paging_keeps_gff_order(self):
+        total, page = query_features(self.index, offset=1, limit=2)
+        self.assertEqual((total, [feature['locus_tag'] for feature in page]), (4, ['LOC_00002', 'LOC_00003']))
+
+    def test_summary(self):
+        self.assertEqual(feature_summary(self.index), {'types': {'CDS': 3, 'tRNA': 1},
+                                                       'sequences': [{'seq_id': 'contig_1', 'features': 3},
+                                                                     {'seq_id': 'contig 2', 'features': 1}]})
+
+    def test_index_is_rebuilt_when_the_gff_changes(self):
+        self.assertEqual(self.index, os.path.join(self.workdir.name, INDEX_NAME))
+        gff_path = os.path.join(self.workdir.name, GFF_NAME)
+        with open(gff_path, 'w') as f:
+            f.write(GFF.replace('gene=dnaA', 'gene=recA'))
+        stat = os.stat(self.index)
+        os.utime(gff_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.locus_tags(gene='recA'), [])
+        ensure_index(self.workdir.name)
+        self.assertEqual(self.locus_tags(gene='recA'), ['LOC_00001'])
+        os.remove(gff_path)
+        self.assertIsNone(ensure_index(self.workdir.name))
+
+
+if __name__ == '__main__':
+    unittest.main()
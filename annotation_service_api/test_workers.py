@@ -0,0 +1,94 @@
+import subprocess
+import time
+import unittest
+from unittest import mock
+
+from workers import DockerWorker, ProkkaWorker, WorkerPool
+
+
+class CountingWorker(ProkkaWorker):
+    ###unhealthy for its first `sick` checks
+    def __init__(self, name, sick=0):
+        super().__init__(name)
+        self.sick = sick
+        self.checks = 0
+        self.starts = 0
+
+    def start(self):
+        self.starts += 1
+
+    def healthy(self):
+        self.checks += 1
+        return self.checks > self.sick
+
+    def run(self, job):
+        return job['job_id']
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('condition not reached')
+        time.sleep(0.01)
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def pool(self, workers, health_interval):
+        pool = WorkerPool(lambda index: workers[index], size=len(workers), health_interval=health_interval)
+        pool.start()
+        self.addCleanup(pool.stop)
+        return pool
+
+    def test_status_does_not_run_health_checks(self):
+        worker = CountingWorker('w0')
+        pool = self.pool([worker], health_interval=3600)
+        wait_until(lambda: pool.status()[0]['healthy'])
+        for _ in range(5):
+            pool.status()
+        self.assertEqual(worker.checks, 0)
+
+    def test_jobs_do_not_wait_for_a_health_check(self):
+        worker = CountingWorker('w0')
+        pool = self.pool([worker], health_interval=3600)
+        self.assertEqual(pool.submit({'job_id': 'j1'}).result(timeout=5), 'j1')
+        self.assertEqual(worker.checks, 0)
+        self.assertEqual(worker.jobs_done, 1)
+
+    def test_interval_check_restarts_and_records(self):
+        worker = CountingWorker('w0', sick=1)
+        pool = self.pool([worker], health_interval=0.05)
+        ###first check fails and restarts the worker, the one after the restart passes
+        wait_until(lambda: worker.starts >= 2 and worker.checks >= 2)
+        wait_until(lambda: pool.status()[0]['healthy'])
+
+
+class DockerWorkerTest(unittest.TestCase):
+    def run_job(self, cgroup):
+        ###cgroup: {file: [contents per read]}, a missing file fails like `cat` in the container
+        def docker(cmd, **kwargs):
+            if cmd[-1].startswith('/sys/fs/cgroup/'):
+                reads = cgroup.get(cmd[-1][len('/sys/fs/cgroup/'):])
+                if not reads:
+                    return subprocess.CompletedProcess(cmd, 1, '', 'No such file or directory')
+                return subprocess.CompletedProcess(cmd, 0, reads.pop(0), '')
+            return subprocess.CompletedProcess(cmd, 0, '', '')
+        job = {'job_id': 'j1', 'filename': 'genome.fasta', 'reference': 'ref.faa'}
+        with mock.patch('workers.subprocess.run', side_effect=docker):
+            DockerWorker('prokka-0', 'staphb/prokka', '/uploads', '/references').run(job)
+        return job.get('usage')
+
+    def test_cpu_and_peak_memory_come_from_the_cgroup(self):
+        usage = self.run_job({'cpu.stat': ['usage_usec 10\nuser_usec 1000000\nsystem_usec 0\n',
+                                           'usage_usec 99\nuser_usec 3500000\nsystem_usec 250000\n'],
+                              'memory.peak': ['734003200\n']})
+        self.assertEqual(usage, {'cpu_user_seconds': 2.5, 'cpu_system_seconds': 0.25, 'max_rss_bytes': 734003200})
+
+    def test_cgroup_v1_peak_memory(self):
+        usage = self.run_job({'memory/memory.max_usage_in_bytes': ['52428800\n']})
+        self.assertEqual(usage, {'max_rss_bytes': 52428800})
+        self.assertIsNone(self.run_job({}))
+
+
+if __name__ == '__main__':
+    unittest.main()
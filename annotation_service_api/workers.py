@@ -0,0 +1,275 @@
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+from compressed import PipeFeed
+from procstats import run_with_usage
+
+
+class ProkkaWorker:
+    ###one long-lived place where prokka runs; subclasses decide what "place" means
+    uploads_dir = '/app/uploads'
+    references_dir = '/data/references'
+
+    def __init__(self, name):
+        self.name = name
+        self.jobs_done = 0
+        self.busy = False
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def healthy(self):
+        return True
+
+    def prokka_args(self, job):
+        ###paths are rewritten to what the worker itself sees; --cpus is what the governor granted
+        cpus = ['--cpus', str(job['cpus'])] if job.get('cpus') else []
+        return [
+            *cpus,
+            '--outdir', f"{self.uploads_dir}/output_{job['job_id']}",
+            '--prefix', 'annotated_genome',
+            '--proteins', f"{self.references_dir}/{job['reference']}",
+            '/dev/stdin' if job.get('compressed') else f"{self.uploads_dir}/{job['filename']}",
+        ]
+
+    def input_feed(self, job):
+        ###gzip / bgzf uploads reach prokka decompressed on its stdin, read from the service's side of the volume
+        if job.get('compressed'):
+            return PipeFeed(os.path.join(ProkkaWorker.uploads_dir, job['filename']))
+        return nullcontext()
+
+    def run(self, job):
+        raise NotImplementedError
+
+
+class DockerWorker(ProkkaWorker):
+    ###keeps a staphb/prokka container alive and runs each job with `docker exec`,
+    ###so image setup and container start happen once per worker instead of once per job
+    uploads_dir = '/data'
+    references_dir = '/data/references'
+
+    def __init__(self, name, image, host_uploads_dir, host_references_dir):
+        super().__init__(name)
+        self.image = image
+        self.host_uploads_dir = host_uploads_dir
+        self.host_references_dir = host_references_dir
+
+    def start(self):
+        subprocess.run(['docker', 'rm', '-f', self.name], capture_output=True)
+        subprocess.run([
+            'docker', 'run', '-d', '--rm',
+            '--name', self.name,
+            '--platform', 'linux/amd64',
+            '-v', f'{self.host_uploads_dir}:/data',
+            '-v', f'{self.host_references_dir}:/data/references',
+            '--entrypoint', 'sleep',
+            self.image,
+            'infinity',
+        ], capture_output=True, text=True, check=True)
+        ###warm up: loads prokka and checks its databases once
+        subprocess.run(['docker', 'exec', self.name, 'prokka', '--listdb'], capture_output=True, text=True)
+
+    def stop(self):
+        subprocess.run(['docker', 'rm', '-f', self.name], capture_output=True)
+
+    def healthy(self):
+        result = subprocess.run(['docker', 'inspect', '-f', '{{.State.Running}}', self.name],
+                                capture_output=True, text=True)
+        return result.returncode == 0 and result.stdout.strip() == 'true'
+
+    def _cgroup(self, *names):
+        ###first readable file of the container's cgroup, None when there is none
+        for name in names:
+            result = subprocess.run(['docker', 'exec', self.name, 'cat', f'/sys/fs/cgroup/{name}'],
+                                    capture_output=True, text=True)
+            if result.returncode == 0:
+                return result.stdout
+        return None
+
+    def _cpu_seconds(self):
+        ###cgroup v2 counters of the container; one job at a time runs in it, so the
+        ###difference around a job is that job's cpu (rusage of `docker exec` would only be the client)
+        stats = dict(line.split() for line in (self._cgroup('cpu.stat') or '').splitlines() if len(line.split()) == 2)
+        if 'user_usec' not in stats:
+            return None
+        return int(stats['user_usec']) / 1e6, int(stats['system_usec']) / 1e6
+
+    def _peak_memory(self):
+        ###high-water mark of the container (cgroup v2, then v1); the container only ever runs one
+        ###job at a time next to `sleep`, so this is the peak of the largest job since it started
+        peak = self._cgroup('memory.peak', 'memory/memory.max_usage_in_bytes')
+        return int(peak) if peak and peak.strip().isdigit() else None
+
+    def run(self, job):
+        before = self._cpu_seconds()
+        try:
+            interactive = ['-i'] if job.get('compressed') else []
+            with self.input_feed(job) as stdin:
+                return subprocess.run(['docker', 'exec', *interactive, self.name, 'prokka', *self.prokka_args(job)],
+                                      stdin=stdin, capture_output=True, text=True, check=True)
+        finally:
+            after = self._cpu_seconds()
+            usage = {}
+            if before and after:
+                usage = {'cpu_user_seconds': round(after[0] - before[0], 3),
+                         'cpu_system_seconds': round(after[1] - before[1], 3)}
+            peak = self._peak_memory()
+            if peak is not None:
+                usage['max_rss_bytes'] = peak
+            if usage:
+                job['usage'] = usage
+
+
+class LocalWorker(ProkkaWorker):
+    ###prokka installed next to the service, no docker involved
+    def healthy(self):
+        return subprocess.run(['prokka', '--version'], capture_output=True).returncode == 0
+
+    def run(self, job):
+        cmd = ['prokka', *self.prokka_args(job)]
+        with self.input_feed(job) as stdin:
+            result, job['usage'] = run_with_usage(cmd, stdin=stdin)
+        if result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout, result.stderr)
+        return result
+
+
+class StubWorker(ProkkaWorker):
+    ###writes placeholder prokka outputs, for running the stack without docker
+    extensions = ('gff', 'gbk', 'fna', 'faa', 'ffn', 'tsv', 'txt', 'log')
+
+    def run(self, job):
+        outdir = os.path.join(self.uploads_dir, f"output_{job['job_id']}")
+        os.makedirs(outdir, exist_ok=True)
+        for extension in self.extensions:
+            with open(os.path.join(outdir, f'annotated_genome.{extension}'), 'w') as f:
+                f.write(f"stub annotation of {job['filename']} against {job['reference']}\n")
+        return subprocess.CompletedProcess(['prokka-stub'], 0, stdout='', stderr='')
+
+
+class WorkerPool:
+    ###jobs go through one local queue, each worker thread owns one worker and pulls from it;
+    ###idle threads wake up every `health_interval` seconds to check (and restart) their worker
+    def __init__(self, worker_factory, size=2, health_interval=30, governor=None):
+        self.worker_factory = worker_factory
+        self.size = size
+        self.health_interval = health_interval
+        ###admission control, submit() raises governor.QueueFull when the waiting line is full
+        self.governor = governor
+        self.workers = []
+        ###worker name -> outcome of its last health check, what status() reports
+        self._healthy = {}
+        self._jobs = queue.Queue()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.size):
+            worker = self.worker_factory(index)
+            self.workers.append(worker)
+            thread = threading.Thread(target=self._loop, args=(worker,), name=worker.name, daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        for worker in self.workers:
+            self._jobs.put(None)
+        for worker in self.workers:
+            worker.stop()
+
+    def submit(self, job, on_start=None):
+        ###on_start is called from the worker thread when a worker picks the job up
+        if self.governor:
+            self.governor.admit()
+        future = Future()
+        self._jobs.put((job, future, on_start))
+        return future
+
+    def queue_depth(self):
+        return self._jobs.qsize()
+
+    def status(self):
+        ###served from the interval checks, /health and every metrics scrape must not run one
+        return [{'name': worker.name,
+                 'busy': worker.busy,
+                 'healthy': self._healthy.get(worker.name, False),
+                 'jobs_done': worker.jobs_done} for worker in self.workers]
+
+    def _ensure_healthy(self, worker):
+        healthy = worker.healthy()
+        if not healthy:
+            print(f'Restarting unhealthy prokka worker {worker.name}', flush=True)
+            worker.stop()
+            worker.start()
+            healthy = worker.healthy()
+        self._healthy[worker.name] = healthy
+
+    def _loop(self, worker):
+        try:
+            worker.start()
+            self._healthy[worker.name] = True
+        except Exception as e:
+            self._healthy[worker.name] = False
+            print(f'Prokka worker {worker.name} failed to start: {e}', flush=True)
+
+        ###health is checked every health_interval, idle or not; a check before every job would add a
+        ###process start to each job's latency
+        checked = time.time()
+        while True:
+            try:
+                item = self._jobs.get(timeout=max(0, checked + self.health_interval - time.time()))
+            except queue.Empty:
+                item = False
+            if item is not None and time.time() - checked >= self.health_interval:
+                checked = time.time()
+                try:
+                    self._ensure_healthy(worker)
+                except Exception as e:
+                    self._healthy[worker.name] = False
+                    print(f'Prokka worker {worker.name} health check failed: {e}', flush=True)
+            if item is False:
+                continue
+            if item is None:
+                return
+
+            job, future, on_start = item
+            granted = self.governor.acquire() if self.governor else None
+            if not future.set_running_or_notify_cancel():
+                if self.governor:
+                    self.governor.release(granted)
+                continue
+            worker.busy = True
+            started = time.time()
+            try:
+                job['cpus'] = granted
+                if on_start:
+                    on_start()
+                future.set_result(worker.run(job))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                worker.busy = False
+                worker.jobs_done += 1
+                if self.governor:
+                    self.governor.release(granted, time.time() - started)
+
+
+def worker_factory_from_env(backend, image, host_uploads_dir, host_references_dir):
+    def factory(index):
+        name = f'prokka_worker_{socket.gethostname()}_{index}'
+        if backend == 'docker':
+            return DockerWorker(name, image, host_uploads_dir, host_references_dir)
+        if backend == 'local':
+            return LocalWorker(name)
+        if backend == 'stub':
+            return StubWorker(name)
+        raise ValueError(f'Unknown prokka backend: {backend}')
+    return factory
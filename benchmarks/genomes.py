@@ -0,0 +1,104 @@
+import random
+
+
+BASES = 'ACGT'
+
+
+def read_reference(path):
+    ###(record id, sequence) of the first record, the bundled references are single-record
+    record_id, chunks = None, []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if record_id is not None:
+                    break
+                record_id = line[1:].split(maxsplit=1)[0]
+            elif line:
+                chunks.append(line.upper())
+    return record_id, ''.join(chunks)
+
+
+def mutate(reference, seed=0, snp_rate=0.001, indel_rate=0.0001):
+    ###returns (query sequence, truth) where truth holds show-snps style rows
+    ###(pos_ref, ref_base, pos_query, query_base), '.' marking the missing side of an indel
+    rng = random.Random(seed)
+    query, truth = [], []
+    pos_query = 0
+    for pos_ref, base in enumerate(reference, start=1):
+        roll = rng.random()
+        if roll < indel_rate / 2:
+            ###deletion of this reference base
+            truth.append((pos_ref, base, pos_query, '.'))
+            continue
+        if roll < indel_rate:
+            ###insertion after this reference base
+            pos_query += 1
+            query.append(base)
+            inserted = rng.choice(BASES)
+            pos_query += 1
+            query.append(inserted)
+            truth.append((pos_ref, '.', pos_query, inserted))
+            continue
+        pos_query += 1
+        if roll < indel_rate + snp_rate:
+            alternative = rng.choice([b for b in BASES if b != base])
+            query.append(alternative)
+            truth.append((pos_ref, base, pos_query, alternative))
+        else:
+            query.append(base)
+    return ''.join(query), truth
+
+
+def add_n_runs(sequence, truth, runs=0, run_length=100, seed=0):
+    ###masks `runs` stretches with N; variants under a mask are dropped from the truth
+    rng = random.Random(seed)
+    sequence = list(sequence)
+    masked = []
+    for _ in range(runs):
+        start = rng.randrange(0, max(1, len(sequence) - run_length))
+        sequence[start:start + run_length] = 'N' * min(run_length, len(sequence) - start)
+        masked.append((start + 1, start + run_length))
+    truth = [row for row in truth if not any(lo <= row[2] <= hi for lo, hi in masked)]
+    return ''.join(sequence), truth
+
+
+def split_contigs(sequence, truth, contigs=1, name='sample'):
+    ###splits the query into `contigs` pieces of equal size, truth rows get the contig name and a local position
+    if contigs <= 1:
+        return [(name, sequence)], [row + (name,) for row in truth]
+    size = -(-len(sequence) // contigs)
+    records = [(f'{name}_contig{index + 1}', sequence[index * size:(index + 1) * size]) for index in range(contigs)]
+    rows = []
+    for pos_ref, ref_base, pos_query, query_base in truth:
+        index = min(max(pos_query - 1, 0) // size, contigs - 1)
+        rows.append((pos_ref, ref_base, pos_query - index * size, query_base, records[index][0]))
+    return records, rows
+
+
+def synthetic_genome(reference_path, seed=0, snp_rate=0.001, indel_rate=0.0001, contigs=1,
+                     n_runs=0, n_run_length=100, name='sample'):
+    ###mpox-sized genome derived from a bundled reference; returns (records, truth, reference id)
+    reference_id, reference = read_reference(reference_path)
+    query, truth = mutate(reference, seed, snp_rate, indel_rate)
+    query, truth = add_n_runs(query, truth, n_runs, n_run_length, seed)
+    records, truth = split_contigs(query, truth, contigs, name)
+    return records, truth, reference_id
+
+
+def write_fasta(records, path, width=70):
+    with open(path, 'w') as f:
+        for record_id, sequence in records:
+            f.write(f'>{record_id}\n')
+            for start in range(0, len(sequence), width):
+                f.write(sequence[start:start + width] + '\n')
+
+
+def write_show_snps(truth, reference_id, path, reference_path='reference.fasta', query_path='query.fasta'):
+    ###the truth as `show-snps -Clr` output, this is what the show-snps stand-in replays
+    with open(path, 'w') as f:
+        f.write(f'{reference_path} {query_path}\nNUCMER\n\n')
+        f.write('[P1]\t[SUB]\t[SUB]\t[P2]\t[BUFF]\t[DIST]\t[LEN R]\t[LEN Q]\t[FRM]\t[TAGS]\n')
+        for pos_ref, ref_base, pos_query, query_base, query_name in truth:
+            f.write(f'{pos_ref}\t{ref_base}\t{query_base}\t{pos_query}\t20\t{pos_ref}\t0\t0\t1\t1\t'
+                    f'{reference_id}\t{query_name}\n')
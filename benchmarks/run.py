@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+###benchmark harness: synthetic genomes + tool stand-ins, runs offline without docker or mummer
+###
+###  python benchmarks/run.py                          # everything, results/<timestamp>.json
+###  python benchmarks/run.py --only parse --repeat 10
+###  python benchmarks/run.py --baseline benchmarks/results/before.json --fail-on-regression
+###
+###the end-to-end flows need the service paths (/app/uploads, /data/references) to be writable,
+###as inside the compose containers; without them they are reported as skipped
+import argparse
+import datetime
+import gzip
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+STUBS_DIR = os.path.join(BENCH_DIR, 'stubs')
+REFERENCE = os.path.join(ROOT, 'references', 'NC_003310.fasta')
+UPLOADS_DIR = '/app/uploads'
+REFERENCES_DIR = '/data/references'
+
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT, 'mutational_service_api'))
+sys.path.insert(0, os.path.join(ROOT, 'django_web'))
+
+from genomes import synthetic_genome, write_fasta, write_show_snps  # noqa: E402
+
+
+BENCHMARKS = []
+
+
+def benchmark(name, **params):
+    ###registers a setup function; it gets (workdir, **params) and returns the callable to time
+    def register(setup):
+        BENCHMARKS.append((name, setup, params))
+        return setup
+    return register
+
+
+def measure(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return {
+        'repeat': repeat,
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.fmean(samples),
+        'max': max(samples),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def genome(workdir, seed, recordings=None, compressed=False, **kwargs):
+    ###writes a synthetic genome (+ its show-snps recording) and returns the fasta path, .fasta.gz when compressed
+    name = f'bench_s{seed}'
+    records, truth, reference_id = synthetic_genome(REFERENCE, seed=seed, name=name, **kwargs)
+    path = os.path.join(workdir, f'{name}.fasta')
+    write_fasta(records, path)
+    if compressed:
+        with open(path, 'rb') as f, gzip.open(f'{path}.gz', 'wb') as out:
+            shutil.copyfileobj(f, out)
+        os.remove(path)
+        path = f'{path}.gz'
+    if recordings:
+        write_show_snps(truth, reference_id, os.path.join(recordings, f'{records[0][0]}.snps'))
+    return path
+
+
+### --- micro benchmarks ---------------------------------------------------------------
+
+@benchmark('parse_snps_file', snps=1000)
+@benchmark('parse_snps_file', snps=100000)
+def parse_snps_setup(workdir, snps):
+    from pipeline import parse_snps_file
+    rate = snps / 197209
+    records, truth, reference_id = synthetic_genome(REFERENCE, seed=1, snp_rate=min(rate, 0.5), indel_rate=0)
+    while len(truth) < snps:
+        truth = truth + truth
+    path = os.path.join(workdir, f'parse_{snps}.snps')
+    write_show_snps(truth[:snps], reference_id, path)
+    return lambda: parse_snps_file(path)
+
+
+@benchmark('snp_store_write', snps=100000)
+def snp_store_setup(workdir, snps):
+    from pipeline import iter_snps
+    from snpstore import write_snp_store
+    records, truth, reference_id = synthetic_genome(REFERENCE, seed=2, snp_rate=0.5, indel_rate=0)
+    path = os.path.join(workdir, 'store.snps')
+    write_show_snps(truth[:snps], reference_id, path)
+    store_path = os.path.join(workdir, 'store.col')
+
+    def run():
+        with open(path) as f:
+            write_snp_store(iter_snps(f), store_path)
+    return run
+
+
+@benchmark('fastpath_call', snp_rate=0.001, seed=11)
+@benchmark('fastpath_call', snp_rate=0.005, seed=13)
+def fastpath_setup(workdir, snp_rate, seed):
+    ###the in-process caller on a substitution-only genome (seeds picked so it does not fall back),
+    ###reference index already built
+    from fastcall import call_snps, load_reference_index
+    path = genome(workdir, seed=seed, snp_rate=snp_rate, indel_rate=0)
+    load_reference_index(REFERENCE)
+    return lambda: call_snps(REFERENCE, path)
+
+
+@benchmark('upload_stats', genomes=1, contigs=1, n_runs=0)
+@benchmark('upload_stats', genomes=1, contigs=50, n_runs=20)
+@benchmark('upload_stats', genomes=10, contigs=1, n_runs=5)
+@benchmark('upload_stats', genomes=10, contigs=1, n_runs=5, compressed=True)
+def upload_stats_setup(workdir, genomes, contigs, n_runs, compressed=False):
+    ###the streaming ingest + statistics that upload_genome runs, on 64 KiB chunks like Django hands them out
+    from frontend.ingest import ingest_fasta
+    from frontend.seqstats import aggregate
+    paths = [genome(workdir, seed=100 + index, contigs=contigs, n_runs=n_runs, compressed=compressed)
+             for index in range(genomes)]
+    data = b''.join(open(path, 'rb').read() for path in paths)
+    uploads = os.path.join(workdir, 'uploads')
+    os.makedirs(uploads, exist_ok=True)
+
+    def run():
+        chunks = (data[start:start + 65536] for start in range(0, len(data), 65536))
+        filename, records = ingest_fasta(chunks, uploads)
+        aggregate(records)
+        os.remove(os.path.join(uploads, filename))
+    return run
+
+
+### --- end-to-end flows ---------------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Stack:
+    ###mutation service in this process, annotation service as a subprocess (local backend with
+    ###the prokka stand-in), django through its test client; all tools resolve to benchmarks/stubs
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.recordings = os.path.join(workdir, 'recordings')
+        os.makedirs(self.recordings, exist_ok=True)
+        self.annotation = None
+        self.created = []
+
+    def start(self):
+        os.environ['PATH'] = STUBS_DIR + os.pathsep + os.environ['PATH']
+        os.environ['BENCH_RECORDINGS'] = self.recordings
+        os.environ['MUTATION_CACHE_DIR'] = os.path.join(self.workdir, 'mutation_cache')
+        os.environ['MUTATION_COHORT_DIR'] = os.path.join(self.workdir, 'mutation_cohorts')
+
+        from werkzeug.serving import make_server
+        import app as mutation_app
+        mutation_port = free_port()
+        self.mutation_server = make_server('127.0.0.1', mutation_port, mutation_app.app, threaded=True)
+        threading.Thread(target=self.mutation_server.serve_forever, daemon=True).start()
+
+        annotation_port = free_port()
+        self.annotation = subprocess.Popen(
+            [sys.executable, '-c', 'import app; from werkzeug.serving import run_simple; '
+             f"run_simple('127.0.0.1', {annotation_port}, app.app, threaded=True)"],
+            cwd=os.path.join(ROOT, 'annotation_service_api'),
+            env=dict(os.environ, PROKKA_BACKEND='local', PROKKA_WORKERS='2'),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self._wait_for(f'http://127.0.0.1:{annotation_port}/health')
+
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'genomics_site.settings')
+        import django
+        django.setup()
+        from django.conf import settings
+        from django.test import Client
+        settings.BACKEND_SERVICES['mutation']['base_url'] = f'http://127.0.0.1:{mutation_port}'
+        settings.BACKEND_SERVICES['annotation']['base_url'] = f'http://127.0.0.1:{annotation_port}'
+        self.client = Client(HTTP_HOST='localhost')
+
+    def _wait_for(self, url, timeout=20):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                urllib.request.urlopen(url, timeout=1)
+                return
+            except Exception:
+                time.sleep(0.1)
+        raise RuntimeError(f'{url} did not come up')
+
+    def stop(self):
+        if self.annotation:
+            self.annotation.terminate()
+            self.annotation.wait()
+            self.mutation_server.shutdown()
+        for path in self.created:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def upload(self, path):
+        with open(path, 'rb') as f:
+            response = self.client.post('/upload/', {'uploaded_file': f})
+        filename = re.search(r'/mutation_analysis/([^"?]+)', response.content.decode()).group(1)
+        self.created.append(os.path.join(UPLOADS_DIR, filename))
+        return filename
+
+    def poll(self, url, since):
+        ###drives the same long-poll the status page runs in the browser
+        while True:
+            job = self.client.get(url, {'since': since}).json()
+            if job['status'] == 'failed':
+                raise RuntimeError(f"job failed: {job.get('error')}")
+            if job['status'] == 'done':
+                return
+            since = job['version']
+
+    def mutation(self, filename):
+        ###returns the result id after the result page was rendered and the csv downloaded
+        response = self.client.get(f'/mutation_analysis/{filename}', {'reference': 'NC_003310'})
+        page = response.content.decode()
+        job_id = re.search(r'mutation_status/([^"]+)"', page).group(1)
+        self.poll(f'/mutation_status/{job_id}', re.search(r'let since = (\d+)', page).group(1))
+        response = self.client.get(f'/mutation_result/{job_id}', {'reference': 'NC_003310'})
+        result_id = re.search(r'name="result_id" value="([0-9a-f]+)"', response.content.decode()).group(1)
+        response = self.client.post('/download_snps/', {'result_id': result_id})
+        for _ in response.streaming_content:
+            pass
+        return result_id
+
+    def pipeline(self, filename):
+        response = self.client.get(f'/pipeline/{filename}', {'reference': 'NC_003310'})
+        page = response.content.decode()
+        pipeline_id = re.search(r'pipeline_status/([^"]+)"', page).group(1)
+        versions = {'mutation': 0, 'annotation': 0}
+        while versions:
+            for name, job in self.client.get(f'/pipeline_status/{pipeline_id}', versions).json().items():
+                if job['status'] == 'failed':
+                    raise RuntimeError(f"{name} failed: {job.get('error')}")
+                if job['status'] == 'done':
+                    versions.pop(name)
+                else:
+                    versions[name] = job['version']
+        response = self.client.get(f'/pipeline_result/{pipeline_id}')
+        job_id = re.search(r'download_annotation/([^"]+)"', response.content.decode()).group(1)
+        self.created.append(os.path.join(UPLOADS_DIR, f'output_{job_id}'))
+
+
+def e2e_available():
+    return all(os.path.isdir(path) and os.access(path, os.W_OK) for path in (UPLOADS_DIR, REFERENCES_DIR)) \
+        and os.path.exists(os.path.join(REFERENCES_DIR, 'NC_003310.fasta'))
+
+
+@benchmark('e2e_mutation_cold', e2e=True)
+@benchmark('e2e_mutation_cold', e2e=True, compressed=True)
+def e2e_mutation_cold_setup(workdir, stack, repeat, warmup, compressed=False):
+    ###upload -> queue -> poll -> result page -> csv download, a new genome every round so nothing is cached
+    paths = iter([genome(workdir, seed=1000 + index, recordings=stack.recordings, compressed=compressed)
+                  for index in range(repeat + warmup)])
+    return lambda: stack.mutation(stack.upload(next(paths)))
+
+
+@benchmark('e2e_mutation_cached', e2e=True)
+def e2e_mutation_cached_setup(workdir, stack, repeat, warmup):
+    path = genome(workdir, seed=2000, recordings=stack.recordings)
+    stack.mutation(stack.upload(path))
+    return lambda: stack.mutation(stack.upload(path))
+
+
+@benchmark('e2e_csv_download', e2e=True, snps=50000)
+def e2e_csv_download_setup(workdir, stack, repeat, warmup, snps):
+    path = genome(workdir, seed=3000, recordings=stack.recordings, snp_rate=snps / 197209)
+    result_id = stack.mutation(stack.upload(path))
+
+    def run():
+        for _ in stack.client.post('/download_snps/', {'result_id': result_id}).streaming_content:
+            pass
+    return run
+
+
+@benchmark('e2e_pipeline', e2e=True)
+def e2e_pipeline_setup(workdir, stack, repeat, warmup):
+    ###annotation and mutation fanned out from one submission
+    paths = iter([genome(workdir, seed=4000 + index, recordings=stack.recordings)
+                  for index in range(repeat + warmup)])
+    return lambda: stack.pipeline(stack.upload(next(paths)))
+
+
+### --- driver -------------------------------------------------------------------------
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_id(name, params):
+    shown = {key: value for key, value in params.items() if key != 'e2e'}
+    return name + ''.join(f'[{key}={value}]' for key, value in sorted(shown.items()))
+
+
+def compare(results, baseline, threshold):
+    ###prints the change of every median against the baseline, returns the ids that regressed
+    regressions = []
+    print(f"\n{'benchmark':<55} {'median':>10} {'baseline':>10} {'change':>8}")
+    for bench_id, result in results.items():
+        before = baseline.get('results', {}).get(bench_id)
+        if 'median' not in result or not before or 'median' not in before:
+            continue
+        change = result['median'] / before['median'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(bench_id)
+        print(f"{bench_id:<55} {result['median'] * 1000:>8.1f}ms {before['median'] * 1000:>8.1f}ms "
+              f"{change * 100:>+7.1f}%{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks for the genomics services')
+    parser.add_argument('--only', help='run benchmarks whose id contains this text')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--output', help='result file (default benchmarks/results/<timestamp>.json)')
+    parser.add_argument('--baseline', help='earlier result file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown that counts as regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--skip-e2e', action='store_true')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='genomics_bench_')
+    stack = None
+    results = {}
+    try:
+        for name, setup, params in BENCHMARKS:
+            bench_id = benchmark_id(name, params)
+            if args.only and args.only not in bench_id:
+                continue
+            kwargs = {key: value for key, value in params.items() if key != 'e2e'}
+            if params.get('e2e'):
+                if args.skip_e2e or not e2e_available():
+                    results[bench_id] = {'skipped': 'needs writable /app/uploads and /data/references'}
+                    print(f'{bench_id:<55} skipped')
+                    continue
+                if stack is None:
+                    stack = Stack(workdir)
+                    stack.start()
+                kwargs.update(stack=stack, repeat=args.repeat, warmup=args.warmup)
+            fn = setup(workdir, **kwargs)
+            result = measure(fn, args.repeat, args.warmup)
+            result['params'] = {key: value for key, value in params.items() if key != 'e2e'}
+            results[bench_id] = result
+            print(f"{bench_id:<55} median {result['median'] * 1000:8.1f}ms  min {result['min'] * 1000:8.1f}ms")
+    finally:
+        if stack:
+            stack.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+        },
+        'results': results,
+    }
+    output = args.output or os.path.join(
+        BENCH_DIR, 'results', datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nresults written to {output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import csv
+import hashlib
+import json
+import os
+import time
+
+import requests
+
+from .ingest import ingest_fasta
+from .seqstats import aggregate
+from .services import get_client, ServiceUnavailable
+from .views import CONSEQUENCE_FIELDS, SNP_FIELDS
+
+
+FASTA_SUFFIXES = ('.fasta', '.fa', '.fna', '.fasta.gz', '.fa.gz', '.fna.gz')
+CHUNK_SIZE = 1 << 20
+POLL_WAIT = 20
+###a service answering 429 is asked again after its Retry-After, this many times at most
+BUSY_RETRIES = 60
+
+
+class BatchError(Exception):
+    pass
+
+
+def collect_inputs(paths):
+    ###fasta files in the order given: directories are walked (sorted), a manifest is any other
+    ###file that is not fasta and lists one path per line (# comments, relative to the manifest)
+    found, seen = [], set()
+    for path in paths:
+        if os.path.isdir(path):
+            candidates = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+                candidates += [os.path.join(dirpath, name) for name in sorted(filenames)
+                               if name.lower().endswith(FASTA_SUFFIXES)]
+        elif path.lower().endswith(FASTA_SUFFIXES):
+            candidates = [path]
+        else:
+            base = os.path.dirname(os.path.abspath(path))
+            with open(path) as f:
+                lines = [line.strip() for line in f]
+            candidates = [os.path.join(base, line) for line in lines if line and not line.startswith('#')]
+        for candidate in candidates:
+            candidate = os.path.abspath(candidate)
+            if candidate not in seen:
+                seen.add(candidate)
+                found.append(candidate)
+    return found
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class Journal:
+    ###append-only json lines, one per checkpoint of a genome ('ingested', then 'done' or 'failed');
+    ###the last line of a path wins. every line is a single O_APPEND write, so the worker processes
+    ###can all append to it and a crash loses at most the line being written
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path, 'rb+') as f:
+                data = f.read()
+                ###a torn last line of a crashed run is cut off, the next append would extend it
+                if data and not data.endswith(b'\n'):
+                    data = data[:data.rfind(b'\n') + 1]
+                    f.truncate(len(data))
+        except FileNotFoundError:
+            return
+        for line in data.splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self.entries[entry['path']] = entry
+
+    def current(self, path):
+        ###the checkpoint of `path`, unless the file changed since it was written
+        entry = self.entries.get(path)
+        if entry is None or entry.get('stamp') != file_stamp(path):
+            return None
+        return entry
+
+
+def append_line(path, entry):
+    data = (json.dumps(entry, sort_keys=True) + '\n').encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def init_worker():
+    ###pool processes are spawned, they set django up themselves
+    import django
+    django.setup()
+
+
+def _submit(client, path, payload):
+    ###queues a job, waiting out 429 answers
+    for _ in range(BUSY_RETRIES):
+        response = client.post(path, json=payload)
+        if response.status_code != 429:
+            break
+        time.sleep(float(response.headers.get('Retry-After') or 5))
+    if response.status_code != 202:
+        raise BatchError(f'{client.name} service answered {response.status_code}: {response.text[:500]}')
+    return response.json()
+
+
+def _wait(client, path, job):
+    ###long-polls a job until it is finished
+    while job['status'] not in ('done', 'failed'):
+        response = client.get(path, params={'wait': POLL_WAIT, 'since': job['version']}, timeout=POLL_WAIT + 10)
+        if response.status_code != 200:
+            raise BatchError(f'{client.name} service answered {response.status_code}: {response.text[:500]}')
+        job = response.json()
+    return job
+
+
+def _result(client, path):
+    response = client.get(path)
+    if response.status_code != 200:
+        raise BatchError(f'{client.name} job failed: {response.text[:500]}')
+    return response.json()
+
+
+def ingest(path, uploads_dir):
+    with open(path, 'rb') as f:
+        filename, records = ingest_fasta(iter(lambda: f.read(CHUNK_SIZE), b''), uploads_dir)
+    total = aggregate(records)
+    return filename, {'records': len(records), 'length': total.length, 'gc_content': round(total.gc_content, 4),
+                      'n_proportion': round(total.proportion('N'), 4), 'ambiguity': total.ambiguity}
+
+
+def write_snps_csv(result_id, csv_path):
+    ###the annotated snps of a result, streamed from the mutation service like download_snps does
+    partial_path = f'{csv_path}.part'
+    count = 0
+    with open(partial_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(SNP_FIELDS + CONSEQUENCE_FIELDS)
+        for line in get_client('mutation').iter_lines(f'/mutate/results/{result_id}/snps', params={'annotate': 1}):
+            snp = json.loads(line)
+            writer.writerow([snp[field] for field in SNP_FIELDS] +
+                            [snp.get(field) or '' for field in CONSEQUENCE_FIELDS])
+            count += 1
+    os.replace(partial_path, csv_path)
+    return count
+
+
+def csv_name(path):
+    ###input basenames repeat across directories, a short hash of the full path keeps them apart
+    stem = os.path.basename(path)
+    for suffix in FASTA_SUFFIXES:
+        if stem.lower().endswith(suffix):
+            stem = stem[:-len(suffix)]
+            break
+    return f'{stem}.{hashlib.sha1(path.encode()).hexdigest()[:8]}.csv'
+
+
+def process_genome(path, options):
+    ###ingest -> snp calling (-> annotation) for one genome; runs in a pool process and writes its own
+    ###checkpoints, returns the final journal entry
+    journal_path = options['journal']
+    started = time.perf_counter()
+    stamp = file_stamp(path)
+    entry = {'path': path, 'stamp': stamp}
+    try:
+        previous = options.get('previous') or {}
+        if previous.get('filename') and os.path.exists(os.path.join(options['uploads_dir'], previous['filename'])):
+            ###ingested by an earlier run that did not finish, the upload is still there
+            filename, stats = previous['filename'], previous['stats']
+        else:
+            filename, stats = ingest(path, options['uploads_dir'])
+            append_line(journal_path, dict(entry, status='ingested', filename=filename, stats=stats))
+        entry.update(filename=filename, stats=stats)
+
+        mutation_client = get_client('mutation')
+        reference = options['reference']
+        if reference == 'auto' and options['annotate']:
+            ###both jobs need the same reference, pick it once
+            response = mutation_client.post('/classify', json={'filename': filename})
+            if response.status_code != 200 or not response.json().get('best'):
+                raise BatchError(f'No reference found: {response.text[:500]}')
+            reference = response.json()['best']
+
+        mutation = _submit(mutation_client, '/mutate/jobs', {
+            'filename': filename, 'reference': 'auto' if reference == 'auto' else f'{reference}.fasta',
+            'cohort': options.get('cohort')})
+        annotation = None
+        if options['annotate']:
+            annotation = _submit(get_client('annotation'), '/annotate/jobs',
+                                 {'filename': filename, 'reference': f'{reference}.faa'})
+
+        mutation = _wait(mutation_client, f"/mutate/jobs/{mutation['job_id']}", mutation)
+        result = _result(mutation_client, f"/mutate/jobs/{mutation['job_id']}/result")
+        entry['mutation'] = {key: result.get(key) for key in ('result_id', 'reference', 'snp_count', 'engine', 'cached')}
+        if options.get('snps_dir'):
+            csv_path = os.path.join(options['snps_dir'], csv_name(path))
+            write_snps_csv(result['result_id'], csv_path)
+            entry['mutation']['csv'] = csv_path
+
+        if annotation:
+            client = get_client('annotation')
+            annotation = _wait(client, f"/annotate/jobs/{annotation['job_id']}", annotation)
+            _result(client, f"/annotate/jobs/{annotation['job_id']}/result")
+            entry['annotation'] = {'job_id': annotation['job_id'],
+                                   'output_dir': os.path.join(options['uploads_dir'], f"output_{annotation['job_id']}")}
+        entry['status'] = 'done'
+    except (BatchError, OSError, ValueError, requests.RequestException, ServiceUnavailable) as e:
+        ###FastaFormatError is a ValueError
+        entry.update(status='failed', error=f'{type(e).__name__}: {e}')
+    entry['seconds'] = round(time.perf_counter() - started, 3)
+    append_line(journal_path, entry)
+    return entry
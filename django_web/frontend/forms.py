@@ -8,4 +8,10 @@ class GenomeForm(forms.Form):
     ),
     required=False)
 
-    uploaded_file = forms.FileField(required=False)
\ No newline at end of file
+    uploaded_file = forms.FileField(required=False, help_text='FASTA, plain or gzip / BGZF compressed (.fasta.gz)')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('uploaded_file') and not cleaned_data.get('genome_text', '').strip():
+            raise forms.ValidationError('Upload a FASTA file or paste a genome.')
+        return cleaned_data
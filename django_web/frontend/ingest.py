@@ -0,0 +1,149 @@
+import os
+import uuid
+import zlib
+from itertools import chain
+
+from .seqstats import SequenceStats
+
+
+UPLOADS_DIR = '/app/uploads'
+
+###IUPAC nucleotide codes (plus gap), both cases
+VALID_BASES = b'ACGTURYKMSWBDHVN-acgturykmswbdhvn'
+WHITESPACE = b' \t\r\n'
+MAX_HEADER_LENGTH = 10000
+GZIP_MAGIC = b'\x1f\x8b'
+###upper bound of what one decompress call may produce, keeps memory flat on highly compressible input
+DECOMPRESS_CHUNK = 1 << 20
+
+
+class FastaFormatError(ValueError):
+    pass
+
+
+class FastaIngest:
+    ###incremental fasta parser: feed() it raw byte chunks in order, it validates and
+    ###collects per-record statistics without ever holding more than one chunk
+    ###(and at most one header line) in memory
+    def __init__(self):
+        self.records = []
+        self._header = None
+        self._at_line_start = True
+
+    def feed(self, chunk):
+        pos = 0
+        end = len(chunk)
+        while pos < end:
+            if self._header is not None:
+                newline = chunk.find(b'\n', pos)
+                stop = end if newline == -1 else newline
+                self._header += chunk[pos:stop]
+                if len(self._header) > MAX_HEADER_LENGTH:
+                    raise FastaFormatError('FASTA header line is too long.')
+                if newline == -1:
+                    pos = end
+                    break
+                self._start_record()
+                pos = newline + 1
+                self._at_line_start = True
+                continue
+
+            marker = chunk.find(b'>', pos)
+            stop = end if marker == -1 else marker
+            if stop > pos:
+                self._sequence(chunk[pos:stop])
+            if marker == -1:
+                break
+            at_line_start = chunk[marker - 1:marker] == b'\n' if marker > 0 else self._at_line_start
+            if not at_line_start:
+                raise FastaFormatError("'>' is only allowed at the start of a header line.")
+            self._header = bytearray()
+            pos = marker + 1
+        if end:
+            self._at_line_start = chunk[end - 1:end] == b'\n'
+
+    def close(self):
+        if self._header is not None:
+            self._start_record()
+        if not self.records:
+            raise FastaFormatError('No FASTA records found.')
+        return self.records
+
+    def _start_record(self):
+        header = bytes(self._header).strip().decode('utf-8', errors='replace')
+        self._header = None
+        if not header:
+            raise FastaFormatError('Found a FASTA record without a header.')
+        self.records.append(SequenceStats(header.split(maxsplit=1)[0], header))
+
+    def _sequence(self, data):
+        sequence = data.translate(None, WHITESPACE)
+        if not sequence:
+            return
+        if not self.records:
+            raise FastaFormatError("A FASTA file must start with a '>' header line.")
+        invalid = sequence.translate(None, VALID_BASES)
+        if invalid:
+            shown = ''.join(sorted(set(invalid.decode('latin-1'))))[:10]
+            raise FastaFormatError(f'Invalid characters in sequence {self.records[-1].id}: {shown}')
+        self.records[-1].update(sequence)
+
+
+def gunzip_chunks(chunks):
+    ###streaming gzip decompression; bgzf (and concatenated gzip) is a series of gzip members,
+    ###each member after the first gets a fresh decompressor
+    decompressor = zlib.decompressobj(wbits=31)
+    pending = False
+    try:
+        for chunk in chunks:
+            data = chunk
+            while data:
+                pending = True
+                out = decompressor.decompress(data, DECOMPRESS_CHUNK)
+                if out:
+                    yield out
+                if decompressor.eof:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+                    pending = False
+                else:
+                    data = decompressor.unconsumed_tail
+        if pending:
+            ###input ended inside a member
+            while not decompressor.eof:
+                out = decompressor.decompress(b'', DECOMPRESS_CHUNK)
+                if not out:
+                    raise FastaFormatError('The gzip file is truncated.')
+                yield out
+    except zlib.error as e:
+        raise FastaFormatError(f'Not a valid gzip file: {e}')
+
+
+def ingest_fasta(chunks, uploads_dir=UPLOADS_DIR):
+    ###one pass over the upload: every chunk is validated, counted and written straight to disk;
+    ###the file only appears under its final name once the whole upload was valid.
+    ###gzip / bgzf uploads are stored as they came (<uuid>.fasta.gz) and only decompressed on the fly
+    job_id = str(uuid.uuid4())
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    compressed = first[:2] == GZIP_MAGIC
+    filename = f'{job_id}.fasta.gz' if compressed else f'{job_id}.fasta'
+    file_path = os.path.join(uploads_dir, filename)
+    partial_path = os.path.join(uploads_dir, f'.{filename}.part')
+
+    parser = FastaIngest()
+    try:
+        with open(partial_path, 'wb') as out_file:
+            def stored():
+                for chunk in chain([first], chunks):
+                    out_file.write(chunk)
+                    yield chunk
+            for piece in gunzip_chunks(stored()) if compressed else stored():
+                parser.feed(piece)
+        records = parser.close()
+        os.replace(partial_path, file_path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    return filename, records
@@ -0,0 +1,97 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from frontend.batch import Journal, append_line, collect_inputs, file_stamp, init_worker, process_genome
+from frontend.ingest import UPLOADS_DIR
+
+
+class Command(BaseCommand):
+    help = ('Runs ingest, snp calling and optionally annotation for a directory or manifest of FASTA files '
+            'through a process pool. Progress is checkpointed in <output>/journal.jsonl, running the same '
+            'command again resumes where it stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('inputs', nargs='+',
+                            help='FASTA files (.gz too), directories to scan, or manifests listing one path per line')
+        parser.add_argument('--output', required=True,
+                            help='directory for journal.jsonl (one json line per genome) and the snp csv files')
+        parser.add_argument('--workers', type=int, default=4, help='genomes processed at the same time')
+        parser.add_argument('--reference', default='auto',
+                            help="reference name without extension (e.g. NC_003310), 'auto' picks the closest")
+        parser.add_argument('--annotate', action='store_true', help='also run prokka on every genome')
+        parser.add_argument('--snps', action='store_true', help='write the annotated snps of every genome as csv')
+        parser.add_argument('--cohort', help='add every sample to this cohort of the mutation service')
+        parser.add_argument('--skip-failed', action='store_true',
+                            help='do not retry genomes that failed in an earlier run')
+        parser.add_argument('--uploads-dir', default=UPLOADS_DIR,
+                            help='the uploads volume shared with the services')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        paths = collect_inputs(options['inputs'])
+        if not paths:
+            raise CommandError('No FASTA files found')
+        os.makedirs(options['output'], exist_ok=True)
+        snps_dir = os.path.join(options['output'], 'snps') if options['snps'] else None
+        if snps_dir:
+            os.makedirs(snps_dir, exist_ok=True)
+        journal = Journal(os.path.join(options['output'], 'journal.jsonl'))
+
+        ###finished genomes are skipped; an interrupted one keeps its upload when it got that far
+        pending, skipped = [], 0
+        for path in paths:
+            try:
+                entry = journal.current(path)
+            except FileNotFoundError:
+                self.stderr.write(f'Missing input: {path}')
+                continue
+            status = entry and entry['status']
+            if status == 'done' or (status == 'failed' and options['skip_failed']):
+                skipped += 1
+                continue
+            pending.append((path, entry))
+        self.stdout.write(f'{len(paths)} genomes, {skipped} already processed, {len(pending)} to go')
+
+        settings = {'journal': journal.path, 'uploads_dir': options['uploads_dir'], 'reference': options['reference'],
+                    'annotate': options['annotate'], 'snps_dir': snps_dir, 'cohort': options['cohort']}
+        started = time.perf_counter()
+        counts = {'done': 0, 'failed': 0}
+        executor = ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=init_worker)
+        try:
+            futures = {executor.submit(process_genome, path, dict(settings, previous=entry)): path
+                       for path, entry in pending}
+            for future in as_completed(futures):
+                try:
+                    entry = future.result()
+                except Exception as e:
+                    ###the worker died (BrokenProcessPool fails every genome still in the pool) or raised
+                    ###something process_genome does not journal itself: record it, a rerun retries it
+                    entry = self.failed(futures[future], f'{type(e).__name__}: {e}', journal)
+                counts[entry['status']] += 1
+                if entry['status'] == 'done':
+                    self.stdout.write(f"[{sum(counts.values())}/{len(pending)}] {entry['path']}: "
+                                      f"{entry['mutation']['snp_count']} snps vs {entry['mutation']['reference']} "
+                                      f"({entry['seconds']}s)")
+                else:
+                    self.stderr.write(f"[{sum(counts.values())}/{len(pending)}] {entry['path']}: {entry['error']}")
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise CommandError('Interrupted, run the same command again to resume')
+        executor.shutdown()
+        self.stdout.write(f"{counts['done']} done, {counts['failed']} failed in "
+                          f'{time.perf_counter() - started:.1f}s, journal: {journal.path}')
+
+    def failed(self, path, error, journal):
+        entry = {'path': path, 'status': 'failed', 'error': error}
+        try:
+            entry['stamp'] = file_stamp(path)
+        except OSError:
+            pass
+        append_line(journal.path, entry)
+        return entry
@@ -0,0 +1,154 @@
+import numpy as np
+
+
+BASES = 'ACGT'
+###IUPAC ambiguity codes, N included
+AMBIGUITY_CODES = 'RYKMSWBDHVN'
+DEFAULT_WINDOW = 1000
+DEFAULT_STEP = 500
+
+
+def _lookup(letters):
+    ###256-entry table so a whole sequence is classified with one fancy-index, both cases
+    table = np.zeros(256, dtype=bool)
+    for letter in letters:
+        table[ord(letter.upper())] = True
+        table[ord(letter.lower())] = True
+    return table
+
+
+GC_LOOKUP = _lookup('GC')
+CALLED_LOOKUP = _lookup(BASES)
+N_LOOKUP = _lookup('N')
+
+
+class SequenceStats:
+    ###composition statistics for one record, built incrementally: update() can be called with
+    ###consecutive pieces of the sequence (whitespace already removed) and each piece is
+    ###processed with a handful of numpy passes (bincount + lookup tables)
+    def __init__(self, record_id='', description='', window=DEFAULT_WINDOW, step=DEFAULT_STEP):
+        if window % step:
+            raise ValueError('window must be a multiple of step')
+        self.id = record_id
+        self.description = description or record_id
+        self.window = window
+        self.step = step
+        self.length = 0
+        self._byte_counts = np.zeros(256, dtype=np.int64)
+        self._n_runs = []
+        self._open_n_run = None
+        self._gc_bins = []
+        self._called_bins = []
+
+    def update(self, sequence):
+        values = np.frombuffer(sequence, dtype=np.uint8)
+        if not values.size:
+            return
+        self._byte_counts += np.bincount(values, minlength=256)
+        self._track_n_runs(values)
+        self._track_gc(values)
+        self.length += values.size
+
+    def _track_n_runs(self, values):
+        is_n = N_LOOKUP[values].astype(np.int8)
+        previous = 1 if self._open_n_run is not None else 0
+        changes = np.flatnonzero(np.diff(is_n, prepend=previous))
+        starts = (self.length + changes[is_n[changes] == 1]).tolist()
+        ends = (self.length + changes[is_n[changes] == 0]).tolist()
+        if self._open_n_run is not None:
+            starts.insert(0, self._open_n_run)
+        ###a run still open at the end of this piece may continue in the next one
+        self._open_n_run = starts.pop() if len(starts) > len(ends) else None
+        self._n_runs.extend(zip(starts, ends))
+
+    def _track_gc(self, values):
+        ###per-step bins of gc and called (ACGT) bases; windows are summed from these at the end
+        offset = self.length % self.step
+        bins = (np.arange(values.size) + offset) // self.step
+        gc = np.bincount(bins, weights=GC_LOOKUP[values]).astype(np.int64)
+        called = np.bincount(bins, weights=CALLED_LOOKUP[values]).astype(np.int64)
+        if offset and self._gc_bins:
+            self._gc_bins[-1][-1] += gc[0]
+            self._called_bins[-1][-1] += called[0]
+            gc, called = gc[1:], called[1:]
+        if gc.size:
+            self._gc_bins.append(gc)
+            self._called_bins.append(called)
+
+    def count(self, letter):
+        return int(self._byte_counts[ord(letter.upper())] + self._byte_counts[ord(letter.lower())])
+
+    @property
+    def composition(self):
+        return {base: self.count(base) for base in BASES}
+
+    @property
+    def ambiguity(self):
+        return {code: self.count(code) for code in AMBIGUITY_CODES if self.count(code)}
+
+    def proportion(self, letter):
+        return (self.count(letter) / self.length) * 100 if self.length else 0.0
+
+    @property
+    def gc_content(self):
+        called = sum(self.composition.values())
+        return ((self.count('G') + self.count('C')) / called) * 100 if called else 0.0
+
+    @property
+    def n_runs(self):
+        ###1-based, inclusive coordinates
+        runs = list(self._n_runs)
+        if self._open_n_run is not None:
+            runs.append((self._open_n_run, self.length))
+        return [{'start': start + 1, 'end': end} for start, end in runs]
+
+    def gc_profile(self):
+        if not self._gc_bins:
+            return []
+        gc = np.concatenate(self._gc_bins)
+        called = np.concatenate(self._called_bins)
+        per_window = max(1, min(self.window // self.step, gc.size))
+        gc_sum = np.cumsum(np.concatenate(([0], gc)))
+        called_sum = np.cumsum(np.concatenate(([0], called)))
+        gc_windows = gc_sum[per_window:] - gc_sum[:-per_window]
+        called_windows = called_sum[per_window:] - called_sum[:-per_window]
+        starts = np.arange(gc_windows.size) * self.step
+        ends = np.minimum(starts + self.window, self.length)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fractions = np.where(called_windows > 0, gc_windows * 100.0 / called_windows, np.nan)
+        return [{'start': int(start) + 1, 'end': int(end), 'gc': None if np.isnan(value) else round(float(value), 2)}
+                for start, end, value in zip(starts, ends, fractions)]
+
+    def to_dict(self, profile=False):
+        stats = {
+            'id': self.id,
+            'description': self.description,
+            'length': self.length,
+            'composition': self.composition,
+            'ambiguity': self.ambiguity,
+            'gc_content': self.gc_content,
+            'n_runs': self.n_runs,
+        }
+        for letter in 'ACGTN':
+            stats[f'{letter.lower()}_proportion'] = self.proportion(letter)
+        if profile:
+            stats['gc_profile'] = {'window': self.window, 'step': self.step, 'windows': self.gc_profile()}
+        return stats
+
+
+def sequence_stats(sequence, record_id='', **kwargs):
+    ###one-shot helper for a sequence already in memory (str or bytes)
+    if isinstance(sequence, str):
+        sequence = sequence.encode('ascii')
+    stats = SequenceStats(record_id, **kwargs)
+    stats.update(sequence)
+    return stats
+
+
+def aggregate(records):
+    ###genome-wide composition over all records (positional data such as n runs stays per record)
+    total = SequenceStats('all records')
+    for record in records:
+        total.length += record.length
+        total._byte_counts += record._byte_counts
+    return total
@@ -0,0 +1,175 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import timing
+
+
+RETRY_STATUSES = (502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+class ServiceUnavailable(Exception):
+    ###raised without touching the network while a service's circuit is open
+    pass
+
+
+class CircuitBreaker:
+    ###closed -> open after `failure_threshold` failures in a row; after `reset_timeout` seconds
+    ###one trial call is let through (half-open) and its outcome closes or re-opens the circuit
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def release(self):
+        ###a trial call that ended without an outcome lets the next call try again
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ServiceClient:
+    ###one per backend service and process: a pooled keep-alive requests.Session shared by the sync
+    ###views and, through a thread pool of the same size, by the async ones, with one circuit breaker
+    def __init__(self, name, base_url, connect_timeout=3, read_timeout=60, retries=2,
+                 backoff=0.5, pool_size=20, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._session = None
+        self._session_lock = threading.Lock()
+        ###a cancelled await (a long-poll that lost the race) leaves its call running here until the
+        ###response or the timeout, so it still records its outcome in the breaker
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix=f'{name}-client')
+
+    @property
+    def session(self):
+        with self._session_lock:
+            if self._session is None:
+                ###connection errors are retried for every method (nothing reached the service),
+                ###read errors and 5xx answers only for idempotent ones
+                retry = Retry(total=self.retries, connect=self.retries, read=self.retries,
+                              status=self.retries, backoff_factor=self.backoff,
+                              status_forcelist=RETRY_STATUSES, allowed_methods=IDEMPOTENT_METHODS,
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def _check_circuit(self):
+        if not self.breaker.allow():
+            raise ServiceUnavailable(f'{self.name} service is unavailable (circuit open)')
+
+    def _record(self, status_code):
+        if status_code in RETRY_STATUSES:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def request(self, method, path, timeout=None, **kwargs):
+        self._check_circuit()
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f'{self.base_url}{path}',
+                                            timeout=timeout or self.timeout, **kwargs)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            ###ended without an outcome, a half-open trial must not stay taken
+            self.breaker.release()
+            raise
+        finally:
+            timing.record(self.name, time.perf_counter() - started)
+        self._record(response.status_code)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def iter_lines(self, path, **kwargs):
+        ###streams a line-oriented (ndjson) response without buffering it
+        with self.request('GET', path, stream=True, **kwargs) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield line
+
+    async def arequest(self, method, path, **kwargs):
+        ###async views await the pooled session on the client's own threads: under WSGI every request
+        ###gets a fresh event loop, so a per-loop async client would never be reused or closed.
+        ###the context is copied so the call still lands in the view's Server-Timing
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, self.request, method, path, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    async def aget(self, path, **kwargs):
+        return await self.arequest('GET', path, **kwargs)
+
+    async def apost(self, path, **kwargs):
+        return await self.arequest('POST', path, **kwargs)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name):
+    ###clients are built from settings.BACKEND_SERVICES on first use and reused for the process lifetime
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = _clients[name] = ServiceClient(name, **settings.BACKEND_SERVICES[name])
+        return client
@@ -1,3 +1,375 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.core import signing
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from django.urls import reverse
+
+from .batch import Journal, append_line, file_stamp
+from .ingest import FastaFormatError, ingest_fasta
+from .seqstats import SequenceStats, aggregate, sequence_stats
+from .services import CircuitBreaker, ServiceClient, ServiceUnavailable
+from .views import PIPELINE_SALT
+from .zipstream import archive_key, iter_zip, iter_zip_cached
+
+
+FASTA = b'>contig1 first record\nACGTNNNNAC\nGT\n>contig2\nacgtRY\n'
+
+
+def pieces(data, size):
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+class IngestTest(SimpleTestCase):
+    def setUp(self):
+        self.uploads = tempfile.TemporaryDirectory()
+        self.addCleanup(self.uploads.cleanup)
+
+    def ingest(self, chunks):
+        return ingest_fasta(chunks, uploads_dir=self.uploads.name)
+
+    def assertRejected(self, chunks, message):
+        with self.assertRaisesRegex(FastaFormatError, message):
+            self.ingest(chunks)
+        ###nothing of a rejected upload is left behind
+        self.assertEqual(os.listdir(self.uploads.name), [])
+
+    def test_records_do_not_depend_on_chunk_boundaries(self):
+        for size in (1, 3, 7, len(FASTA)):
+            with self.subTest(size=size):
+                filename, records = self.ingest(pieces(FASTA, size))
+                self.assertEqual([(record.id, record.length) for record in records], [('contig1', 12), ('contig2', 6)])
+                self.assertEqual(records[0].description, 'contig1 first record')
+                with open(os.path.join(self.uploads.name, filename), 'rb') as f:
+                    self.assertEqual(f.read(), FASTA)
+
+    def test_gzip_and_bgzf_are_stored_compressed(self):
+        ###two members, as bgzf writes them
+        data = gzip.compress(FASTA[:20]) + gzip.compress(FASTA[20:])
+        filename, records = self.ingest(pieces(data, 5))
+        self.assertTrue(filename.endswith('.fasta.gz'))
+        self.assertEqual([record.length for record in records], [12, 6])
+        with open(os.path.join(self.uploads.name, filename), 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_invalid_uploads_are_rejected(self):
+        self.assertRejected([b''], 'No FASTA records')
+        self.assertRejected([b'ACGT\n'], "must start with a '>'")
+        self.assertRejected([b'>\nACGT\n'], 'without a header')
+        self.assertRejected([b'>r1\nAC>GT\n'], "only allowed at the start")
+        self.assertRejected([b'>r1\nACGT\n', b'AC12\n'], 'Invalid characters in sequence r1: 12')
+        self.assertRejected([b'>' + b'x' * 20000], 'too long')
+
+    def test_broken_gzip_is_rejected(self):
+        data = gzip.compress(FASTA)
+        self.assertRejected([data[:len(data) // 2]], 'truncated')
+        self.assertRejected([data[:10] + b'garbage' * 10], 'Not a valid gzip file')
+
+
+class SequenceStatsTest(SimpleTestCase):
+    SEQUENCE = ('ACGTNNNNGGCCatatNNRYgc' * 40) + 'NNN'
+
+    def naive_gc_profile(self, sequence, window, step):
+        windows = []
+        for start in range(0, max(1, len(sequence) - window + step), step):
+            piece = sequence[start:start + window].upper()
+            called = sum(piece.count(base) for base in 'ACGT')
+            gc = piece.count('G') + piece.count('C')
+            windows.append({'start': start + 1, 'end': min(start + window, len(sequence)),
+                            'gc': round(gc * 100 / called, 2) if called else None})
+        return windows
+
+    def test_pieces_give_the_same_statistics_as_one_pass(self):
+        whole = sequence_stats(self.SEQUENCE, 'r1', window=100, step=50).to_dict(profile=True)
+        for size in (1, 7, 49, 50, 333):
+            with self.subTest(size=size):
+                stats = SequenceStats('r1', window=100, step=50)
+                for piece in pieces(self.SEQUENCE.encode(), size):
+                    stats.update(piece)
+                self.assertEqual(stats.to_dict(profile=True), whole)
+
+    def test_composition_and_n_runs(self):
+        stats = sequence_stats('NNACgtRNNNa', 'r1')
+        self.assertEqual(stats.composition, {'A': 2, 'C': 1, 'G': 1, 'T': 1})
+        self.assertEqual(stats.ambiguity, {'R': 1, 'N': 5})
+        self.assertEqual(stats.n_runs, [{'start': 1, 'end': 2}, {'start': 8, 'end': 10}])
+        self.assertAlmostEqual(stats.gc_content, 40.0)
+        self.assertAlmostEqual(stats.proportion('n'), 5 * 100 / 11)
+
+    def test_gc_profile_matches_a_naive_window_scan(self):
+        stats = sequence_stats(self.SEQUENCE, window=100, step=50)
+        self.assertEqual(stats.gc_profile(), self.naive_gc_profile(self.SEQUENCE, 100, 50))
+        self.assertEqual(sequence_stats('NNNN', window=100, step=50).gc_profile()[0]['gc'], None)
+        with self.assertRaises(ValueError):
+            SequenceStats(window=100, step=30)
+
+    def test_aggregate_sums_the_records(self):
+        total = aggregate([sequence_stats('ACGT'), sequence_stats('GGNN')])
+        self.assertEqual((total.length, total.count('G'), total.count('N')), (8, 3, 2))
+
+
+class CircuitBreakerTest(SimpleTestCase):
+    def setUp(self):
+        clock = mock.patch('frontend.services.time.monotonic', return_value=1000.0)
+        self.clock = clock.start()
+        self.addCleanup(clock.stop)
+
+    def opened(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.clock.return_value += 30
+        self.assertEqual(breaker.state, 'half-open')
+        return breaker
+
+    def test_half_open_lets_one_trial_through(self):
+        breaker = self.opened()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = self.opened()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+    def test_client_releases_an_interrupted_trial(self):
+        client = ServiceClient('test', 'http://backend', failure_threshold=2)
+        client.breaker = self.opened()
+        with mock.patch.object(client.session, 'request', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                client.get('/status')
+        ###still half-open, and the next call may try again
+        self.assertTrue(client.breaker.allow())
+
+    def test_client_fails_fast_while_open(self):
+        client = ServiceClient('test', 'http://backend', failure_threshold=2, retries=0)
+        with mock.patch.object(client.session, 'request', side_effect=requests.ConnectionError):
+            for _ in range(2):
+                with self.assertRaises(requests.ConnectionError):
+                    client.get('/status')
+            with self.assertRaises(ServiceUnavailable):
+                client.get('/status')
+            self.assertEqual(client.session.request.call_count, 2)
+
+    def test_async_calls_share_the_session_and_the_breaker(self):
+        client = ServiceClient('test', 'http://backend', failure_threshold=2)
+        client.breaker = self.opened()
+        response = mock.Mock(status_code=200)
+        with mock.patch.object(client.session, 'request', return_value=response) as request:
+            self.assertIs(asyncio.run(client.aget('/status', params={'wait': 1})), response)
+        request.assert_called_once_with('GET', 'http://backend/status', timeout=client.timeout, params={'wait': 1})
+        self.assertEqual(client.breaker.state, 'closed')
+
+
+class MutationStatusTest(SimpleTestCase):
+    def poll(self, response):
+        client = mock.Mock()
+        client.aget = mock.AsyncMock(return_value=response)
+        with mock.patch('frontend.views.get_client', return_value=client):
+            return self.client.get(reverse('mutation_job_status', args=['job']), {'since': '3'})
+
+    def test_job_is_passed_through(self):
+        answer = self.poll(mock.Mock(status_code=200, json=mock.Mock(return_value={'status': 'running'})))
+        self.assertEqual((answer.status_code, answer.json()), (200, {'status': 'running'}))
+
+    def test_non_json_reply_is_a_bad_gateway(self):
+        ###e.g. the html error page of a proxy in front of the service
+        answer = self.poll(mock.Mock(status_code=504, json=mock.Mock(side_effect=ValueError('Expecting value'))))
+        self.assertEqual(answer.status_code, 502)
+        self.assertEqual(answer.json()['status'], 'unknown')
+
+
+class PipelineStatusTest(SimpleTestCase):
+    PIPELINE = {'filename': 'genome.fasta', 'reference': 'ref', 'mutation': 'm1', 'annotation': 'a1'}
+
+    def setUp(self):
+        self.cancelled = []
+        self.calls = []
+
+    def reply(self, status_code=200, job=None):
+        response = mock.Mock(status_code=status_code, text='<html>bad gateway</html>')
+        response.json = mock.Mock(return_value=job) if job is not None else mock.Mock(side_effect=ValueError('Expecting value'))
+        return response
+
+    def client_for(self, name, response):
+        async def aget(path, params=None, timeout=None):
+            self.calls.append((name, path, params['since']))
+            if response is None:
+                ###a job that does not change within the test
+                try:
+                    await asyncio.sleep(30)
+                except asyncio.CancelledError:
+                    self.cancelled.append(name)
+                    raise
+            return response
+        client = mock.Mock()
+        client.aget = mock.AsyncMock(side_effect=aget)
+        return client
+
+    def poll(self, responses, pipeline_id=None, **since):
+        clients = {name: self.client_for(name, response) for name, response in responses.items()}
+        pipeline_id = pipeline_id or signing.dumps(self.PIPELINE, salt=PIPELINE_SALT)
+        with mock.patch('frontend.views.get_client', side_effect=clients.__getitem__):
+            return self.client.get(reverse('pipeline_status', args=[pipeline_id]), since)
+
+    def test_first_changed_job_answers_and_the_other_wait_is_dropped(self):
+        answer = self.poll({'mutation': self.reply(job={'status': 'done'}), 'annotation': None},
+                           mutation='2', annotation='5')
+        self.assertEqual((answer.status_code, answer.json()), (200, {'mutation': {'status': 'done'}}))
+        self.assertEqual(sorted(self.calls), [('annotation', '/annotate/jobs/a1', '5'), ('mutation', '/mutate/jobs/m1', '2')])
+        self.assertEqual(self.cancelled, ['annotation'])
+
+    def test_only_the_jobs_still_waited_on_are_polled(self):
+        answer = self.poll({'mutation': None, 'annotation': self.reply(job={'status': 'running'})}, annotation='1')
+        self.assertEqual(answer.json(), {'annotation': {'status': 'running'}})
+        self.assertEqual([name for name, _, _ in self.calls], ['annotation'])
+        self.assertEqual(self.poll({}).json(), {})
+
+    def test_service_errors_are_a_bad_gateway(self):
+        for response in (self.reply(status_code=500, job={'error': 'boom'}), self.reply()):
+            with self.subTest(status_code=response.status_code):
+                answer = self.poll({'mutation': response, 'annotation': None}, mutation='0', annotation='0')
+                self.assertEqual(answer.status_code, 502)
+                self.assertEqual(answer.json()['status'], 'unknown')
+
+    def test_unsigned_pipeline_is_unknown(self):
+        tampered = signing.dumps(dict(self.PIPELINE, mutation='other'), salt='another.salt')
+        self.assertEqual(self.poll({}, pipeline_id=tampered, mutation='0').status_code, 404)
+
+
+class ZipStreamTest(SimpleTestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.files = []
+        for name, data in (('a.fasta', FASTA * 5000), ('empty.txt', b''), ('b.gff', os.urandom(200000))):
+            path = os.path.join(self.workdir.name, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.files.append((f'result/{name}', path))
+
+    def assertArchive(self, data, compress_type):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            ###testzip reads every member back and checks its crc
+            self.assertIsNone(archive.testzip())
+            self.assertEqual([info.filename for info in archive.infolist()], [name for name, _ in self.files])
+            for (name, path), info in zip(self.files, archive.infolist()):
+                self.assertEqual(info.compress_type, compress_type)
+                self.assertEqual(info.file_size, os.path.getsize(path))
+                with open(path, 'rb') as f:
+                    self.assertEqual(archive.read(name), f.read())
+
+    def test_deflated_and_stored_archives_are_valid(self):
+        chunks = list(iter_zip(self.files))
+        self.assertGreater(len(chunks), 1)
+        self.assertArchive(b''.join(chunks), zipfile.ZIP_DEFLATED)
+        self.assertArchive(b''.join(iter_zip(self.files, compresslevel=0)), zipfile.ZIP_STORED)
+
+    def test_zip64_members_are_readable(self):
+        with mock.patch('frontend.zipstream.ZIP64_LIMIT', 1000):
+            self.assertArchive(b''.join(iter_zip(self.files)), zipfile.ZIP_DEFLATED)
+
+    def test_cached_archive_is_written_only_when_complete(self):
+        archive_path = os.path.join(self.workdir.name, 'archives', 'a.zip')
+        stream = iter_zip_cached(self.files, archive_path)
+        next(stream)
+        stream.close()
+        self.assertEqual(os.listdir(os.path.dirname(archive_path)), [])
+        data = b''.join(iter_zip_cached(self.files, archive_path))
+        with open(archive_path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertArchive(data, zipfile.ZIP_DEFLATED)
+
+    def test_archive_key_follows_the_files_and_the_level(self):
+        key = archive_key(self.files, 6)
+        self.assertEqual(key, archive_key(list(reversed(self.files)), 6))
+        self.assertNotEqual(key, archive_key(self.files, 0))
+        os.utime(self.files[0][1], ns=(1, 1))
+        self.assertNotEqual(key, archive_key(self.files, 6))
+
+
+class ThreadPool(ThreadPoolExecutor):
+    ###the command's process pool, minus the processes (patched functions do not reach spawned ones)
+    def __init__(self, max_workers, mp_context=None, initializer=None):
+        super().__init__(max_workers)
+
+
+class BatchGenomesTest(SimpleTestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.inputs = os.path.join(self.workdir.name, 'genomes')
+        os.makedirs(self.inputs)
+        self.paths = []
+        for name in ('a.fasta', 'b.fasta', 'c.fasta.gz'):
+            path = os.path.join(self.inputs, name)
+            with open(path, 'wb') as f:
+                f.write(FASTA)
+            self.paths.append(path)
+        self.output = os.path.join(self.workdir.name, 'batch')
+        self.processed = []
+
+    def process_genome(self, crash=()):
+        def process(path, options):
+            self.processed.append(path)
+            if path in crash:
+                raise BrokenProcessPool('A process in the process pool was terminated abruptly')
+            entry = {'path': path, 'stamp': file_stamp(path), 'status': 'done', 'seconds': 0.1,
+                     'mutation': {'snp_count': 3, 'reference': 'NC_003310.fasta'}}
+            append_line(options['journal'], entry)
+            return entry
+        return process
+
+    def run_batch(self, crash=(), **options):
+        command = 'frontend.management.commands.batch_genomes'
+        with mock.patch(f'{command}.ProcessPoolExecutor', ThreadPool), \
+                mock.patch(f'{command}.process_genome', self.process_genome(crash)):
+            stdout = StringIO()
+            call_command('batch_genomes', self.inputs, output=self.output, workers=2,
+                         uploads_dir=self.workdir.name, stdout=stdout, stderr=StringIO(), **options)
+        return stdout.getvalue()
+
+    def statuses(self):
+        journal = Journal(os.path.join(self.output, 'journal.jsonl'))
+        return {os.path.basename(path): entry['status'] for path, entry in journal.entries.items()}
+
+    def test_a_crashed_worker_fails_only_its_genome(self):
+        out = self.run_batch(crash={self.paths[1]})
+        self.assertIn('2 done, 1 failed', out)
+        self.assertEqual(self.statuses(), {'a.fasta': 'done', 'b.fasta': 'failed', 'c.fasta.gz': 'done'})
+        journal = Journal(os.path.join(self.output, 'journal.jsonl'))
+        self.assertIn('BrokenProcessPool', journal.entries[self.paths[1]]['error'])
+
+    def test_rerun_resumes_with_the_unfinished_genomes(self):
+        self.run_batch(crash={self.paths[1]})
+        self.processed.clear()
+        self.assertIn('3 genomes, 3 already processed, 0 to go', self.run_batch(skip_failed=True))
+        self.assertEqual(self.processed, [])
+        out = self.run_batch()
+        self.assertIn('3 genomes, 2 already processed, 1 to go', out)
+        self.assertEqual(self.processed, [self.paths[1]])
+        self.assertEqual(set(self.statuses().values()), {'done'})
+        ###a changed input is processed again
+        self.processed.clear()
+        with open(self.paths[0], 'ab') as f:
+            f.write(b'>contig3\nACGT\n')
+        self.run_batch()
+        self.assertEqual(self.processed, [self.paths[0]])
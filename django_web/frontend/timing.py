@@ -0,0 +1,63 @@
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+
+###per request list of (name, seconds); a list shared by reference, so timings recorded inside
+###async views (which run in a copied context) are still seen by the middleware
+_timings = ContextVar('server_timings', default=None)
+
+
+def record(name, seconds):
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+def server_timing_header(timings, total):
+    ###Server-Timing: mutation;dur=12.1;desc="2 calls", total;dur=15.0 (durations in ms)
+    grouped = {}
+    for name, seconds in timings:
+        calls, spent = grouped.get(name, (0, 0.0))
+        grouped[name] = (calls + 1, spent + seconds)
+    entries = [f'{name};dur={spent * 1000:.1f};desc="{calls} call{"s" if calls != 1 else ""}"'
+               for name, (calls, spent) in grouped.items()]
+    entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
+
+
+class ServerTimingMiddleware:
+    ###adds a Server-Timing header with the time spent in every backend service and in total,
+    ###browser devtools show it next to the request
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = []
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _timings.reset(token)
+        response['Server-Timing'] = server_timing_header(timings, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        timings = []
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _timings.reset(token)
+        response['Server-Timing'] = server_timing_header(timings, time.perf_counter() - started)
+        return response
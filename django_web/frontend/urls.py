@@ -6,6 +6,13 @@ urlpatterns = [
     path('upload/', views.upload_genome, name='upload_genome'),
     path('annotate_genome/<str:filename>', views.annotate_genome, name='annotate_genome'),
     path('mutation_analysis/<str:filename>', views.mutation_analysis, name='mutation_analysis'),
+    path('mutation_status/<str:job_id>', views.mutation_job_status, name='mutation_job_status'),
+    path('mutation_result/<str:job_id>', views.mutation_result, name='mutation_result'),
+    path('snps_page/<str:result_id>', views.snps_page, name='snps_page'),
+    path('pipeline/<str:filename>', views.pipeline, name='pipeline'),
+    path('pipeline_status/<str:pipeline_id>', views.pipeline_status, name='pipeline_status'),
+    path('pipeline_result/<str:pipeline_id>', views.pipeline_result, name='pipeline_result'),
     path('download_annotation/<str:job_id>', views.download_annotation, name='download_annotation'),
+    path('annotation_features/<str:job_id>', views.annotation_features, name='annotation_features'),
     path('download_snps/', views.download_snps, name='download_snps')
 ]
@@ -1,22 +1,83 @@
 from django.shortcuts import render
-from django.http import HttpResponse, FileResponse, HttpResponseNotFound
-from zipfile import ZipFile
+from django.http import HttpResponse, FileResponse, HttpResponseNotFound, JsonResponse, StreamingHttpResponse
 from . forms import GenomeForm
+from . ingest import ingest_fasta, FastaFormatError
+from . seqstats import aggregate
+from . zipstream import iter_zip_cached, archive_key
+from . services import get_client, ServiceUnavailable
+from django.core import signing
+import asyncio
 import requests
 import json
 import logging
 import os
-import uuid
-from Bio import SeqIO
-from io import StringIO, BytesIO
 import csv
+import re
+from itertools import chain
 
 logger = logging.getLogger(__name__)
 
+MUTATION_POLL_WAIT = 20
+PIPELINE_SALT = 'frontend.pipeline'
+ANNOTATION_ARCHIVES_DIR = '/app/uploads/annotation_archives'
+ANNOTATION_ZIP_COMPRESSION = 6
+SNP_FIELDS = ('pos_ref', 'ref_base', 'pos_query', 'query_base', 'ref_name', 'query_name')
+CONSEQUENCE_FIELDS = ('gene', 'aa_change', 'effect')
+###labels of the known references in the upload page (the list itself comes from the mutation service's
+###registry), the closest one by sketch distance is preselected
+REFERENCE_LABELS = {'NC_003310': 'Clade I', 'NC_063383': 'Clade II'}
+CLASSIFY_TIMEOUT = (3, 10)
+###query parameters of the annotation service's feature table that are passed through
+FEATURE_PARAMS = ('seq_id', 'start', 'end', 'locus_tag', 'gene', 'product', 'type', 'q', 'offset', 'limit')
+###query parameters of the mutation service's snp pages that are passed through (always annotated)
+SNP_PAGE_PARAMS = ('ref_name', 'start', 'end', 'ref_base', 'query_base', 'sort', 'offset', 'limit')
+RESULT_ID = re.compile(r'[0-9a-f]{64}')
+JOB_ID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
 # Create your views here.
 def home(request):
     return render(request, 'frontend/home.html')
 
+
+def registered_references():
+    ###names and descriptions of the mutation service's reference registry; the known labels when it is down
+    try:
+        response = get_client('mutation').get('/references', timeout=CLASSIFY_TIMEOUT)
+        if response.status_code == 200:
+            return {entry['name']: entry.get('description') or '' for entry in response.json()}
+        logger.warning(f'Reference list failed with status {response.status_code}: {response.text}')
+    except (requests.RequestException, ServiceUnavailable, ValueError, KeyError) as e:
+        logger.warning(f'Reference list failed: {e}')
+    return dict(REFERENCE_LABELS)
+
+
+def reference_label(name, description):
+    label = REFERENCE_LABELS.get(name) or description
+    return f'{name} ({label})' if label else name
+
+
+def reference_options(filename):
+    ###select options, closest reference first; the registered ones in order when the mutation service can't rank them
+    try:
+        response = get_client('mutation').post('/classify', json={'filename': filename}, timeout=CLASSIFY_TIMEOUT)
+        ranking = response.json()['references'] if response.status_code == 200 else []
+    except (requests.RequestException, ServiceUnavailable, ValueError, KeyError) as e:
+        logger.warning(f'Reference classification failed: {e}')
+        ranking = []
+    references = registered_references()
+    options = []
+    for entry in ranking:
+        name = entry['reference']
+        options.append({'value': name,
+                        'label': f"{reference_label(name, references.get(name))} - {entry['identity'] * 100:.2f}% identity, "
+                                 f"{entry['shared_hashes']}/{entry['sketch_size']} shared k-mers",
+                        'selected': not options and entry['shared_hashes'] > 0})
+    ranked = {option['value'] for option in options}
+    options += [{'value': name, 'label': reference_label(name, description), 'selected': False}
+                for name, description in references.items() if name not in ranked]
+    return options
+
+
 def upload_genome(request):
     if request.method == 'POST':
         form = GenomeForm(request.POST, request.FILES)
@@ -24,53 +85,57 @@ def upload_genome(request):
             collected_data = form.cleaned_data
             uploaded_file = collected_data.get('uploaded_file')
 
-
-            length = 0
-            header = ''
+            ###the upload is streamed chunk by chunk: validated, counted and written to /app/uploads in one pass
             if uploaded_file:
+                chunks = uploaded_file.chunks()
+            else:
+                chunks = [collected_data.get('genome_text').encode('utf-8')]
 
-                ###the file only exists in memory
-                uploaded_file_data = uploaded_file.read().decode('utf-8')
-                uploaded_file_io = StringIO(uploaded_file_data)
-
-                ###basic statistics on the uploaded genome
-                for record in SeqIO.parse(uploaded_file_io, 'fasta'):
-                    length = len(record.seq)
-                    header = record.id
-                    a_proportion = (record.seq.count('A')/length)*100
-                    t_proportion = (record.seq.count('T')/length)*100
-                    c_proportion = (record.seq.count('C')/length)*100
-                    g_proportion = (record.seq.count('G')/length)*100
-                    n_proportion = (record.seq.count('N')/length)*100
-
-                ###now i need to write the file persistently to disk
-                job_id = str(uuid.uuid4())
-                filename = f"{job_id}.fasta"
-                file_path = os.path.join('/app/uploads', filename)
-
-                ###the file is now uploaded into /app/uploads, which is a pointer to /Users/gustavosganzerla/Documents/mpox_outbreak/genomics_net/annotation_service_api/uploads
-                with open(file_path, 'w') as out_file:
-                    out_file.write(uploaded_file_data)
-
-                    
+            try:
+                filename, records = ingest_fasta(chunks)
+            except FastaFormatError as e:
+                form.add_error(None, str(e))
+                return render(request, 'frontend/upload.html', {'form': form})
 
-                
+            total = aggregate(records)
+            header = records[0].id if len(records) == 1 else f'{records[0].id} (+{len(records) - 1} more records)'
 
-           
             return render(request, 'frontend/result_upload.html', {'header':header,
-                                                            'length':length,
-                                                            'a_proportion':f"{a_proportion:.2f}",
-                                                            't_proportion':f"{t_proportion:.2f}",
-                                                            'c_proportion':f"{c_proportion:.2f}",
-                                                            'g_proportion':f"{g_proportion:.2f}",
-                                                            'n_proportion':f"{n_proportion:.2f}",
+                                                            'length':total.length,
+                                                            'a_proportion':f"{total.proportion('A'):.2f}",
+                                                            't_proportion':f"{total.proportion('T'):.2f}",
+                                                            'c_proportion':f"{total.proportion('C'):.2f}",
+                                                            'g_proportion':f"{total.proportion('G'):.2f}",
+                                                            'n_proportion':f"{total.proportion('N'):.2f}",
+                                                            'gc_content':f"{total.gc_content:.2f}",
+                                                            'ambiguity':total.ambiguity,
+                                                            'records':[record.to_dict(profile=len(records) == 1) for record in records],
+                                                            'reference_options':reference_options(filename),
                                                             'filename':filename})
     else:
         form = GenomeForm()
     return render(request, 'frontend/upload.html', {'form': form})
 
 
-def annotate_genome(request, filename):
+def annotation_files(job_id):
+    uploads_dir = '/app/uploads'
+    job_folder = f"output_{job_id}"
+
+    full_path = os.path.join(uploads_dir, job_folder)
+
+    ###dotfiles are the service's own (the feature index), not prokka outputs
+    return sorted(name for name in os.listdir(full_path) if not name.startswith('.'))
+
+
+def busy_response(prefix, response):
+    ###a service turned the job away because its queue is full, pass the 429 and Retry-After on
+    busy = HttpResponse(f'{prefix}: the service is busy, please retry later', status=429)
+    if response.headers.get('Retry-After'):
+        busy['Retry-After'] = response.headers['Retry-After']
+    return busy
+
+
+async def annotate_genome(request, filename):
     
     selected_reference = request.GET.get('reference')
 
@@ -78,49 +143,230 @@ def annotate_genome(request, filename):
                'reference':f'{selected_reference}.faa'}
     
     try:
-        response = requests.post('http://annotation_service_api:5000/annotate',
-                                json=payload)
+        response = await get_client('annotation').apost('/annotate', json=payload)
+        if response.status_code == 429:
+            return busy_response('Annotation failed', response)
         response.raise_for_status()
         result = response.json()
         
         ###now I should've got a response back from the api
         job_id = result.get('job_id')
-        uploads_dir = '/app/uploads'
-        job_folder = f"output_{job_id}"
-
-        full_path = os.path.join(uploads_dir, job_folder)
+        files = annotation_files(job_id)
 
-        files = os.listdir(full_path)
-        
 
-    except requests.RequestException as e:
+    except (requests.RequestException, ServiceUnavailable) as e:
         logger.error(f'Annotation service error: {e}')
-        return HttpResponse(e)
+        return HttpResponse(e, status=503 if isinstance(e, ServiceUnavailable) else 502)
     
     return render(request, 'frontend/annotation_results.html', {'files':files,
                                                                 'job_id':job_id,
                                                                 'selected_reference':selected_reference})
 
-def mutation_analysis(request, filename):
+async def mutation_analysis(request, filename):
     selected_reference = request.GET.get('reference')
     payload = {'filename': filename,
                'reference':f'{selected_reference}.fasta'}
-    
 
-    response = requests.post('http://mutational_service_api:5000/mutate', json=payload)
+    ###the service only queues the job, the page below polls for it
+    try:
+        response = await get_client('mutation').apost('/mutate/jobs', json=payload)
+    except (requests.RequestException, ServiceUnavailable) as e:
+        logger.error(f'Mutational service error: {e}')
+        return HttpResponse(f'Mutation analysis failed: {e}', status=503 if isinstance(e, ServiceUnavailable) else 502)
+
+    if response.status_code == 429:
+        return busy_response('Mutation analysis failed', response)
+    if response.status_code != 202:
+        logger.error(f'Mutational service failed with status {response.status_code}: {response.text}')
+        return HttpResponse(f'Mutation analysis failed: {response.text}', status=500)
+
+    job = response.json()
+    return render(request, 'frontend/mutational_analysis_status.html', {'job': job,
+                                                                        'reference':selected_reference})
+
+
+async def mutation_job_status(request, job_id):
+    ###long-poll proxy, the browser passes back the last version it saw;
+    ###the wait runs on one of the mutation client's threads; under WSGI the request thread blocks
+    ###on it as well, only an ASGI server frees it for other requests meanwhile
+    params = {'wait': MUTATION_POLL_WAIT}
+    if request.GET.get('since'):
+        params['since'] = request.GET.get('since')
+    try:
+        response = await get_client('mutation').aget(f'/mutate/jobs/{job_id}', params=params,
+                                                      timeout=MUTATION_POLL_WAIT + 10)
+        ###a proxy error page or a worker timeout comes back as html
+        job = response.json()
+    except (requests.RequestException, ServiceUnavailable, ValueError) as e:
+        logger.error(f'Mutational service error: {e}')
+        return JsonResponse({'status': 'unknown', 'error': str(e)}, status=502)
+    return JsonResponse(job, status=response.status_code)
+
+
+async def pipeline(request, filename):
+    ###one submission fans out to both services at once; each service queues its own job
+    ###and the pair is tracked under a signed pipeline id, so no state is kept here
+    selected_reference = request.GET.get('reference')
+    try:
+        mutation, annotation = await asyncio.gather(
+            get_client('mutation').apost('/mutate/jobs', json={'filename': filename,
+                                                               'reference': f'{selected_reference}.fasta'}),
+            get_client('annotation').apost('/annotate/jobs', json={'filename': filename,
+                                                                   'reference': f'{selected_reference}.faa'}),
+        )
+    except (requests.RequestException, ServiceUnavailable) as e:
+        logger.error(f'Pipeline submission failed: {e}')
+        return HttpResponse(f'Pipeline failed: {e}', status=503 if isinstance(e, ServiceUnavailable) else 502)
+
+    for name, response in (('Mutational', mutation), ('Annotation', annotation)):
+        if response.status_code == 429:
+            ###the other service may have accepted its half, that job just runs to completion unpolled
+            return busy_response('Pipeline failed', response)
+        if response.status_code != 202:
+            logger.error(f'{name} service failed with status {response.status_code}: {response.text}')
+            return HttpResponse(f'Pipeline failed: {response.text}', status=500)
+
+    jobs = {'mutation': mutation.json(), 'annotation': annotation.json()}
+    pipeline_id = signing.dumps({'filename': filename,
+                                 'reference': selected_reference,
+                                 'mutation': jobs['mutation']['job_id'],
+                                 'annotation': jobs['annotation']['job_id']}, salt=PIPELINE_SALT)
+    return render(request, 'frontend/pipeline_status.html', {'pipeline_id': pipeline_id,
+                                                             'jobs': jobs,
+                                                             'filename': filename,
+                                                             'reference': selected_reference})
+
+
+def load_pipeline(pipeline_id):
+    try:
+        return signing.loads(pipeline_id, salt=PIPELINE_SALT)
+    except signing.BadSignature:
+        return None
+
+
+async def pipeline_status(request, pipeline_id):
+    ###long-poll over both jobs: the browser passes ?mutation=<version>&annotation=<version> for the
+    ###jobs it still waits on, the first one that changes answers the poll and the other wait is dropped
+    pipeline = load_pipeline(pipeline_id)
+    if pipeline is None:
+        return JsonResponse({'status': 'unknown', 'error': 'Unknown pipeline'}, status=404)
+
+    paths = {'mutation': f"/mutate/jobs/{pipeline['mutation']}",
+             'annotation': f"/annotate/jobs/{pipeline['annotation']}"}
+    polls = {}
+    for name, path in paths.items():
+        since = request.GET.get(name)
+        if since is None:
+            continue
+        params = {'wait': MUTATION_POLL_WAIT, 'since': since}
+        polls[asyncio.ensure_future(get_client(name).aget(path, params=params, timeout=MUTATION_POLL_WAIT + 10))] = name
+    if not polls:
+        return JsonResponse({})
+
+    done, pending = await asyncio.wait(polls, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+
+    jobs = {}
+    for task in done:
+        name = polls[task]
+        try:
+            response = task.result()
+            if response.status_code != 200:
+                return JsonResponse({'status': 'unknown', 'error': response.text}, status=502)
+            jobs[name] = response.json()
+        except (requests.RequestException, ServiceUnavailable, ValueError) as e:
+            logger.error(f'{name} service error: {e}')
+            return JsonResponse({'status': 'unknown', 'error': str(e)}, status=502)
+    return JsonResponse(jobs)
+
+
+def pipeline_result(request, pipeline_id):
+    ###both jobs are done: the snp summary and the annotation files on one page
+    pipeline = load_pipeline(pipeline_id)
+    if pipeline is None:
+        return HttpResponseNotFound('Pipeline not found')
+
+    try:
+        response = get_client('mutation').get(f"/mutate/jobs/{pipeline['mutation']}/result")
+    except (requests.RequestException, ServiceUnavailable) as e:
+        logger.error(f'Mutational service error: {e}')
+        return HttpResponse(f'Mutation analysis failed: {e}', status=503 if isinstance(e, ServiceUnavailable) else 502)
+    if response.status_code != 200:
+        logger.error(f'Mutational service failed with status {response.status_code}: {response.text}')
+        return HttpResponse(f'Mutation analysis failed: {response.text}', status=500)
+    mutation = response.json()
+
+    try:
+        files = annotation_files(pipeline['annotation'])
+    except FileNotFoundError:
+        return HttpResponseNotFound('Annotation job not found')
+
+    return render(request, 'frontend/pipeline_result.html', {'filename': pipeline['filename'],
+                                                             'reference': pipeline['reference'],
+                                                             'mutation_job_id': pipeline['mutation'],
+                                                             'result_id': mutation['result_id'],
+                                                             'snp_count': mutation.get('snp_count'),
+                                                             'cached': mutation.get('cached'),
+                                                             'job_id': pipeline['annotation'],
+                                                             'files': files})
+
+
+def iter_remote_snps(result_id, annotate=True):
+    ###consumes the ndjson stream from the mutation service one snp at a time,
+    ###annotated with the gene / amino acid consequence by the service
+    params = {'annotate': 1} if annotate else None
+    for line in get_client('mutation').iter_lines(f'/mutate/results/{result_id}/snps', params=params):
+        yield json.loads(line)
+
+
+def mutation_result(request, job_id):
+    selected_reference = request.GET.get('reference')
+    try:
+        response = get_client('mutation').get(f'/mutate/jobs/{job_id}/result')
+    except (requests.RequestException, ServiceUnavailable) as e:
+        logger.error(f'Mutational service error: {e}')
+        return HttpResponse(f'Mutation analysis failed: {e}', status=503 if isinstance(e, ServiceUnavailable) else 502)
 
     if response.status_code != 200:
         logger.error(f'Mutational service failed with status {response.status_code}: {response.text}')
         return HttpResponse(f'Mutation analysis failed: {response.text}', status=500)
 
+    ###the rows are not rendered here, the table fetches the pages it shows from snps_page
     result = response.json()
-    snps_list = result.get('snps')
-    snps_file = result.get('snps_file') 
-    return render(request, 'frontend/mutational_analysis_result.html', {'snps_list': snps_list,
+    return render(request, 'frontend/mutational_analysis_result.html', {'snp_count': result.get('snp_count'),
                                                                         'reference':selected_reference,
-                                                                        'snps_file':snps_file})
+                                                                        'result_id':result['result_id']})
 
 
+def snps_page(request, result_id):
+    ###json passthrough of one filtered / sorted page of annotated snps, for the results table and scripts
+    if not RESULT_ID.fullmatch(result_id):
+        return JsonResponse({'error': 'Unknown result'}, status=404)
+    params = {name: request.GET[name] for name in SNP_PAGE_PARAMS if request.GET.get(name)}
+    try:
+        response = get_client('mutation').get(f'/mutate/results/{result_id}/snps/page', params=dict(params, annotate=1))
+        page = response.json()
+    except (requests.RequestException, ServiceUnavailable, ValueError) as e:
+        logger.error(f'Mutational service error: {e}')
+        return JsonResponse({'error': str(e)}, status=503 if isinstance(e, ServiceUnavailable) else 502)
+    if response.status_code != 200:
+        return JsonResponse({'error': page.get('stderr') or page.get('message')}, status=response.status_code)
+    return JsonResponse(page)
+
+
+def annotation_features(request, job_id):
+    ###json passthrough of the annotation service's indexed feature table, for the results page and scripts
+    if not JOB_ID.fullmatch(job_id):
+        return JsonResponse({'error': 'Unknown annotation'}, status=404)
+    params = {name: request.GET[name] for name in FEATURE_PARAMS if request.GET.get(name)}
+    try:
+        response = get_client('annotation').get(f'/annotate/results/{job_id}/features', params=params)
+        return JsonResponse(response.json(), status=response.status_code)
+    except (requests.RequestException, ServiceUnavailable, ValueError) as e:
+        logger.error(f'Annotation service error: {e}')
+        return JsonResponse({'error': str(e)}, status=503 if isinstance(e, ServiceUnavailable) else 502)
+
 
 def download_annotation(request, job_id):
     ###a post is comming from the template
@@ -130,69 +376,80 @@ def download_annotation(request, job_id):
             return HttpResponse('No files selected')
         
         uploads_dir = '/app/uploads'
-        job_folder = f'output_{job_id}'
+        job_folder = f'output_{os.path.basename(job_id)}'
 
         full_path = os.path.join(uploads_dir, job_folder)
+        if not os.path.isdir(full_path):
+            return HttpResponseNotFound('Annotation job not found')
+        ###a download counts as a use for the uploads sweeper's lru
+        os.utime(full_path)
+
+        ###only plain names of files that really are in the output folder
+        available = set(annotation_files(os.path.basename(job_id)))
+        selected_files = [name for name in selected_files if name in available and os.path.isfile(os.path.join(full_path, name))]
+        if not selected_files:
+            return HttpResponseNotFound('File not found')
 
         ###if it's one file only, download directly
         if len(selected_files)==1:
             file_path = os.path.join(full_path, selected_files[0])
-            if os.path.exists(file_path):
-                return FileResponse(open(file_path, 'rb'), as_attachment=True)
-            else:
-                return HttpResponseNotFound('File not found')
+            return FileResponse(open(file_path, 'rb'), as_attachment=True)
             
-        ###for multiple files, I have to zip them
+        ###for multiple files, the zip is streamed while it is built and kept for the next download
         else:
-            zip_buffer = BytesIO()
+            compresslevel = request.POST.get('compression', ANNOTATION_ZIP_COMPRESSION)
+            try:
+                compresslevel = min(max(int(compresslevel), 0), 9)
+            except ValueError:
+                compresslevel = ANNOTATION_ZIP_COMPRESSION
 
-            with ZipFile(zip_buffer, 'w') as zip_file:
-                for filename in selected_files:
-                    file_path = os.path.join(full_path, filename)
-                    if os.path.exists(file_path):
-                        zip_file.write(file_path, arcname=filename)
-            
-            zip_buffer.seek(0)
-            response = HttpResponse(zip_buffer, content_type='application/zip')
+            files = [(filename, os.path.join(full_path, filename)) for filename in selected_files]
+            archive_path = os.path.join(ANNOTATION_ARCHIVES_DIR, f'{job_folder}-{archive_key(files, compresslevel)}.zip')
+
+            if os.path.exists(archive_path):
+                ###built before: FileResponse lets the server use sendfile
+                return FileResponse(open(archive_path, 'rb'), as_attachment=True,
+                                    filename='annotation_files.zip', content_type='application/zip')
+
+            response = StreamingHttpResponse(iter_zip_cached(files, archive_path, compresslevel),
+                                             content_type='application/zip')
             response['Content-Disposition'] = 'attachment; filename="annotation_files.zip"'
             return response
 
 
+class Echo:
+    ###csv.writer needs something with write(); this one just hands the row back
+    def write(self, value):
+        return value
+
+
 def download_snps(request):
     ###a POST is coming from the template
     if request.method=='POST':
-        snps_file = request.POST.get('snps_file')
-        ###the django has access to the folder in which the snps file is at
-        if os.path.exists(snps_file):
-            try:
-                with open(snps_file, 'r') as infile:
-                    response = HttpResponse(content_type='text/csv')
-                    response['Content-Disposition'] = 'attachment; filename="snps_results.csv"'
-
-                    writer = csv.writer(response)
-                    # Write header row
-                    writer.writerow(['pos_ref', 'ref_base', 'pos_query', 'query_base', 'ref_name', 'query_name'])
-
-                    for line in infile:
-                        line = line.strip()
-                        if not line or line.startswith(('=', '/', 'NUCMER', '[')):
-                            continue
-
-                        fields = line.split()
-                        if len(fields) >= 8:
-                            writer.writerow([
-                                fields[0],  # pos_ref
-                                fields[1],  # ref_base
-                                fields[2],  # pos_query
-                                fields[3],  # query_base
-                                fields[-2],
-                                fields[-1]
-                            ])
-
-                    return response
-
-            except FileNotFoundError:
-                return HttpResponse("SNPs file not found.", status=404)
+        result_id = request.POST.get('result_id', '')
+        if not RESULT_ID.fullmatch(result_id):
+            return HttpResponse("SNPs result not found.", status=404)
+
+        ###open the stream before answering, so an unknown result is still a 404
+        snps = iter_remote_snps(result_id)
+        try:
+            first = next(snps, None)
+        except (requests.RequestException, ServiceUnavailable):
+            return HttpResponse("SNPs result not found.", status=404)
+        if first is not None:
+            snps = chain([first], snps)
+
+        writer = csv.writer(Echo())
+
+        def rows():
+            # Write header row
+            yield writer.writerow(SNP_FIELDS + CONSEQUENCE_FIELDS)
+            for snp in snps:
+                yield writer.writerow([snp[field] for field in SNP_FIELDS] +
+                                      [snp.get(field) or '' for field in CONSEQUENCE_FIELDS])
+
+        response = StreamingHttpResponse(rows(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="snps_results.csv"'
+        return response
 
     return HttpResponse("Invalid request method.", status=405)
-        
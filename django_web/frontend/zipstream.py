@@ -0,0 +1,77 @@
+import hashlib
+import os
+import tempfile
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+
+CHUNK_SIZE = 64 * 1024
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+class _Sink:
+    ###write-only target for ZipFile; without tell()/seek() zipfile switches to streaming mode
+    ###(data descriptors after each member) and we hand out whatever was written so far
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(files, compresslevel=6):
+    ###files is a list of (arcname, path); yields the archive piece by piece, never the whole thing
+    sink = _Sink()
+    compression = ZIP_STORED if compresslevel == 0 else ZIP_DEFLATED
+    with ZipFile(sink, 'w', compression=compression,
+                 compresslevel=compresslevel if compression == ZIP_DEFLATED else None) as zip_file:
+        for arcname, path in files:
+            with open(path, 'rb') as src, \
+                    zip_file.open(arcname, 'w', force_zip64=os.path.getsize(path) > ZIP64_LIMIT) as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    data = sink.drain()
+                    if data:
+                        yield data
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def archive_key(files, compresslevel):
+    ###same selection + same file versions + same level -> same archive
+    sha = hashlib.sha256(str(compresslevel).encode())
+    for arcname, path in sorted(files):
+        stat = os.stat(path)
+        sha.update(f'{arcname}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return sha.hexdigest()[:32]
+
+
+def iter_zip_cached(files, archive_path, compresslevel=6):
+    ###streams the archive to the client and tees it into archive_path; the file only gets its
+    ###final name when the whole archive was produced (an aborted download leaves nothing behind)
+    directory = os.path.dirname(archive_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, partial_path = tempfile.mkstemp(prefix='.', suffix='.part', dir=directory)
+    completed = False
+    try:
+        with os.fdopen(fd, 'wb') as partial:
+            for data in iter_zip(files, compresslevel):
+                partial.write(data)
+                yield data
+        os.replace(partial_path, archive_path)
+        completed = True
+    finally:
+        if not completed and os.path.exists(partial_path):
+            os.remove(partial_path)
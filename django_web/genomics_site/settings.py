@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'frontend.timing.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -118,6 +119,25 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Backend services used by the frontend (see frontend/services.py).
+# Timeouts are in seconds; retries are bounded and the circuit opens after
+# failure_threshold consecutive failures for reset_timeout seconds.
+BACKEND_SERVICES = {
+    'mutation': {
+        'base_url': os.getenv('MUTATION_SERVICE_URL', 'http://mutational_service_api:5000'),
+        'connect_timeout': 3,
+        'read_timeout': 60,
+        'retries': 2,
+    },
+    'annotation': {
+        'base_url': os.getenv('ANNOTATION_SERVICE_URL', 'http://annotation_service_api:5000'),
+        'connect_timeout': 3,
+        # a prokka run can take many minutes
+        'read_timeout': 1800,
+        'retries': 1,
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
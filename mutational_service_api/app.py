@@ -1,116 +1,667 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from decouple import config
-import subprocess
+import json
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import uuid
+from contextlib import nullcontext
 
+from cache import ResultCache, result_key
+from cohort import CohortStore, COHORT_NAME
+from compressed import FifoFeed, decompress_to, is_gzip
+from fastcall import Fallback, call_snps as fast_call_snps
+from features import annotate_snps, load_feature_index, store_substitutions
+from governor import Governor, QueueFull, cpu_slots
+from jobs import JobQueue
+from lifecycle import UploadsJanitor, pick_scratch_dir, pin, purge_scratch, unpin
+from metrics import record_job, record_sweep, update_queue, watch_governor
+from pipeline import run_nucmer, call_snps_piped, call_snps_files, snp_dict, alignment_summary, delta_alignment
+from registry import ReferenceRegistry
+from sketch import SketchIndex
+from snpstore import open_store, write_snp_store
 
-def parse_snps_file(show_snps_file):
-    snps = []
-    with open(show_snps_file, 'r') as f:
-        for line in f:
-            stripped = line.strip()
-            if not stripped or stripped.startswith('=') or stripped.startswith('/') or stripped.startswith('NUCMER') or stripped.startswith('['):
-                continue  #skip headers, comments, and empty lines
-            fields = stripped.split()
-            if len(fields) >= 8:
-                snp = {
-                    'pos_ref': fields[0],
-                    'ref_base': fields[1],
-                    'pos_query': fields[2],
-                    'query_base': fields[3],
-                    'ref_name': fields[-2],
-                    'query_name': fields[-1]
-                }
-                snps.append(snp)
-    return snps
 
 app = Flask(__name__)
 
-@app.route('/mutate', methods=['POST'])
-def mutate():
-    HOST_UPLOADS_DIR = os.getenv('HOST_UPLOADS_DIR', '/app/uploads')
-    HOST_REFERENCES_DIR = os.getenv('HOST_REFERENCES_DIR', '/data/references')
+###admission control: MUTATION_SLOTS_PER_CPU x cpus threads are shared by the running jobs, each job
+###gets up to MUTATION_JOB_THREADS of them; at most MUTATION_MAX_QUEUE jobs wait, more are rejected with 429
+SLOTS = cpu_slots(config('MUTATION_SLOTS_PER_CPU', default=1.0, cast=float))
+JOB_THREADS = config('MUTATION_JOB_THREADS', default=max(1, SLOTS // 2), cast=int)
+MAX_QUEUE = config('MUTATION_MAX_QUEUE', default=32, cast=int)
+MUTATION_WORKERS = config('MUTATION_WORKERS', default=max(1, SLOTS // JOB_THREADS), cast=int)
+JOB_KEEP_SECONDS = config('MUTATION_JOB_KEEP_SECONDS', default=3600, cast=int)
+MAX_POLL_WAIT = 30
+MAX_PAGE_SIZE = 1000
+###snps are annotated in batches of this many rows while streaming
+ANNOTATE_BATCH = 1000
+CACHE_DIR = config('MUTATION_CACHE_DIR', default='/app/uploads/mutation_cache')
+CACHE_MAX_BYTES = config('MUTATION_CACHE_MAX_BYTES', default=2 * 1024 ** 3, cast=int)
+###'pipe' streams delta-filter into show-snps, 'files' is the old file-to-file chain
+EXEC_MODE = config('MUTATION_EXEC_MODE', default='pipe')
+###intermediate mummer files; MUTATION_SCRATCH_DIR may be a small tmpfs, jobs fall back to
+###MUTATION_SCRATCH_FALLBACK_DIR when less than MUTATION_SCRATCH_MIN_FREE bytes are left on it
+SCRATCH_DIR = config('MUTATION_SCRATCH_DIR', default=tempfile.gettempdir())
+SCRATCH_FALLBACK_DIR = config('MUTATION_SCRATCH_FALLBACK_DIR', default=tempfile.gettempdir())
+SCRATCH_MIN_FREE = config('MUTATION_SCRATCH_MIN_FREE', default=256 * 1024 ** 2, cast=int)
+###gzip / bgzf uploads: 'pipe' decompresses into a named pipe for every tool that reads the query,
+###'file' writes one decompressed copy to the scratch directory (for tools that need to seek)
+GZIP_INPUT = config('MUTATION_GZIP_INPUT', default='pipe')
+COHORT_DIR = config('MUTATION_COHORT_DIR', default='/app/uploads/mutation_cohorts')
+###garbage collection of the shared uploads volume, this service sweeps it for all of them;
+###UPLOADS_GC_INTERVAL=0 turns the sweeper off
+UPLOADS_DIR = '/app/uploads'
+REFERENCES_DIR = '/data/references'
+###minhash sketches of the references, rebuilt only for references that changed since the last start
+SKETCH_CACHE = config('MUTATION_SKETCH_CACHE', default='/app/uploads/mutation_sketches.npz')
+UPLOADS_MAX_BYTES = config('UPLOADS_MAX_BYTES', default=20 * 1024 ** 3, cast=int)
+UPLOADS_TTL_SECONDS = config('UPLOADS_TTL_SECONDS', default=7 * 24 * 3600, cast=int)
+UPLOADS_GC_INTERVAL = config('UPLOADS_GC_INTERVAL', default=600, cast=int)
+###near-identical genomes are called in-process (fastcall.py), anything else still goes through mummer;
+###jobs asking for the raw mummer artifacts always run mummer
+FASTPATH = config('MUTATION_FASTPATH', default=True, cast=bool)
 
+###reference registry: checksums, metadata and the nucmer suffix array of every reference are kept in
+###MUTATION_REFERENCE_INDEX_DIR (per checksum), the in-memory indexes of MUTATION_HOT_REFERENCES stay loaded
+REFERENCE_INDEX_DIR = config('MUTATION_REFERENCE_INDEX_DIR', default='/app/uploads/reference_indexes')
+HOT_REFERENCES = config('MUTATION_HOT_REFERENCES', default=4, cast=int)
+NUCMER_INDEX = config('MUTATION_NUCMER_INDEX', default=True, cast=bool)
+###the references folder is scanned again every MUTATION_REFERENCE_RESCAN seconds, 0 scans only at startup
+REFERENCE_RESCAN = config('MUTATION_REFERENCE_RESCAN', default=300, cast=int)
 
-    job_id = str(uuid.uuid4())
-    
-    data = request.get_json()
-    filename = data.get('filename')
-    reference_file = data.get('reference')
+###extra arguments for each mummer tool, they are part of the cache key
+MUMMER_PARAMS = {
+    'nucmer': [],
+    'delta-filter': ['-1'],
+    'show-snps': ['-Clr'],
+}
+
+result_cache = ResultCache(CACHE_DIR, CACHE_MAX_BYTES)
+cohorts = CohortStore(COHORT_DIR)
+sketch_index = SketchIndex(REFERENCES_DIR, SKETCH_CACHE)
+try:
+    sketch_index.refresh()
+except OSError as e:
+    print(f'Could not sketch the references: {e}', flush=True)
+reference_registry = ReferenceRegistry(REFERENCES_DIR, REFERENCE_INDEX_DIR, hot=HOT_REFERENCES,
+                                       nucmer_index=NUCMER_INDEX)
+try:
+    ###indexes are built and the hot references loaded in the background, jobs do not wait for it
+    os.makedirs(REFERENCE_INDEX_DIR, exist_ok=True)
+    if REFERENCE_RESCAN > 0:
+        reference_registry.start(REFERENCE_RESCAN)
+    else:
+        reference_registry.prepare()
+except OSError as e:
+    print(f'Could not register the references: {e}', flush=True)
+
+
+def add_to_cohort(params, result_id):
+    ###every finished result joins a cohort (by default the one of its reference); results are
+    ###content addressed, so re-running the same genome does not add a second sample
+    cohort = cohorts.get(params.get('cohort') or os.path.splitext(params['reference'])[0], create=True)
+    if cohort is None or result_id in cohort:
+        return
+    try:
+        store = open_store(result_cache.entry_path(result_id, 'snps.col'))
+        cohort.add_samples([(result_id, params['filename'], store.rows(0, store.count_all))])
+    except Exception as e:
+        ###the analysis itself succeeded, a cohort problem must not fail the job
+        print(f'Could not add {result_id} to its cohort: {e}', flush=True)
+
+
+def run_fastpath(job, reference_path, file_path, store_path):
+    ###returns (snp count, alignment summary), or (None, None) when the genome has to go through mummer
+    ###(the reason is kept on the stage)
+    with job.stage('fastpath') as info:
+        try:
+            records, alignment = fast_call_snps(reference_path, file_path)
+        except Fallback as e:
+            info['fallback'] = str(e)
+            return None, None
+        ###every snp / indel base is one error over the aligned part, as in the nucmer delta
+        return write_snp_store(iter(records), store_path), alignment_summary(
+            alignment['query_bases'], alignment['aligned_bases'], alignment['differences'], alignment['aligned_bases'])
+
+
+def run_mutation(job):
+    ###in-process fast path, or nucmer -> delta-filter -> show-snps for one job, stage by stage
+    filename = job.params['filename']
+    reference_file = job.params['reference']
+    keep_artifacts = job.params.get('artifacts', False)
+    cache_key = job.params['cache_key']
 
     ###input file
     file_path = os.path.join('/app/uploads', filename)
-    
-    ###create a directory for storing the output files
-    outdir = f'/app/uploads/mutation_{job_id}'
-    os.makedirs(outdir, exist_ok=True)
 
     ###reference file path
     reference_path = os.path.join('/data/references', reference_file)
+    reference_registry.use(reference_file)
+
+    ###intermediate files live in a local scratch directory, not on the shared uploads volume
+    workdir = tempfile.mkdtemp(prefix=f'mutation_{job.id}_',
+                               dir=pick_scratch_dir(SCRATCH_DIR, SCRATCH_FALLBACK_DIR, SCRATCH_MIN_FREE))
+    try:
+        store_path = os.path.join(workdir, 'snps.col')
+        artifacts = {'snps.col': store_path}
+        snp_count, alignment, nucmer_stderr = None, None, ''
+        if FASTPATH and not keep_artifacts:
+            ###reads the (possibly gzipped) upload itself, no pipe needed
+            snp_count, alignment = run_fastpath(job, reference_path, file_path, store_path)
+        else:
+            job.skip_stage('fastpath')
+
+        engine = 'mummer' if snp_count is None else 'fastpath'
+        if engine == 'fastpath':
+            for name in ('nucmer', 'delta-filter', 'show-snps'):
+                job.skip_stage(name)
+        else:
+            compressed = is_gzip(file_path)
+            if compressed and GZIP_INPUT == 'file':
+                file_path, compressed = decompress_to(file_path, os.path.join(workdir, 'query.fasta')), False
+
+            def query_input():
+                ###nucmer and show-snps both read the query, under the same name (show-snps takes it from the delta)
+                return FifoFeed(file_path, os.path.join(workdir, 'query.fasta')) if compressed else nullcontext(file_path)
+
+            with query_input() as query_path:
+                delta_file, nucmer_stderr = run_nucmer(job, MUMMER_PARAMS, reference_path, query_path, workdir,
+                                                       index_prefix=reference_registry.nucmer_prefix(reference_file))
+            alignment = delta_alignment(delta_file, file_path)
+            with query_input():
+                if EXEC_MODE == 'files':
+                    snp_count, show_snps_file = call_snps_files(job, MUMMER_PARAMS, delta_file, workdir, store_path)
+                else:
+                    show_snps_file = os.path.join(workdir, 'mutation.snps') if keep_artifacts else None
+                    snp_count = call_snps_piped(job, MUMMER_PARAMS, delta_file, workdir, store_path,
+                                                snps_copy=show_snps_file)
+            if keep_artifacts:
+                artifacts.update({'mutation.snps': show_snps_file, 'mutation.delta': delta_file})
+
+        ###the snps themselves stay in the columnar snps.col, result.json is only the summary
+        mutation_result = {
+            'result_id': cache_key,
+            'reference': reference_file,
+            'snp_count': snp_count,
+            'message': 'success',
+            'stderr': nucmer_stderr,
+            'snps_file': result_cache.entry_path(cache_key, 'mutation.snps') if keep_artifacts else None,
+            'exec_mode': EXEC_MODE,
+            'engine': engine,
+            ###aligned fraction of the query and identity, what a comparison ranks the references by
+            'alignment': alignment,
+            'fastpath_fallback': job.stages['fastpath'].get('fallback'),
+            'timings': {name: info.get('seconds') for name, info in job.stages.items()},
+            'resources': {name: {key: info[key] for key in ('cpu_user_seconds', 'cpu_system_seconds', 'max_rss_bytes')
+                                 if key in info} for name, info in job.stages.items()},
+            'queue_wait_seconds': round(job.started_at - job.submitted_at, 3),
+        }
+        result_cache.put(cache_key, mutation_result, artifacts)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    add_to_cohort(job.params, cache_key)
+    return dict(mutation_result, cached=False)
+
+
+def job_finished(job):
+    unpin(UPLOADS_DIR, job.params['filename'], job.id)
+    record_job(job)
+
+
+governor = Governor(SLOTS, MAX_QUEUE, JOB_THREADS)
+watch_governor(governor)
+job_queue = JobQueue(run_mutation, max_workers=MUTATION_WORKERS, keep_seconds=JOB_KEEP_SECONDS,
+                     on_finished=job_finished, governor=governor)
+
+###nothing runs yet, whatever a killed predecessor left in the scratch areas can go
+for directory in {SCRATCH_DIR, SCRATCH_FALLBACK_DIR}:
+    purge_scratch(directory, 'mutation_')
+janitor = UploadsJanitor(UPLOADS_DIR, UPLOADS_MAX_BYTES, UPLOADS_TTL_SECONDS, UPLOADS_GC_INTERVAL,
+                         on_sweep=record_sweep)
+if UPLOADS_GC_INTERVAL > 0:
+    janitor.start()
+
+
+def check_upload(data):
+    ###validates the upload and cohort of a posted payload, returns (file_path, error_response)
+    filename = data.get('filename')
+    if not filename:
+        return None, (jsonify({'message': 'error', 'stderr': 'filename is required'}), 400)
+    file_path = os.path.join('/app/uploads', filename)
+    if not os.path.isfile(file_path):
+        return None, (jsonify({'message': 'error', 'stderr': f'File not found: {filename}'}), 400)
+    if data.get('cohort') and not COHORT_NAME.fullmatch(data['cohort']):
+        return None, (jsonify({'message': 'error', 'stderr': f"Invalid cohort name: {data['cohort']}"}), 400)
+    return file_path, None
+
+
+def mutation_params(data, file_path, reference_file, max_threads=None):
+    ###max_threads caps the slots the governor grants the job (jobs of a comparison share the budget)
+    reference_path = os.path.join('/data/references', reference_file)
+    return {'filename': data['filename'], 'reference': reference_file,
+            'cache_key': result_key(file_path, reference_path, MUMMER_PARAMS),
+            'artifacts': bool(data.get('artifacts')), 'cohort': data.get('cohort'),
+            'input_bytes': os.path.getsize(file_path), 'max_threads': max_threads}
+
+
+def finished_from_cache(params):
+    ###same sequence + reference + parameters already ran: a finished job without touching the pool;
+    ###a cached entry without the raw files does not satisfy a request for artifacts
+    cached = result_cache.get(params['cache_key'])
+    if cached is None or (params['artifacts'] and not cached.get('snps_file')):
+        return None
+    add_to_cohort(params, params['cache_key'])
+    return job_queue.add_finished(params, dict(cached, cached=True))
+
+
+def pin_upload(job):
+    ###the upload must survive the sweeper until the job is done with it (unpinned in job_finished)
+    with job_queue.changed:
+        if not job.finished:
+            pin(UPLOADS_DIR, job.params['filename'], job.id)
+
+
+def queue_full_response(e):
+    ###fail fast instead of piling up nucmer runs, the client should come back later
+    return jsonify({'message': 'error', 'stderr': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+
+
+def submit_from_request():
+    ###validates the posted payload and queues a job, returns (job, error_response)
+    data = request.get_json(silent=True) or {}
+    file_path, error = check_upload(data)
+    if error:
+        return None, error
+    reference_file = data.get('reference')
+    if not reference_file or reference_file == 'auto':
+        ###no reference picked: align against the closest one by sketch distance
+        ranking, _ = sketch_index.classify(file_path)
+        if not ranking or not ranking[0]['shared_hashes']:
+            return None, (jsonify({'message': 'error', 'stderr': f"No reference is close to {data['filename']}"}), 400)
+        reference_file = ranking[0]['file']
+    if not os.path.isfile(os.path.join('/data/references', reference_file)):
+        return None, (jsonify({'message': 'error', 'stderr': f'Reference not found: {reference_file}'}), 400)
+
+    params = mutation_params(data, file_path, reference_file)
+    job = finished_from_cache(params)
+    if job is not None:
+        return job, None
+    try:
+        job = job_queue.submit(params)
+    except QueueFull as e:
+        return None, queue_full_response(e)
+    pin_upload(job)
+    return job, None
+
+
+###multi-reference comparisons: id -> {'filename', 'jobs': {reference file: job id}, 'created_at'}.
+###the jobs themselves live in job_queue, a comparison is dropped once all of its jobs were pruned
+comparisons = {}
+comparisons_lock = threading.Lock()
+
+
+def submit_comparison_from_request():
+    ###validates the posted payload and queues one job per reference, all admitted together;
+    ###returns (comparison_id, error_response)
+    data = request.get_json(silent=True) or {}
+    file_path, error = check_upload(data)
+    if error:
+        return None, error
+    references = data.get('references') or [entry['file'] for entry in reference_registry.scan()]
+    if not isinstance(references, list) or not all(isinstance(reference, str) for reference in references):
+        return None, (jsonify({'message': 'error', 'stderr': 'references must be a list of reference files'}), 400)
+    references = list(dict.fromkeys(references))
+    if not references:
+        return None, (jsonify({'message': 'error', 'stderr': 'No references to compare against'}), 400)
+    if len(references) > MAX_QUEUE:
+        return None, (jsonify({'message': 'error', 'stderr': f'At most {MAX_QUEUE} references per comparison'}), 400)
+    for reference_file in references:
+        if not os.path.isfile(os.path.join('/data/references', reference_file)):
+            return None, (jsonify({'message': 'error', 'stderr': f'Reference not found: {reference_file}'}), 400)
+
+    ###an equal share of the slots per reference, so the alignments run side by side and the
+    ###comparison takes about as long as the slowest of them
+    max_threads = governor.share(len(references))
+    jobs, pending = {}, []
+    for reference_file in references:
+        params = mutation_params(data, file_path, reference_file, max_threads)
+        job = finished_from_cache(params)
+        if job is None:
+            pending.append(params)
+        else:
+            jobs[reference_file] = job
+    if pending:
+        try:
+            queued = job_queue.submit_group(pending)
+        except QueueFull as e:
+            return None, queue_full_response(e)
+        for job in queued:
+            pin_upload(job)
+            jobs[job.params['reference']] = job
+
+    comparison_id = str(uuid.uuid4())
+    with comparisons_lock:
+        for expired in [key for key, comparison in comparisons.items()
+                        if not any(job_queue.get(job_id) for job_id in comparison['jobs'].values())]:
+            del comparisons[expired]
+        comparisons[comparison_id] = {'filename': data['filename'], 'created_at': time.time(),
+                                      'jobs': {reference_file: jobs[reference_file].id for reference_file in references}}
+    return comparison_id, None
+
+
+def wait_comparison(comparison, timeout=None):
+    ###blocks until every job of the comparison finished, or the timeout passed
+    deadline = None if timeout is None else time.time() + timeout
+    for job_id in comparison['jobs'].values():
+        job = job_queue.get(job_id)
+        remaining = None if deadline is None else deadline - time.time()
+        if job is None or (remaining is not None and remaining <= 0):
+            continue
+        job_queue.wait(job, timeout=remaining)
+
+
+def comparison_dict(comparison_id, comparison, include_snps=False):
+    ###per-reference summary, finished references ranked by identity and aligned fraction (best first)
+    references = []
+    for reference_file, job_id in comparison['jobs'].items():
+        job = job_queue.get(job_id)
+        entry = {'reference': reference_file, 'job_id': job_id, 'status': job.status if job else 'expired'}
+        if job is not None and job.status == 'done':
+            result = job.result
+            entry.update({key: result.get(key) for key in ('result_id', 'snp_count', 'engine', 'cached')},
+                         **(result.get('alignment') or {}),
+                         snps_url=f"/mutate/results/{result['result_id']}/snps")
+            if include_snps:
+                store = result_store(result['result_id'])
+                entry['snps'] = [snp_dict(record) for record in store.rows(0, store.count_all)] if store else None
+        elif job is not None and job.status == 'failed':
+            entry['error'] = job.error.get('stderr') or job.error.get('message')
+        references.append(entry)
+    references.sort(key=lambda entry: (entry['status'] != 'done', -(entry.get('identity') or 0),
+                                       -(entry.get('aligned_fraction') or 0), entry['reference']))
+    finished = all(entry['status'] in ('done', 'failed', 'expired') for entry in references)
+    best = references[0]['reference'] if finished and references and references[0]['status'] == 'done' else None
+    return {'comparison_id': comparison_id, 'filename': comparison['filename'],
+            'status': 'done' if finished else 'running', 'best': best, 'references': references,
+            'created_at': comparison['created_at']}
 
-    ###first, i will run a nucmer to generate a delta file
-    nucmer_cmd = [
-    'nucmer',
-    '--prefix', f'mutation_{job_id}',
-    reference_path,
-    file_path
-    ]
+
+def result_response(job):
+    if job.status == 'failed':
+        return jsonify(job.error), 500
+    return jsonify(dict(job.result, snps_url=f"/mutate/results/{job.result['result_id']}/snps"))
+
+
+def result_store(result_id):
+    ###None when the id is malformed or the result was evicted
+    if not re.fullmatch(r'[0-9a-f]{64}', result_id) or result_cache.get(result_id) is None:
+        return None
+    return open_store(result_cache.entry_path(result_id, 'snps.col'))
+
+
+def result_feature_index(result_id):
+    ###feature index of the reference a result was called against, None when there are no features
+    result = result_cache.get(result_id)
+    if not result or not result.get('reference'):
+        return None
+    return load_feature_index(os.path.join('/data/references', result['reference']))
+
+
+def annotated(batch, feature_index, store):
+    if not feature_index or not batch:
+        return batch
+    ###codons are completed from the whole result, not just from this batch or page
+    return annotate_snps(batch, feature_index, store_substitutions(store, batch) if store is not None else None)
+
+
+def snp_dicts(records, feature_index=None, store=None):
+    ###records -> snp dicts, annotated batch by batch with gene / codon / amino acid when an index is given
+    batch = []
+    for record in records:
+        batch.append(snp_dict(record))
+        if len(batch) >= ANNOTATE_BATCH:
+            yield from annotated(batch, feature_index, store)
+            batch = []
+    yield from annotated(batch, feature_index, store)
+
+
+def range_args():
+    return {'ref_name': request.args.get('ref_name'),
+            'start': request.args.get('start', type=int),
+            'end': request.args.get('end', type=int)}
+
+
+@app.route('/mutate', methods=['POST'])
+def mutate():
+    ###kept for old clients: queues the job, blocks until it is done and inlines the snp list;
+    ###a 'references' list instead of 'reference' runs a comparison and inlines the snps of every reference
+    if isinstance((request.get_json(silent=True) or {}).get('references'), list):
+        comparison_id, error = submit_comparison_from_request()
+        if error:
+            return error
+        with comparisons_lock:
+            comparison = comparisons[comparison_id]
+        wait_comparison(comparison)
+        return jsonify(comparison_dict(comparison_id, comparison, include_snps=True))
+    job, error = submit_from_request()
+    if error:
+        return error
+    job_queue.wait(job)
+    if job.status == 'failed':
+        return jsonify(job.error), 500
+    store = result_store(job.result['result_id'])
+    if store is None:
+        ###evicted from the result cache between the job finishing and this read
+        return jsonify({'message': 'error', 'stderr': 'Result expired, submit the job again'}), 410
+    snps_list = [snp_dict(record) for record in store.rows(0, store.count_all)]
+    return jsonify(dict(job.result, snps=snps_list))
+
+
+@app.route('/mutate/jobs', methods=['POST'])
+def submit_job():
+    job, error = submit_from_request()
+    if error:
+        return error
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/mutate/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown job'}), 404
+
+    ###?wait=<seconds>&since=<version> turns this into a long-poll
+    wait = min(request.args.get('wait', default=0, type=float), MAX_POLL_WAIT)
+    if wait > 0:
+        job_queue.wait(job, since=request.args.get('since', type=int), timeout=wait)
+    return jsonify(job.to_dict())
+
+
+@app.route('/mutate/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown job'}), 404
+    if not job.finished:
+        return jsonify(job.to_dict()), 202
+    return result_response(job)
+
+
+@app.route('/mutate/compare', methods=['POST'])
+def submit_comparison():
+    ###{filename, references?: [reference files, default all], cohort?}: the upload against every reference at once
+    comparison_id, error = submit_comparison_from_request()
+    if error:
+        return error
+    with comparisons_lock:
+        comparison = comparisons[comparison_id]
+    return jsonify(comparison_dict(comparison_id, comparison)), 202
+
+
+@app.route('/mutate/compare/<comparison_id>', methods=['GET'])
+def comparison_status(comparison_id):
+    ###?wait=<seconds> long-polls until all references are done, ?snps=1 inlines the snps of each
+    with comparisons_lock:
+        comparison = comparisons.get(comparison_id)
+    if comparison is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown comparison'}), 404
+    wait = min(request.args.get('wait', default=0, type=float), MAX_POLL_WAIT)
+    if wait > 0:
+        wait_comparison(comparison, timeout=wait)
+    return jsonify(comparison_dict(comparison_id, comparison, include_snps=bool(request.args.get('snps', type=int))))
+
+
+@app.route('/mutate/results/<result_id>/snps', methods=['GET'])
+def result_snps(result_id):
+    ###streams the snps of a finished result as ndjson, one object per line (optionally one range)
+    store = result_store(result_id)
+    if store is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown result'}), 404
+    try:
+        lo, hi = store.bounds(**range_args())
+    except ValueError as e:
+        return jsonify({'message': 'error', 'stderr': str(e)}), 400
+
+    ###?annotate=1 adds the consequences from the reference's feature index
+    feature_index = result_feature_index(result_id) if request.args.get('annotate', type=int) else None
+
+    def generate():
+        for snp in snp_dicts(store.rows(lo, hi), feature_index, store):
+            yield json.dumps(snp) + '\n'
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@app.route('/mutate/results/<result_id>/snps/page', methods=['GET'])
+def result_snps_page(result_id):
+    ###?ref_name=&start=&end= selects a positional range (without ref_name on every reference),
+    ###?ref_base=&query_base= a base change ('.' for indels), ?sort=<field> or -<field> the order,
+    ###offset/limit page through it
+    store = result_store(result_id)
+    if store is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown result'}), 404
+    offset = request.args.get('offset', default=0, type=int)
+    limit = min(request.args.get('limit', default=100, type=int), MAX_PAGE_SIZE)
+    sort = request.args.get('sort') or None
     try:
-        result = subprocess.run(
-            nucmer_cmd,
-            cwd=outdir,  # run inside the output directory
-            capture_output=True,  # capture stdout and stderr
-            text=True,
-            check=True
-        )
-        ###at this point, nucmer ran successfully and i should have a delta file
-        ###i can now access it and convert the delta to vcf
-        ###i will not install delta2vcf, instead i will parse the delta file manually
-
-        delta_file = os.path.join(outdir, f'mutation_{job_id}.delta')
-        if os.path.exists(delta_file):
-            ###1. delta-filter from mummer
-            delta_filter_file = os.path.join(outdir, f'mutation_{job_id}.delta_filter')
-            with open (delta_filter_file, 'w') as df_outfile:
-                subprocess.run(['delta-filter',
-                                '-1',
-                                delta_file],
-                                stdout=df_outfile,
-                                check=True
-                                )
-                ###lets ensure the delta-filter file exists and is not empty
-                if os.path.exists(delta_filter_file) and os.path.getsize(delta_filter_file) > 0:
-                    show_snps_file = os.path.join(outdir, f'mutation_{job_id}.snps')
-                    with open(show_snps_file, 'w') as snps_outfile:
-                        subprocess.run(['show-snps',
-                                        '-Clr',
-                                        delta_filter_file],
-                                        stdout=snps_outfile,
-                                        check=True
-                                        )
-                        
-                        ###if the snps file was successfully created and is not empty
-                        ###i will parse it and send to the django view (using json)
-
-                        if os.path.exists(show_snps_file) and os.path.getsize(show_snps_file) > 0:
-                            snps_list = parse_snps_file(show_snps_file)
-                            return jsonify({
-                                    'snps':snps_list,
-                                    'message': 'success',
-                                    'stderr': result.stderr,
-                                    'snps_file':show_snps_file
-                                })
-            
-    except subprocess.CalledProcessError as e:
-        return jsonify({
-            'message': 'error',
-            'stderr': e.stderr
-        }), 500
-    
+        total, records = store.query(offset=offset, limit=limit, ref_base=request.args.get('ref_base') or None,
+                                     query_base=request.args.get('query_base') or None,
+                                     sort=sort and sort.lstrip('-'), descending=bool(sort and sort.startswith('-')),
+                                     **range_args())
+    except ValueError as e:
+        return jsonify({'message': 'error', 'stderr': str(e)}), 400
+    feature_index = result_feature_index(result_id) if request.args.get('annotate', type=int) else None
+    return jsonify({'total': total, 'offset': offset, 'limit': limit,
+                    'snps': list(snp_dicts(records, feature_index, store))})
+
+
+@app.route('/mutate/results/<result_id>/snps/count', methods=['GET'])
+def result_snps_count(result_id):
+    store = result_store(result_id)
+    if store is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown result'}), 404
+    try:
+        count = store.count(**range_args())
+    except ValueError as e:
+        return jsonify({'message': 'error', 'stderr': str(e)}), 400
+    return jsonify({'count': count, 'ref_names': store.ref_names()})
+
+
+@app.route('/cohorts', methods=['GET'])
+def list_cohorts():
+    return jsonify([dict(cohorts.get(name).summary(), name=name) for name in cohorts.names()])
+
 
+@app.route('/cohorts/<name>', methods=['GET'])
+def cohort_detail(name):
+    cohort = cohorts.get(name)
+    if cohort is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown cohort'}), 404
+    return jsonify(dict(cohort.summary(), name=name, sample_list=cohort.samples))
+
+
+@app.route('/cohorts/<name>/samples', methods=['POST'])
+def cohort_add_sample(name):
+    ###adds an existing result by id, e.g. one that was computed for another cohort
+    data = request.get_json(silent=True) or {}
+    result_id = data.get('result_id', '')
+    store = result_store(result_id)
+    if store is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown result'}), 404
+    cohort = cohorts.get(name, create=True)
+    if cohort is None:
+        return jsonify({'message': 'error', 'stderr': f'Invalid cohort name: {name}'}), 400
+    added = cohort.add_samples([(result_id, data.get('label') or result_id, store.rows(0, store.count_all))])
+    return jsonify(dict(cohort.summary(), name=name, added=added)), 201 if added else 200
+
+
+@app.route('/cohorts/<name>/distances', methods=['GET'])
+def cohort_distances(name):
+    ###?metric=snps (pairwise snp distance, default) or ?metric=shared (shared variant counts);
+    ###rows are paged with offset/limit, ?nearest=k answers the k closest samples per row instead
+    cohort = cohorts.get(name)
+    if cohort is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown cohort'}), 404
+    metric = request.args.get('metric', 'snps')
+    if metric not in ('snps', 'shared'):
+        return jsonify({'message': 'error', 'stderr': f'Unknown metric: {metric}'}), 400
+    offset = max(request.args.get('offset', default=0, type=int), 0)
+    limit = min(max(request.args.get('limit', default=100, type=int), 0), MAX_PAGE_SIZE)
+    nearest = request.args.get('nearest', type=int)
+    if nearest is not None and (nearest < 1 or metric != 'snps'):
+        return jsonify({'message': 'error', 'stderr': 'nearest must be a positive count of the snps metric'}), 400
+    with cohort.lock:
+        total = len(cohort.samples)
+        stop = min(offset + limit, total)
+        page = {'metric': metric, 'total': total, 'offset': offset, 'limit': limit,
+                'rows': cohort.samples[offset:stop]}
+        if nearest is not None:
+            page['nearest'] = [[dict(cohort.samples[column], distance=distance) for column, distance in row]
+                               for row in cohort.nearest(nearest, offset, stop)] if offset < stop else []
+            return jsonify(page)
+        matrix = cohort.distances(offset, stop) if metric == 'snps' else cohort.shared[offset:stop]
+        return jsonify(dict(page, samples=cohort.samples, matrix=matrix.tolist()))
+
+
+@app.route('/cohorts/<name>/clusters', methods=['GET'])
+def cohort_clusters(name):
+    cohort = cohorts.get(name)
+    if cohort is None:
+        return jsonify({'message': 'error', 'stderr': 'Unknown cohort'}), 404
+    threshold = request.args.get('threshold', default=10, type=int)
+    return jsonify({'threshold': threshold, 'clusters': cohort.clusters(threshold)})
+
+
+@app.route('/references', methods=['GET'])
+def list_references():
+    ###the registered references with checksum, records, length, gc content and index state, for the ui
+    return jsonify(reference_registry.list())
+
+
+@app.route('/classify', methods=['POST'])
+def classify():
+    ###ranks the references by minhash (mash) distance to an uploaded genome, closest first
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename')
+    if not filename:
+        return jsonify({'message': 'error', 'stderr': 'filename is required'}), 400
+    file_path = os.path.join('/app/uploads', filename)
+    if not os.path.isfile(file_path):
+        return jsonify({'message': 'error', 'stderr': f'File not found: {filename}'}), 400
+    ranking, seconds = sketch_index.classify(file_path)
+    best = ranking[0]['reference'] if ranking and ranking[0]['shared_hashes'] else None
+    return jsonify({'filename': filename, 'best': best, 'references': ranking, 'seconds': round(seconds, 4)})
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    ###prometheus text format
+    update_queue(job_queue.counts(), governor.status())
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
 
 
 if __name__ == '__main__':
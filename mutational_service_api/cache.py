@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+from compressed import open_fasta
+
+
+CHUNK_SIZE = 1 << 20
+###bump when the layout of a cache entry changes, old entries then simply stop matching
+RESULT_FORMAT = 5
+
+###digests are memoized on (path, size, mtime) in bounded lru caches, one entry per upload would
+###otherwise pile up for the lifetime of the service
+DIGEST_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=DIGEST_CACHE_SIZE)
+def _file_digest(path, size, mtime_ns):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_digest(path):
+    ###sha256 of a file, memoized so references are hashed once
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_size, stat.st_mtime_ns)
+
+
+@lru_cache(maxsize=DIGEST_CACHE_SIZE)
+def _sequence_digest(path, size, mtime_ns):
+    sha = hashlib.sha256()
+    with open_fasta(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith(b'>'):
+                record_id = line[1:].split(maxsplit=1)[0] if len(line) > 1 else b''
+                sha.update(b'\n>' + record_id + b'\n')
+            else:
+                sha.update(line.upper())
+    return sha.hexdigest()
+
+
+def sequence_digest(path):
+    ###digest of the normalised fasta content: record ids + upper-cased sequence, no line wrapping
+    ###so the same genome re-uploaded under a new uuid (or re-wrapped, or gzipped) maps to the same key;
+    ###memoized like file_digest, a comparison keys one query against every reference
+    stat = os.stat(path)
+    return _sequence_digest(path, stat.st_size, stat.st_mtime_ns)
+
+
+def result_key(query_path, reference_path, params):
+    payload = {
+        'query': sequence_digest(query_path),
+        'reference': file_digest(reference_path),
+        'params': params,
+        'format': RESULT_FORMAT,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    ###one directory per key holding result.json plus the mummer artifacts,
+    ###a small sqlite index tracks sizes and last access for lru eviction
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(root, 'index.sqlite3'), check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                         'key TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+                         'created REAL NOT NULL, last_access REAL NOT NULL)')
+        self._db.commit()
+
+    def entry_dir(self, key):
+        return os.path.join(self.root, key)
+
+    def entry_path(self, key, name):
+        return os.path.join(self.entry_dir(key), name)
+
+    def get(self, key):
+        result_path = self.entry_path(key, 'result.json')
+        try:
+            with open(result_path) as f:
+                result = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        with self._lock:
+            self._db.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+            self._db.commit()
+        return result
+
+    def put(self, key, result, artifacts=None):
+        ###artifacts maps the stored name to a path that is moved into the entry
+        staging = tempfile.mkdtemp(prefix=f'.{key}.', dir=self.root)
+        try:
+            for name, path in (artifacts or {}).items():
+                if path and os.path.exists(path):
+                    shutil.move(path, os.path.join(staging, name))
+            with open(os.path.join(staging, 'result.json'), 'w') as f:
+                json.dump(result, f)
+            size = sum(os.path.getsize(os.path.join(staging, name)) for name in os.listdir(staging))
+
+            with self._lock:
+                target = self.entry_dir(key)
+                if os.path.exists(target):
+                    ###same result computed again (e.g. now with artifacts), the newer entry wins
+                    shutil.rmtree(target, ignore_errors=True)
+                os.rename(staging, target)
+                now = time.time()
+                self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, size, now, now))
+                self._db.commit()
+                self._evict(keep=key)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def _evict(self, keep=None):
+        ###called with the lock held; drops least recently used entries until under quota. the entry
+        ###just put (`keep`) is never dropped, even alone over quota: its job is about to answer from it
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute('SELECT key, size FROM entries WHERE key != ? ORDER BY last_access',
+                                (keep or '',)).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+        self._db.commit()
@@ -0,0 +1,192 @@
+import json
+import os
+import re
+import threading
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+###starts with a letter or digit, so '.', '..' and hidden names are never a cohort
+COHORT_NAME = re.compile(r'[A-Za-z0-9][A-Za-z0-9_.-]{0,63}')
+JOURNAL = 'samples.jsonl'
+
+
+class Cohort:
+    ###sparse sample x variant matrix (csr, 1 = sample carries the variant) plus the dense
+    ###sample x sample count of shared variants; adding samples only computes the new rows,
+    ###snp distances are derived from it: |a| + |b| - 2 * shared(a, b).
+    ###the shared counts live in a buffer with spare capacity that doubles when full, so an
+    ###addition writes its new rows in place instead of copying the whole n x n matrix
+    def __init__(self, directory):
+        self.directory = directory
+        self.samples = []
+        self.variants = []
+        self._sample_index = {}
+        self._variant_index = {}
+        self.matrix = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self._shared = np.zeros((0, 0), dtype=np.int32)
+        self.lock = threading.Lock()
+        if os.path.exists(self._path(JOURNAL)):
+            self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def shared(self):
+        count = len(self.samples)
+        return self._shared[:count, :count]
+
+    def _reserve(self, count):
+        ###grows the buffer to hold `count` samples, at least doubling it
+        capacity = self._shared.shape[0]
+        if count <= capacity:
+            return
+        used = len(self.samples)
+        grown = np.zeros((max(count, 2 * capacity),) * 2, dtype=np.int32)
+        grown[:used, :used] = self._shared[:used, :used]
+        self._shared = grown
+
+    def __contains__(self, sample_id):
+        return sample_id in self._sample_index
+
+    def _variant_column(self, key):
+        column = self._variant_index.get(key)
+        if column is None:
+            column = self._variant_index[key] = len(self.variants)
+            self.variants.append(key)
+        return column
+
+    def add_samples(self, samples, save=True):
+        ###samples: iterable of (sample_id, label, snp records as in pipeline.iter_snps);
+        ###samples already in the cohort are skipped, returns how many were added
+        with self.lock:
+            indptr, indices, added, journal, seen = [0], [], [], [], set()
+            for sample_id, label, records in samples:
+                if sample_id in self._sample_index or sample_id in seen:
+                    continue
+                seen.add(sample_id)
+                keys = sorted({(ref_name, pos_ref, ref_base, query_base)
+                               for pos_ref, ref_base, pos_query, query_base, ref_name, query_name in records})
+                indices.extend(sorted(self._variant_column(key) for key in keys))
+                indptr.append(len(indices))
+                added.append({'id': sample_id, 'label': label})
+                journal.append({'id': sample_id, 'label': label, 'variants': keys})
+            if not added:
+                return 0
+
+            width = len(self.variants)
+            new = sparse.csr_matrix((np.ones(len(indices), dtype=np.int32), indices, indptr),
+                                    shape=(len(added), width))
+            old = self.matrix
+            old.resize((old.shape[0], width))
+
+            ###only the new rows are multiplied: new x old and new x new
+            shared_old = (new @ old.T).toarray().astype(np.int32)
+            shared_new = (new @ new.T).toarray().astype(np.int32)
+            count = old.shape[0]
+            total = count + len(added)
+            self._reserve(total)
+            self._shared[count:total, :count] = shared_old
+            self._shared[:count, count:total] = shared_old.T
+            self._shared[count:total, count:total] = shared_new
+
+            self.matrix = sparse.vstack([old, new], format='csr')
+            for sample in added:
+                self._sample_index[sample['id']] = len(self.samples)
+                self.samples.append(sample)
+            if save:
+                self._append_journal(journal)
+            return len(added)
+
+    def sizes(self):
+        ###variants per sample, the diagonal of the shared counts
+        return np.diagonal(self.shared)
+
+    def distances(self, start=0, stop=None):
+        ###rows start:stop of the snp distance matrix, all of it by default
+        sizes = self.sizes()
+        return sizes[start:stop, None] + sizes[None, :] - 2 * self.shared[start:stop]
+
+    def nearest(self, k, start=0, stop=None):
+        ###for rows start:stop, the k closest other samples as (column, distance), closest first
+        rows = self.distances(start, stop)
+        columns = np.arange(rows.shape[1])
+        ###a sample is never its own neighbour
+        rows[np.arange(rows.shape[0]), np.arange(start, start + rows.shape[0])] = np.iinfo(rows.dtype).max
+        k = min(k, rows.shape[1] - 1)
+        if k <= 0:
+            return [[] for _ in range(rows.shape[0])]
+        closest = np.argpartition(rows, k - 1, axis=1)[:, :k]
+        result = []
+        for row, candidates in zip(rows, closest):
+            order = candidates[np.lexsort((columns[candidates], row[candidates]))]
+            result.append([(int(column), int(row[column])) for column in order])
+        return result
+
+    def clusters(self, threshold):
+        ###single linkage: samples within `threshold` snps of each other end up in one cluster
+        with self.lock:
+            if not self.samples:
+                return []
+            adjacency = sparse.csr_matrix(self.distances() <= threshold)
+            count, labels = connected_components(adjacency, directed=False)
+            members = [[] for _ in range(count)]
+            for row, label in enumerate(labels):
+                members[label].append(self.samples[row])
+            return sorted(members, key=len, reverse=True)
+
+    def summary(self):
+        return {'samples': len(self.samples), 'variants': len(self.variants)}
+
+    def _append_journal(self, entries):
+        ###append-only, one line per sample, so persisting an addition costs only the new rows
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(JOURNAL), 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+    def _load(self):
+        ###replays the journal through add_samples; a torn last line (crash mid-write) is ignored
+        entries = []
+        with open(self._path(JOURNAL)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entries.append((entry['id'], entry['label'],
+                                [(pos_ref, ref_base, None, query_base, ref_name, None)
+                                 for ref_name, pos_ref, ref_base, query_base in entry['variants']]))
+        self.add_samples(entries, save=False)
+
+
+class CohortStore:
+    ###one directory per cohort under `root`, cohorts are loaded on first use and kept in memory
+    def __init__(self, root):
+        self.root = root
+        self._cohorts = {}
+        self._lock = threading.Lock()
+
+    def names(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.exists(os.path.join(self.root, name, JOURNAL)))
+
+    def get(self, name, create=False):
+        if not COHORT_NAME.fullmatch(name):
+            return None
+        with self._lock:
+            cohort = self._cohorts.get(name)
+            if cohort is None:
+                directory = os.path.join(self.root, name)
+                root = os.path.realpath(self.root)
+                if os.path.dirname(os.path.realpath(directory)) != root:
+                    return None
+                if not create and not os.path.exists(os.path.join(directory, JOURNAL)):
+                    return None
+                cohort = self._cohorts[name] = Cohort(directory)
+            return cohort
@@ -0,0 +1,94 @@
+import gzip
+import os
+import shutil
+import threading
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 1 << 20
+
+
+def is_gzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def open_fasta(path):
+    ###binary reader over a plain or gzip fasta; bgzf is a series of gzip members, gzip reads through them
+    return gzip.open(path, 'rb') if is_gzip(path) else open(path, 'rb')
+
+
+class _Feed:
+    ###decompresses `source` from a thread into whatever _open_target() returns; a reader that
+    ###stops early (or never starts) only ends the copy, it is not an error
+    def __init__(self, source):
+        self.source = source
+        self.error = None
+        self._thread = threading.Thread(target=self._copy, daemon=True)
+
+    def _copy(self):
+        try:
+            with self._open_target() as target, open_fasta(self.source) as source:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+        except BrokenPipeError:
+            pass
+        except (OSError, EOFError) as e:
+            self.error = e
+
+
+class FifoFeed(_Feed):
+    ###serves a compressed file as plain text under `path` (a named pipe), for tools that only take a
+    ###file name; every tool that reads the file needs its own feed, a pipe can only be read once
+    def __init__(self, source, path):
+        super().__init__(source)
+        self.path = path
+
+    def _open_target(self):
+        ###blocks until the tool opens the pipe
+        return open(self.path, 'wb')
+
+    def __enter__(self):
+        os.mkfifo(self.path)
+        self._thread.start()
+        return self.path
+
+    def __exit__(self, *exc):
+        ###the tool is done; if it never opened the pipe, opening the read end lets the writer through
+        ###(and its first write then fails with a broken pipe)
+        while self._thread.is_alive():
+            try:
+                os.close(os.open(self.path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self._thread.join(0.1)
+        os.remove(self.path)
+        if self.error and exc[0] is None:
+            raise self.error
+
+
+class PipeFeed(_Feed):
+    ###serves a compressed file as plain text on the read end of an os pipe, to be used as a tool's stdin
+    def __init__(self, source):
+        super().__init__(source)
+        self._read_fd = self._write_fd = None
+
+    def _open_target(self):
+        return os.fdopen(self._write_fd, 'wb')
+
+    def __enter__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        self._thread.start()
+        return self._read_fd
+
+    def __exit__(self, *exc):
+        ###the tool has its own copy of the read end; closing ours lets a blocked writer fail
+        os.close(self._read_fd)
+        self._thread.join()
+        if self.error and exc[0] is None:
+            raise self.error
+
+
+def decompress_to(source, path):
+    with open_fasta(source) as src, open(path, 'wb') as out:
+        shutil.copyfileobj(src, out, CHUNK_SIZE)
+    return path
@@ -0,0 +1,230 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from sketch import CODES, packed_kmers, read_named_records
+
+
+###anchors are exact matches of k-mers that occur once in the reference (forward strand only, so the
+###inverted terminal repeats of poxvirus genomes still anchor on their own copy)
+ANCHOR_K = 31
+###an anchored stretch of the genome may carry a gap of at most this many bases between two diagonals
+MAX_INDEL = 50
+###four differences within one anchor length are left to nucmer (clustered variants, local misalignment)
+MAX_CLUSTER = 4
+###fraction of differing aligned bases above which the genome is not "near-identical" any more
+MAX_DIVERGENCE = 0.01
+###contigs shorter than this, or with less than MIN_ANCHORED of their bases in anchored stretches, fall back
+MIN_CONTIG = 1000
+MIN_ANCHORED = 0.9
+###unanchored ends of a contig longer than this are not aligned here
+MAX_FLANK = 2 * ANCHOR_K
+
+
+class Fallback(Exception):
+    ###the genome is not a simple case, the reason says why; the caller runs nucmer instead
+    pass
+
+
+class ReferenceIndex:
+    ###the reference records concatenated (separated by N runs, so no k-mer spans two records) with
+    ###the sorted unique forward k-mers and where they start
+    def __init__(self, path, k=ANCHOR_K):
+        self.k = k
+        records = read_named_records(path)
+        self.names = [name for name, _ in records]
+        sequences = [sequence for _, sequence in records]
+        self.lengths = [len(sequence) for sequence in sequences]
+        self.offsets = [0]
+        for length in self.lengths[:-1]:
+            self.offsets.append(self.offsets[-1] + length + k)
+        self.sequence = (b'N' * k).join(sequences)
+        self.bases = np.frombuffer(self.sequence, dtype=np.uint8)
+
+        forward, _, valid = packed_kmers(self.sequence, k)
+        starts = np.flatnonzero(valid)
+        kmers = forward[valid]
+        order = np.argsort(kmers, kind='stable')
+        kmers, starts = kmers[order], starts[order]
+        ###keep the k-mers that occur exactly once
+        first = np.concatenate(([True], kmers[1:] != kmers[:-1]))
+        last = np.concatenate((kmers[1:] != kmers[:-1], [True]))
+        unique = first & last
+        self.kmers, self.starts = kmers[unique], starts[unique]
+
+    def locate(self, position):
+        ###(record index, 0-based position in the record) of a position in the concatenated sequence
+        index = int(np.searchsorted(self.offsets, position, side='right')) - 1
+        return index, position - self.offsets[index]
+
+
+@lru_cache(maxsize=8)
+def _load_reference_index(path, stamp):
+    return ReferenceIndex(path)
+
+
+def load_reference_index(path):
+    ###built once per reference and held in memory, the stamp rebuilds it when the file changes
+    return _load_reference_index(path, os.stat(path).st_mtime_ns)
+
+
+def _runs(query_starts, reference_starts, k):
+    ###anchors grouped into runs of one diagonal: [(query start, query end, diagonal)], ends exclusive
+    diagonals = reference_starts - query_starts
+    breaks = np.flatnonzero(diagonals[1:] != diagonals[:-1]) + 1
+    firsts = np.concatenate(([0], breaks))
+    lasts = np.concatenate((breaks - 1, [diagonals.size - 1]))
+    return [(int(query_starts[first]), int(query_starts[last]) + k, int(diagonals[first]))
+            for first, last in zip(firsts, lasts)]
+
+
+def _substitutions(query, reference, query_start, reference_start, length):
+    ###(query offset, reference offset) of every differing base of two equally long stretches
+    a = query[query_start:query_start + length]
+    b = reference[reference_start:reference_start + length]
+    offsets = np.flatnonzero(a != b)
+    return [(query_start + int(offset), reference_start + int(offset)) for offset in offsets]
+
+
+def _place_gap(a, b):
+    ###one gap of |len(a) - len(b)| bases in the longer stretch, placed where the fewest bases differ;
+    ###returns (position, cost) or raises when several placements are equally good (a shiftable indel)
+    short = min(a.size, b.size)
+    left = np.concatenate(([0], np.cumsum(a[:short] != b[:short])))
+    tail = a[a.size - short:] != b[b.size - short:]
+    right = np.concatenate((np.cumsum(tail[::-1])[::-1], [0]))
+    cost = left + right
+    best = int(cost.min())
+    placements = np.flatnonzero(cost == best)
+    if placements.size > 1:
+        raise Fallback('indel in a repeat, its position is ambiguous')
+    return int(placements[0]), best
+
+
+def call_contig(name, sequence, index):
+    ###snps of one query contig as show-snps records (see pipeline.SNP_FIELDS), 1-based positions
+    k = index.k
+    if len(sequence) < MIN_CONTIG:
+        raise Fallback(f'contig {name} is shorter than {MIN_CONTIG} bp')
+    query = np.frombuffer(sequence, dtype=np.uint8)
+    reference = index.bases
+    if np.any(CODES[query] > 3):
+        raise Fallback(f'contig {name} has ambiguous bases')
+
+    forward, _, _ = packed_kmers(sequence, k)
+    slots = np.searchsorted(index.kmers, forward)
+    slots[slots >= index.kmers.size] = 0
+    found = index.kmers[slots] == forward
+    query_starts = np.flatnonzero(found)
+    if query_starts.size == 0:
+        raise Fallback(f'contig {name} has no anchors')
+    reference_starts = index.starts[slots[found]]
+    ###a substitution can turn k-mers into ones that are unique elsewhere in the reference: a short run
+    ###of anchors off the diagonal its neighbouring runs agree on is dropped
+    diagonals = reference_starts - query_starts
+    run_ids = np.concatenate(([0], np.cumsum(diagonals[1:] != diagonals[:-1])))
+    runs = _runs(query_starts, reference_starts, k)
+    stray = [position for position in range(1, len(runs) - 1)
+             if runs[position][1] - runs[position][0] < 2 * k and runs[position - 1][2] == runs[position + 1][2]]
+    if stray:
+        keep = ~np.isin(run_ids, stray)
+        query_starts, reference_starts = query_starts[keep], reference_starts[keep]
+    if np.any(np.diff(reference_starts) <= 0):
+        raise Fallback(f'contig {name} is rearranged, duplicated or reverse complemented')
+
+    runs = _runs(query_starts, reference_starts, k)
+    anchored = sum(end - start for start, end, _ in runs)
+    if anchored < MIN_ANCHORED * len(sequence):
+        raise Fallback(f'contig {name} has a low anchor density')
+
+    ###flanks before the first and after the last anchor only get aligned when they do not differ
+    first_start, _, first_diagonal = runs[0]
+    _, last_end, last_diagonal = runs[-1]
+    if first_start > MAX_FLANK or len(sequence) - last_end > MAX_FLANK:
+        raise Fallback(f'contig {name} has long unanchored ends')
+    head = max(0, -first_diagonal)
+    tail = min(len(sequence), reference.size - last_diagonal)
+    if _substitutions(query, reference, head, head + first_diagonal, first_start - head) or \
+            _substitutions(query, reference, last_end, last_end + last_diagonal, tail - last_end):
+        raise Fallback(f'contig {name} differs close to its ends')
+
+    ###(query offset, reference offset, query base, reference base), '.' for the missing side of an indel;
+    ###events holds one query offset per substitution or indel, for the cluster check
+    differences, events = [], []
+    for position, (start, end, diagonal) in enumerate(runs):
+        differences += [(q, r, sequence[q:q + 1], index.sequence[r:r + 1])
+                        for q, r in _substitutions(query, reference, start, start + diagonal, end - start)]
+        if position + 1 == len(runs):
+            break
+        next_start, _, next_diagonal = runs[position + 1]
+        gap = next_diagonal - diagonal
+        if abs(gap) > MAX_INDEL:
+            raise Fallback(f'contig {name} has an indel longer than {MAX_INDEL} bp')
+        query_gap = query[end:next_start]
+        reference_gap = reference[end + diagonal:next_start + next_diagonal]
+        if next_start < end or next_start + next_diagonal < end + diagonal:
+            raise Fallback('indel in a repeat, its position is ambiguous')
+        if index.locate(end + diagonal)[0] != index.locate(next_start + next_diagonal)[0]:
+            raise Fallback(f'contig {name} spans two reference records')
+        split, _ = _place_gap(query_gap, reference_gap)
+        q0, r0 = end, end + diagonal
+        ###the gap can also slide into the anchored bases around it when it sits in a homopolymer or
+        ###tandem repeat: the base before the gap equals its last base, or its first the one after it
+        inserted = query[q0 + split:q0 + split - gap] if gap < 0 else reference[r0 + split:r0 + split + gap]
+        before = query[q0 + split - 1] if gap < 0 else reference[r0 + split - 1]
+        after = query[q0 + split - gap] if gap < 0 else reference[r0 + split + gap]
+        if before == inserted[-1] or after == inserted[0]:
+            raise Fallback('indel in a repeat, its position is ambiguous')
+        events.append(q0 + split)
+        ###aligned left of the gap, the gap itself, aligned right of it
+        differences += [(q, r, sequence[q:q + 1], index.sequence[r:r + 1])
+                        for q, r in _substitutions(query, reference, q0, r0, split)]
+        if gap > 0:
+            differences += [(q0 + split - 1, r0 + split + offset, b'.',
+                             index.sequence[r0 + split + offset:r0 + split + offset + 1]) for offset in range(gap)]
+        else:
+            differences += [(q0 + split + offset, r0 + split - 1,
+                             sequence[q0 + split + offset:q0 + split + offset + 1], b'.') for offset in range(-gap)]
+        q1, r1 = q0 + split + max(0, -gap), r0 + split + max(0, gap)
+        differences += [(q, r, sequence[q:q + 1], index.sequence[r:r + 1])
+                        for q, r in _substitutions(query, reference, q1, r1, next_start - q1)]
+
+    aligned = tail - head
+    if len(differences) > MAX_DIVERGENCE * aligned:
+        raise Fallback(f'contig {name} is more than {MAX_DIVERGENCE:.0%} divergent')
+    events += [q for q, _, query_base, reference_base in differences if b'.' not in (query_base, reference_base)]
+    query_offsets = np.array(sorted(events), dtype=np.int64)
+    if query_offsets.size >= MAX_CLUSTER and np.any(query_offsets[MAX_CLUSTER - 1:] - query_offsets[:1 - MAX_CLUSTER] < k):
+        raise Fallback(f'contig {name} has clustered differences')
+
+    records = []
+    for q, r, query_base, reference_base in differences:
+        record, position = index.locate(r)
+        records.append((position + 1, reference_base.decode(), q + 1, query_base.decode(),
+                        index.names[record], name))
+    ###reference interval the contig covers, to spot contigs that overlap on the reference; aligned query bases
+    return records, (first_start + first_diagonal, last_end + last_diagonal), aligned
+
+
+def call_snps(reference_path, query_path):
+    ###in-process snp calling for near-identical genomes: anchors on unique reference k-mers, runs of
+    ###one diagonal are compared base by base and the gaps between diagonals become small indels.
+    ###returns (records in show-snps -Clr order, alignment summary), raises Fallback for anything that
+    ###needs a real aligner
+    index = load_reference_index(reference_path)
+    records, spans = [], []
+    alignment = {'query_bases': 0, 'aligned_bases': 0}
+    for name, sequence in read_named_records(query_path):
+        contig_records, span, aligned = call_contig(name, sequence, index)
+        records += contig_records
+        spans.append(span)
+        alignment['query_bases'] += len(sequence)
+        alignment['aligned_bases'] += aligned
+    spans.sort()
+    if any(previous[1] > following[0] for previous, following in zip(spans, spans[1:])):
+        raise Fallback('contigs overlap on the reference')
+    order = {name: position for position, name in enumerate(index.names)}
+    records.sort(key=lambda record: (order[record[4]], record[0], record[2]))
+    alignment['differences'] = len(records)
+    return records, alignment
@@ -0,0 +1,219 @@
+import os
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+
+
+HEADER_ATTRIBUTE = re.compile(r'\[(\w+)=([^\]]*)\]')
+LOCATION = re.compile(r'^(complement\()?<?(\d+)\.\.>?(\d+)\)?$')
+###ncbi protein/cds fasta ids look like lcl|NC_003310.1_prot_NP_536428.1_1
+SEQUENCE_ID = re.compile(r'^lcl\|(.+?)_(?:prot|cds)_')
+
+COMPLEMENT = str.maketrans('ACGTRYKMBDHVNacgtrykmbdhvn', 'TGCAYRMKVHDBNtgcayrmkvhdbn')
+BASES = 'TCAG'
+AMINO_ACIDS = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+###standard genetic code (ncbi table 1)
+CODON_TABLE = {a + b + c: AMINO_ACIDS[16 * i + 4 * j + k]
+               for i, a in enumerate(BASES) for j, b in enumerate(BASES) for k, c in enumerate(BASES)}
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+def translate(codon):
+    return CODON_TABLE.get(codon.upper(), 'X')
+
+
+def read_fasta(path):
+    ###{record id: sequence}, the reference genomes are small enough to keep as plain strings
+    sequences = {}
+    record_id, chunks = None, []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                if record_id is not None:
+                    sequences[record_id] = ''.join(chunks).upper()
+                record_id, chunks = line[1:].split(maxsplit=1)[0], []
+            elif line:
+                chunks.append(line)
+    if record_id is not None:
+        sequences[record_id] = ''.join(chunks).upper()
+    return sequences
+
+
+def read_faa_features(path):
+    ###cds features from the [location=..] / [gene=..] attributes of an ncbi protein fasta
+    features = []
+    with open(path) as f:
+        for line in f:
+            if not line.startswith('>'):
+                continue
+            header = line[1:].strip()
+            attributes = dict(HEADER_ATTRIBUTE.findall(header))
+            location = LOCATION.match(attributes.get('location', ''))
+            sequence_id = SEQUENCE_ID.match(header)
+            if not location or not sequence_id:
+                continue  #joins and other compound locations are not used by these references
+            features.append({
+                'seq_id': sequence_id.group(1),
+                'start': int(location.group(2)),
+                'end': int(location.group(3)),
+                'strand': '-' if location.group(1) else '+',
+                'gene': attributes.get('gene'),
+                'locus_tag': attributes.get('locus_tag'),
+                'product': attributes.get('protein'),
+                'protein_id': attributes.get('protein_id'),
+            })
+    return features
+
+
+class FeatureIndex:
+    ###per sequence the features are sorted by start with a running maximum of the ends, a point
+    ###lookup is one bisect plus a walk back over the features that can still overlap: O(log n + hits)
+    def __init__(self, features, sequences=None):
+        self.sequences = sequences or {}
+        by_sequence = {}
+        for feature in features:
+            by_sequence.setdefault(feature['seq_id'], []).append(feature)
+        self._features = {}
+        self._starts = {}
+        self._max_ends = {}
+        for seq_id, items in by_sequence.items():
+            items.sort(key=lambda feature: (feature['start'], feature['end']))
+            self._features[seq_id] = items
+            self._starts[seq_id] = [feature['start'] for feature in items]
+            self._max_ends[seq_id] = list(accumulate((feature['end'] for feature in items), max))
+
+    def __len__(self):
+        return sum(len(items) for items in self._features.values())
+
+    def _seq_id(self, ref_name):
+        ###show-snps reports the fasta id (NC_003310.1), tolerate a missing version suffix
+        if ref_name in self._features:
+            return ref_name
+        base = ref_name.split('.')[0]
+        for seq_id in self._features:
+            if seq_id.split('.')[0] == base:
+                return seq_id
+        return None
+
+    def overlapping(self, ref_name, position):
+        seq_id = self._seq_id(ref_name)
+        if seq_id is None:
+            return []
+        features, max_ends = self._features[seq_id], self._max_ends[seq_id]
+        hits = []
+        row = bisect_right(self._starts[seq_id], position) - 1
+        while row >= 0 and max_ends[row] >= position:
+            if features[row]['end'] >= position:
+                hits.append(features[row])
+            row -= 1
+        hits.reverse()
+        return hits
+
+    def sequence(self, ref_name):
+        sequence = self.sequences.get(ref_name)
+        if sequence is None:
+            base = ref_name.split('.')[0]
+            sequence = next((value for key, value in self.sequences.items() if key.split('.')[0] == base), None)
+        return sequence
+
+
+def _codon(sequence, feature, position, substitutions):
+    ###(codon number, position in codon, ref codon, alt codon) on the coding strand;
+    ###every substitution falling into the same codon is applied together
+    if feature['strand'] == '+':
+        offset = position - feature['start']
+        first = feature['start'] + offset - offset % 3
+        positions = (first, first + 1, first + 2)
+    else:
+        offset = feature['end'] - position
+        first = feature['end'] - (offset - offset % 3)
+        positions = (first, first - 1, first - 2)
+    if min(positions) < 1 or max(positions) > len(sequence):
+        return None
+    ref_codon = ''.join(sequence[p - 1] for p in positions)
+    alt_codon = ''.join(substitutions.get(p, sequence[p - 1]).upper() for p in positions)
+    if feature['strand'] == '-':
+        ref_codon, alt_codon = ref_codon.translate(COMPLEMENT), alt_codon.translate(COMPLEMENT)
+    return offset // 3 + 1, offset % 3 + 1, ref_codon, alt_codon
+
+
+def _effect(ref_aa, alt_aa):
+    if ref_aa == alt_aa:
+        return 'synonymous'
+    if alt_aa == '*':
+        return 'nonsense'
+    if ref_aa == '*':
+        return 'stop_lost'
+    return 'missense'
+
+
+def store_substitutions(store, snps):
+    ###{ref name: {position: base}} of every substitution in the store within a codon's reach of
+    ###the snps, so a codon split over two batches or pages is still changed as a whole
+    substitutions = {}
+    for snp in snps:
+        lo, hi = store.bounds(snp['ref_name'], max(1, snp['pos_ref'] - 2), snp['pos_ref'] + 2)
+        for row in range(lo, hi):
+            pos_ref, ref_base, _, query_base, ref_name, _ = store.record(row)
+            if ref_base != '.' and query_base != '.':
+                substitutions.setdefault(ref_name, {})[pos_ref] = query_base
+    return substitutions
+
+
+def annotate_snps(snps, index, substitutions=None):
+    ###adds gene / codon / amino acid consequences to a batch of snp dicts (snp_dict shape), in place;
+    ###without substitutions (see store_substitutions) only the batch itself is looked at
+    if substitutions is None:
+        substitutions = {}
+        for snp in snps:
+            if snp['ref_base'] != '.' and snp['query_base'] != '.':
+                substitutions.setdefault(snp['ref_name'], {})[snp['pos_ref']] = snp['query_base']
+
+    for snp in snps:
+        consequences = []
+        sequence = index.sequence(snp['ref_name'])
+        indel = '.' in (snp['ref_base'], snp['query_base'])
+        for feature in index.overlapping(snp['ref_name'], snp['pos_ref']):
+            consequence = {'gene': feature['gene'], 'locus_tag': feature['locus_tag'],
+                           'product': feature['product'], 'strand': feature['strand']}
+            codon = None if indel or sequence is None else _codon(
+                sequence, feature, snp['pos_ref'], substitutions.get(snp['ref_name'], {}))
+            if codon:
+                codon_number, codon_position, ref_codon, alt_codon = codon
+                ref_aa, alt_aa = translate(ref_codon), translate(alt_codon)
+                consequence.update(codon_number=codon_number, codon_position=codon_position,
+                                   ref_codon=ref_codon, alt_codon=alt_codon,
+                                   aa_change=f'{ref_aa}{codon_number}{alt_aa}', effect=_effect(ref_aa, alt_aa))
+            else:
+                consequence['effect'] = 'frameshift' if indel else None
+            consequences.append(consequence)
+
+        first = consequences[0] if consequences else {}
+        snp.update(gene=first.get('gene') or first.get('locus_tag'),
+                   aa_change=first.get('aa_change'),
+                   effect=first.get('effect') or ('intergenic' if not consequences else None),
+                   consequences=consequences)
+    return snps
+
+
+@lru_cache(maxsize=8)
+def _load_feature_index(features_path, sequence_path, stamp):
+    return FeatureIndex(read_faa_features(features_path),
+                        read_fasta(sequence_path) if sequence_path else None)
+
+
+def load_feature_index(reference_path):
+    ###index for the reference the snps were called against, built once and held in memory;
+    ###features come from the .faa next to the .fasta, the stamp rebuilds it when either file changes
+    stem = os.path.splitext(reference_path)[0]
+    features_path = f'{stem}.faa'
+    if not os.path.isfile(features_path):
+        return None
+    sequence_path = reference_path if os.path.isfile(reference_path) else None
+    stamp = tuple(os.stat(path).st_mtime_ns for path in (features_path, sequence_path) if path)
+    return _load_feature_index(features_path, sequence_path, stamp)
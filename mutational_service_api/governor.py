@@ -0,0 +1,81 @@
+import math
+import os
+import threading
+
+
+class QueueFull(Exception):
+    ###the waiting line is full; retry_after is a rough estimate in seconds
+    def __init__(self, retry_after):
+        super().__init__(f'queue is full, retry in {retry_after}s')
+        self.retry_after = retry_after
+
+
+def cpu_slots(slots_per_cpu):
+    ###slot budget for this container: cpus it may run on (affinity, not the host total) x slots per cpu
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, int(cpus * slots_per_cpu))
+
+
+class Governor:
+    ###admission control: a budget of cpu slots shared by the running jobs and a bounded waiting line.
+    ###admit() is called at submission and fails fast when the line is full, acquire() blocks until
+    ###slots are free and hands out up to `job_slots` of them, that grant is the job's thread count
+    def __init__(self, slots, max_queue, job_slots):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.job_slots = max(1, min(job_slots, slots))
+        self.free = slots
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+        self._average_seconds = None
+        self._cond = threading.Condition()
+
+    def admit(self, count=1):
+        ###all or nothing, so a group of jobs (a multi-reference comparison) is never queued half
+        with self._cond:
+            if self.waiting + count > self.max_queue:
+                self.rejected += count
+                raise QueueFull(self._retry_after())
+            self.waiting += count
+
+    def acquire(self, limit=None):
+        ###limit: a job sharing its budget with others (comparison) asks for fewer than job_slots
+        with self._cond:
+            while self.free < 1:
+                self._cond.wait()
+            granted = min(self.job_slots, self.free, limit or self.job_slots)
+            self.free -= granted
+            self.waiting -= 1
+            self.running += 1
+            return granted
+
+    def share(self, count):
+        ###slots per job for `count` jobs meant to run side by side (never more than a single job gets)
+        return max(1, min(self.job_slots, self.slots // count))
+
+    def release(self, granted, seconds=None):
+        with self._cond:
+            self.free += granted
+            self.running -= 1
+            if seconds is not None:
+                ###moving average of job durations, only used for the Retry-After estimate
+                self._average_seconds = seconds if self._average_seconds is None \
+                    else 0.8 * self._average_seconds + 0.2 * seconds
+            self._cond.notify_all()
+
+    def _retry_after(self):
+        ###time until this request would reach the front: the jobs waiting ahead of it plus itself,
+        ###at full concurrency and the average job duration
+        per_job = self._average_seconds or 30
+        concurrency = max(1, self.slots // self.job_slots)
+        return max(1, math.ceil(per_job * (self.waiting + 1) / concurrency))
+
+    def status(self):
+        with self._cond:
+            return {'slots': self.slots, 'free_slots': self.free, 'job_slots': self.job_slots,
+                    'waiting': self.waiting, 'max_queue': self.max_queue, 'running': self.running,
+                    'rejected': self.rejected}
@@ -0,0 +1,184 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+###fastpath is the in-process caller (fastcall.py), the mummer stages are skipped when it succeeds
+STAGES = ('fastpath', 'nucmer', 'delta-filter', 'show-snps')
+
+
+class JobFailed(Exception):
+    ###raised by a runner to mark the job as failed with a json-able error payload
+    def __init__(self, error):
+        super().__init__(error.get('message', 'error'))
+        self.error = error
+
+
+class Job:
+    def __init__(self, params, queue):
+        self.id = str(uuid.uuid4())
+        self.params = params
+        self.status = 'queued'
+        self.stages = {name: {'status': 'pending'} for name in STAGES}
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0
+        ###cpu slots granted by the governor, the job runs its tools with this many threads
+        self.threads = None
+        self._queue = queue
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def _changed(self, **attrs):
+        with self._queue.changed:
+            for name, value in attrs.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._queue.changed.notify_all()
+
+    def start_stage(self, name):
+        info = self.stages.setdefault(name, {'status': 'pending'})
+        info.update(status='running', started_at=time.time())
+        self._changed()
+        return info
+
+    def finish_stage(self, name, failed=False, usage=None):
+        ###usage: cpu time / peak rss of the stage's process (procstats)
+        info = self.stages[name]
+        info.update(usage or {})
+        info.update(status='failed' if failed else 'done',
+                    seconds=round(time.time() - info['started_at'], 3))
+        self._changed()
+        return info
+
+    @contextmanager
+    def stage(self, name):
+        ###wrap one pipeline step so its progress can be polled from outside
+        info = self.start_stage(name)
+        try:
+            yield info
+        except BaseException:
+            self.finish_stage(name, failed=True)
+            raise
+        self.finish_stage(name)
+
+    def skip_stage(self, name):
+        self.stages[name]['status'] = 'skipped'
+        self._changed()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stages': [dict(info, name=name) for name, info in self.stages.items()],
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'threads': self.threads,
+            'version': self.version,
+        }
+
+
+class JobQueue:
+    ###bounded worker pool; finished jobs are kept for `keep_seconds` so they can be polled
+    def __init__(self, runner, max_workers=2, keep_seconds=3600, on_finished=None, governor=None):
+        self.runner = runner
+        self.keep_seconds = keep_seconds
+        ###admission control, submit() raises governor.QueueFull when the waiting line is full
+        self.governor = governor
+        ###called with every job that finished (also cache hits), e.g. to record metrics
+        self.on_finished = on_finished
+        self.changed = threading.Condition()
+        self._jobs = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mutation')
+
+    def submit(self, params):
+        return self.submit_group([params])[0]
+
+    def submit_group(self, params_list):
+        ###queues several jobs at once, admitted together or not at all
+        self._prune()
+        if self.governor:
+            self.governor.admit(len(params_list))
+        jobs = [Job(params, self) for params in params_list]
+        with self.changed:
+            for job in jobs:
+                self._jobs[job.id] = job
+        for job in jobs:
+            self._executor.submit(self._run, job)
+        return jobs
+
+    def add_finished(self, params, result):
+        ###register a job whose result is already known (cache hit), no stage runs
+        job = Job(params, self)
+        for info in job.stages.values():
+            info['status'] = 'skipped'
+        job.status = 'done'
+        job.result = result
+        job.started_at = job.finished_at = job.submitted_at
+        with self.changed:
+            self._jobs[job.id] = job
+        self._notify_finished(job)
+        return job
+
+    def counts(self):
+        ###jobs per status, for the queue gauges
+        with self.changed:
+            counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def get(self, job_id):
+        with self.changed:
+            return self._jobs.get(job_id)
+
+    def wait(self, job, since=None, timeout=None):
+        ###long-poll: block until the job changes past `since` (or finishes)
+        deadline = None if timeout is None else time.time() + timeout
+        with self.changed:
+            while not job.finished and (since is None or job.version <= since):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+        return job
+
+    def _run(self, job):
+        granted = self.governor.acquire(job.params.get('max_threads')) if self.governor else None
+        job._changed(status='running', started_at=time.time(), threads=granted)
+        try:
+            result = self.runner(job)
+        except JobFailed as e:
+            job._changed(status='failed', error=e.error, finished_at=time.time())
+        except Exception as e:
+            job._changed(status='failed', error={'message': 'error', 'stderr': str(e)}, finished_at=time.time())
+        else:
+            job._changed(status='done', result=result, finished_at=time.time())
+        finally:
+            if self.governor:
+                self.governor.release(granted, time.time() - job.started_at)
+        self._notify_finished(job)
+
+    def _notify_finished(self, job):
+        if self.on_finished:
+            try:
+                self.on_finished(job)
+            except Exception as e:
+                print(f'on_finished failed for job {job.id}: {e}', flush=True)
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_seconds
+        with self.changed:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and job.finished_at < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
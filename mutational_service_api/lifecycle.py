@@ -0,0 +1,197 @@
+import fnmatch
+import os
+import shutil
+import threading
+import time
+
+
+###pins are empty files in <root>/.pins named <artifact>@<owner>, so every service sharing the
+###volume can hold on to what its active jobs use; a pin older than pin_ttl is a leftover of a crash
+PINS_DIR = '.pins'
+
+###what the services leave on the shared uploads volume, relative to its root
+ARTIFACT_PATTERNS = (
+    '*.fasta', '*.fa', '*.fna', '*.fasta.gz', '*.fa.gz', '*.fna.gz',  #uploads
+    '.*.part',                                                          #aborted uploads
+    'output_*',                                                         #prokka runs
+    'mutation_*-*-*-*-*',                                               #old mummer working directories (job uuids)
+    'annotation_archives/*.zip',                                        #zips of prokka outputs
+)
+
+
+def _pin_path(root, name, owner):
+    return os.path.join(root, PINS_DIR, f"{name.replace('/', '%')}@{owner}")
+
+
+def pin(root, name, owner):
+    os.makedirs(os.path.join(root, PINS_DIR), exist_ok=True)
+    with open(_pin_path(root, name, owner), 'w'):
+        pass
+
+
+def unpin(root, name, owner):
+    try:
+        os.remove(_pin_path(root, name, owner))
+    except FileNotFoundError:
+        pass
+
+
+def entry_stats(path):
+    ###(bytes, last access) of a file or a whole directory tree; last access is the newest
+    ###atime / mtime found, since relatime mounts only move atime now and then
+    try:
+        stat = os.stat(path, follow_symlinks=False)
+    except FileNotFoundError:
+        return 0, 0
+    size, last = stat.st_size, max(stat.st_atime, stat.st_mtime)
+    if os.path.isdir(path) and not os.path.islink(path):
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, name), follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                size += stat.st_size
+                last = max(last, stat.st_atime, stat.st_mtime)
+    return size, last
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadsJanitor:
+    ###keeps the shared uploads volume under `max_bytes`: artifacts matching `patterns` that were not
+    ###touched for `ttl_seconds` go first, then the least recently used ones until the volume fits.
+    ###everything else (result cache, cohorts) counts towards the quota but is never deleted here,
+    ###the result cache has its own lru; pinned artifacts are skipped
+    def __init__(self, root, max_bytes, ttl_seconds, interval=600, patterns=ARTIFACT_PATTERNS,
+                 pin_ttl=86400, on_sweep=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.interval = interval
+        self.patterns = patterns
+        self.pin_ttl = pin_ttl
+        ###called with the stats of every sweep, e.g. to record metrics
+        self.on_sweep = on_sweep
+        self.last_sweep = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pinned(self, now=None):
+        now = now or time.time()
+        pins_dir = os.path.join(self.root, PINS_DIR)
+        names = set()
+        try:
+            entries = list(os.scandir(pins_dir))
+        except FileNotFoundError:
+            return names
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < now - self.pin_ttl:
+                    os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            names.add(entry.name.rsplit('@', 1)[0].replace('%', '/'))
+        return names
+
+    def candidates(self):
+        ###relative names of everything the patterns match, one directory level deep at most
+        names = set()
+        for pattern in self.patterns:
+            directory, basename = os.path.split(pattern)
+            try:
+                listing = os.listdir(os.path.join(self.root, directory))
+            except FileNotFoundError:
+                continue
+            names.update(os.path.join(directory, name) for name in fnmatch.filter(listing, basename))
+        return names
+
+    def volume_bytes(self):
+        return sum(entry_stats(os.path.join(self.root, name))[0] for name in os.listdir(self.root))
+
+    def sweep(self):
+        now = time.time()
+        pinned = self.pinned(now)
+        candidates = self.candidates()
+        artifacts = []
+        for name in candidates - pinned:
+            size, last = entry_stats(os.path.join(self.root, name))
+            artifacts.append((last, size, name))
+        artifacts.sort()
+
+        removed = {'ttl': 0, 'quota': 0}
+        freed = 0
+        total = self.volume_bytes()
+        kept = []
+        for last, size, name in artifacts:
+            if self.ttl_seconds and last < now - self.ttl_seconds:
+                _remove(os.path.join(self.root, name))
+                removed['ttl'] += 1
+                freed += size
+                total -= size
+            else:
+                kept.append((last, size, name))
+        for last, size, name in kept:
+            if total <= self.max_bytes:
+                break
+            _remove(os.path.join(self.root, name))
+            removed['quota'] += 1
+            freed += size
+            total -= size
+
+        stats = {'finished_at': time.time(), 'seconds': round(time.time() - now, 3),
+                 'removed': removed, 'freed_bytes': freed, 'volume_bytes': total,
+                 'max_bytes': self.max_bytes, 'pinned': len(pinned & candidates)}
+        if total > self.max_bytes:
+            print(f'Uploads volume still over quota after sweeping: {total} > {self.max_bytes} bytes', flush=True)
+        self.last_sweep = stats
+        if self.on_sweep:
+            self.on_sweep(stats)
+        return stats
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name='uploads-janitor', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f'Uploads sweep failed: {e}', flush=True)
+            self._stop.wait(self.interval)
+
+
+def purge_scratch(scratch_dir, prefix):
+    ###working directories left behind by a previous run of this service (killed mid-job)
+    try:
+        names = os.listdir(scratch_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith(prefix):
+            shutil.rmtree(os.path.join(scratch_dir, name), ignore_errors=True)
+
+
+def pick_scratch_dir(preferred, fallback, min_free_bytes):
+    ###a tmpfs scratch area is fast but small: fall back to disk when it is missing or nearly full
+    try:
+        if shutil.disk_usage(preferred).free >= min_free_bytes:
+            return preferred
+    except FileNotFoundError:
+        pass
+    return fallback
@@ -0,0 +1,76 @@
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily
+
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = tuple(2 ** power for power in range(16, 34, 2))
+
+JOBS = Counter('mutation_jobs_total', 'Finished mutation jobs', ['status', 'cached'])
+JOBS_CURRENT = Gauge('mutation_queue_jobs', 'Mutation jobs known to the queue', ['status'])
+QUEUE_WAIT = Histogram('mutation_queue_wait_seconds', 'Time from submission to start', buckets=SECONDS_BUCKETS)
+INPUT_BYTES = Histogram('mutation_input_bytes', 'Size of the query genome', buckets=BYTES_BUCKETS)
+STAGE_SECONDS = Histogram('mutation_stage_seconds', 'Wall time per pipeline stage', ['stage'],
+                          buckets=SECONDS_BUCKETS)
+STAGE_CPU = Counter('mutation_stage_cpu_seconds_total', 'Child process cpu time per pipeline stage',
+                    ['stage', 'mode'])
+STAGE_MAX_RSS = Histogram('mutation_stage_max_rss_bytes', 'Peak resident memory per pipeline stage', ['stage'],
+                          buckets=BYTES_BUCKETS)
+ENGINE = Counter('mutation_engine_jobs_total', 'Computed mutation jobs by snp caller (fastpath or mummer)',
+                 ['engine'])
+SLOTS = Gauge('mutation_governor_slots', 'Cpu slots of the admission governor', ['state'])
+WAITING = Gauge('mutation_governor_waiting', 'Admitted jobs waiting for slots')
+UPLOADS_BYTES = Gauge('uploads_volume_bytes', 'Bytes on the shared uploads volume after the last sweep')
+UPLOADS_REMOVED = Counter('uploads_removed_total', 'Artifacts removed from the uploads volume', ['reason'])
+UPLOADS_FREED = Counter('uploads_freed_bytes_total', 'Bytes freed on the uploads volume')
+
+
+class RejectedCollector:
+    ###the governor keeps the count of its 429s, read at scrape time and exposed as a counter (_total)
+    def __init__(self, governor):
+        self.governor = governor
+
+    def collect(self):
+        yield CounterMetricFamily('mutation_governor_rejected', 'Submissions rejected with 429',
+                                  value=self.governor.status()['rejected'])
+
+
+def watch_governor(governor, registry=REGISTRY):
+    registry.register(RejectedCollector(governor))
+
+
+def record_job(job):
+    ###JobQueue on_finished hook; cache hits only count as jobs, they ran no stage
+    cached = bool(job.result and job.result.get('cached'))
+    JOBS.labels(status=job.status, cached=str(cached).lower()).inc()
+    if job.params.get('input_bytes') is not None:
+        INPUT_BYTES.observe(job.params['input_bytes'])
+    if cached or job.started_at is None:
+        return
+    QUEUE_WAIT.observe(job.started_at - job.submitted_at)
+    if job.result:
+        ENGINE.labels(engine=job.result.get('engine', 'mummer')).inc()
+    for name, info in job.stages.items():
+        if 'seconds' not in info:
+            continue
+        STAGE_SECONDS.labels(stage=name).observe(info['seconds'])
+        if 'cpu_user_seconds' in info:
+            STAGE_CPU.labels(stage=name, mode='user').inc(info['cpu_user_seconds'])
+            STAGE_CPU.labels(stage=name, mode='system').inc(info['cpu_system_seconds'])
+            STAGE_MAX_RSS.labels(stage=name).observe(info['max_rss_bytes'])
+
+
+def update_queue(counts, governor=None):
+    for status, count in counts.items():
+        JOBS_CURRENT.labels(status=status).set(count)
+    if governor:
+        SLOTS.labels(state='total').set(governor['slots'])
+        SLOTS.labels(state='free').set(governor['free_slots'])
+        WAITING.set(governor['waiting'])
+
+
+def record_sweep(stats):
+    ###UploadsJanitor on_sweep hook
+    UPLOADS_BYTES.set(stats['volume_bytes'])
+    for reason, count in stats['removed'].items():
+        UPLOADS_REMOVED.labels(reason=reason).inc(count)
+    UPLOADS_FREED.inc(stats['freed_bytes'])
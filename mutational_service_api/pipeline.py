@@ -0,0 +1,193 @@
+import os
+import shutil
+import subprocess
+import threading
+
+from compressed import open_fasta
+from jobs import JobFailed
+from procstats import run_with_usage, wait_with_usage
+from snpstore import write_snp_store
+
+
+SNP_FIELDS = ('pos_ref', 'ref_base', 'pos_query', 'query_base', 'ref_name', 'query_name')
+
+
+def iter_snps(lines):
+    ###incremental parser for `show-snps` output, yields one compact tuple per snp (see SNP_FIELDS);
+    ###columns are [P1] [SUB] [SUB] [P2] ... [TAGS], so the query base comes before the query position
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(('=', '/', 'NUCMER', '[')):
+            continue  #skip headers, comments, and empty lines
+        fields = stripped.split()
+        if len(fields) >= 8:
+            yield (int(fields[0]), fields[1], int(fields[3]), fields[2], fields[-2], fields[-1])
+
+
+def snp_dict(record):
+    return dict(zip(SNP_FIELDS, record))
+
+
+def parse_snps_file(show_snps_file):
+    with open(show_snps_file, 'r') as f:
+        return [snp_dict(record) for record in iter_snps(f)]
+
+
+def _tee_lines(lines, copy):
+    for line in lines:
+        if copy:
+            copy.write(line)
+        yield line
+
+
+def _read_stderr(path):
+    with open(path) as f:
+        return f.read()
+
+
+def run_nucmer(job, params, reference_path, file_path, workdir, index_prefix=None):
+    ###nucmer has to write its delta to a file, it goes to the (local) scratch directory
+    prefix = f'mutation_{job.id}'
+    ###the thread count comes from the slots the governor granted, it is not part of the cache key
+    threads = ['--threads', str(job.threads)] if job.threads else []
+    ###with a saved suffix array (registry.py) the reference is loaded instead of indexed again
+    reference = ['--load', index_prefix] if index_prefix else [reference_path]
+    nucmer_cmd = ['nucmer', *params['nucmer'], *threads, '--prefix', prefix, *reference, file_path]
+    with job.stage('nucmer') as info:
+        result, usage = run_with_usage(
+            nucmer_cmd,
+            cwd=workdir,  # run inside the scratch directory
+        )
+        info.update(usage)
+        if result.returncode != 0:
+            raise JobFailed({'message': 'error', 'stderr': result.stderr})
+
+    delta_file = os.path.join(workdir, f'{prefix}.delta')
+    if not os.path.exists(delta_file):
+        raise JobFailed({'message': 'error', 'stderr': 'nucmer did not produce a delta file'})
+    if index_prefix:
+        set_delta_paths(delta_file, reference_path, file_path)
+    return delta_file, result.stderr
+
+
+def set_delta_paths(delta_file, reference_path, query_path):
+    ###show-snps reads the sequences from the paths on the first line of the delta; after --load that
+    ###line names the reference as it was when the index was saved, it is pointed at the registered file
+    header = f'{reference_path} {query_path}\n'
+    partial_path = f'{delta_file}.part'
+    with open(delta_file) as f:
+        if f.readline() == header:
+            return
+        with open(partial_path, 'w') as out:
+            out.write(header)
+            shutil.copyfileobj(f, out)
+    os.replace(partial_path, delta_file)
+
+
+def call_snps_piped(job, params, delta_file, workdir, store_path, snps_copy=None):
+    ###delta-filter | show-snps through an os pipe; show-snps stdout is parsed while it is produced
+    ###straight into the columnar store at `store_path`, the raw text only hits the disk when `snps_copy` asks for the artifact
+    df_stderr_path = os.path.join(workdir, 'delta-filter.stderr')
+    snps_stderr_path = os.path.join(workdir, 'show-snps.stderr')
+
+    with open(df_stderr_path, 'w') as df_stderr, open(snps_stderr_path, 'w') as snps_stderr:
+        job.start_stage('delta-filter')
+        job.start_stage('show-snps')
+        delta_filter = subprocess.Popen(['delta-filter', *params['delta-filter'], delta_file],
+                                        stdout=subprocess.PIPE, stderr=df_stderr)
+        show_snps = subprocess.Popen(['show-snps', *params['show-snps'], '/dev/stdin'],
+                                     stdin=delta_filter.stdout, stdout=subprocess.PIPE,
+                                     stderr=snps_stderr, text=True)
+        ###only show-snps may read the pipe now
+        delta_filter.stdout.close()
+
+        def finish_delta_filter():
+            usage = wait_with_usage(delta_filter)
+            job.finish_stage('delta-filter', failed=delta_filter.returncode != 0, usage=usage)
+        waiter = threading.Thread(target=finish_delta_filter, daemon=True)
+        waiter.start()
+
+        try:
+            copy = open(snps_copy, 'w') if snps_copy else None
+            try:
+                snp_count = write_snp_store(iter_snps(_tee_lines(show_snps.stdout, copy)), store_path)
+            finally:
+                if copy:
+                    copy.close()
+        finally:
+            show_snps.stdout.close()
+            usage = wait_with_usage(show_snps)
+            waiter.join()
+        job.finish_stage('show-snps', failed=show_snps.returncode != 0, usage=usage)
+
+    if delta_filter.returncode != 0:
+        raise JobFailed({'message': 'error', 'stderr': _read_stderr(df_stderr_path)})
+    if show_snps.returncode != 0:
+        raise JobFailed({'message': 'error', 'stderr': _read_stderr(snps_stderr_path)})
+    return snp_count
+
+
+def call_snps_files(job, params, delta_file, workdir, store_path):
+    ###the original file-to-file chain, kept as MUTATION_EXEC_MODE=files
+    delta_filter_file = os.path.join(workdir, f'mutation_{job.id}.delta_filter')
+    show_snps_file = os.path.join(workdir, f'mutation_{job.id}.snps')
+    with job.stage('delta-filter') as info, open(delta_filter_file, 'w') as df_outfile:
+        result, usage = run_with_usage(['delta-filter', *params['delta-filter'], delta_file], stdout=df_outfile)
+        info.update(usage)
+        if result.returncode != 0:
+            raise JobFailed({'message': 'error', 'stderr': result.stderr})
+    ###lets ensure the delta-filter file is not empty
+    if not os.path.getsize(delta_filter_file) > 0:
+        raise JobFailed({'message': 'error', 'stderr': 'delta-filter produced an empty file'})
+
+    with job.stage('show-snps') as info, open(show_snps_file, 'w') as snps_outfile:
+        result, usage = run_with_usage(['show-snps', *params['show-snps'], delta_filter_file], stdout=snps_outfile)
+        info.update(usage)
+        if result.returncode != 0:
+            raise JobFailed({'message': 'error', 'stderr': result.stderr})
+
+    with open(show_snps_file) as f:
+        snp_count = write_snp_store(iter_snps(f), store_path)
+    return snp_count, show_snps_file
+
+
+def alignment_summary(query_bases, aligned_bases, errors, alignment_length):
+    ###aligned fraction of the query and identity over the aligned part (mismatches and indel bases as errors)
+    return {'query_bases': query_bases, 'aligned_bases': aligned_bases,
+            'aligned_fraction': round(aligned_bases / query_bases, 6) if query_bases else 0.0,
+            'identity': round(1 - errors / alignment_length, 6) if alignment_length else None}
+
+
+def fasta_bases(path):
+    ###total sequence length of a (possibly gzipped) fasta, streamed
+    with open_fasta(path) as f:
+        return sum(len(line.strip()) for line in f if not line.startswith(b'>'))
+
+
+def delta_alignment(delta_file, query_path):
+    ###alignment_summary of a nucmer delta: query bases covered by at least one alignment, errors over the
+    ###mean of the reference and query extent of every alignment. the unfiltered delta is used (the pipe
+    ###mode never writes the filtered one), so repeats aligned twice count twice towards identity
+    intervals = {}
+    errors = alignment_length = 0
+    query = None
+    with open(delta_file) as f:
+        for line in f:
+            if line.startswith('>'):
+                query = line[1:].split()[1]
+                continue
+            fields = line.split()
+            if len(fields) != 7 or query is None:
+                continue
+            ref_start, ref_end, query_start, query_end, alignment_errors = map(int, fields[:5])
+            intervals.setdefault(query, []).append((min(query_start, query_end), max(query_start, query_end)))
+            errors += alignment_errors
+            alignment_length += (abs(ref_end - ref_start) + abs(query_end - query_start)) / 2 + 1
+    aligned = 0
+    for spans in intervals.values():
+        covered_to = 0
+        for start, end in sorted(spans):
+            if end > covered_to:
+                aligned += end - max(start - 1, covered_to)
+                covered_to = end
+    return alignment_summary(fasta_bases(query_path), aligned, errors, alignment_length)
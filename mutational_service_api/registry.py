@@ -0,0 +1,291 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from cache import file_digest
+from compressed import open_fasta
+from fastcall import load_reference_index
+from features import load_feature_index
+from sketch import reference_name
+
+
+###bump when the metadata or the index layout changes, older index folders are rebuilt
+INDEX_VERSION = 1
+CHUNK_SIZE = 1 << 20
+###bases of the reference aligned against a freshly saved nucmer index to check it loads
+PROBE_BASES = 2000
+
+
+def reference_metadata(path):
+    ###records, total length, gc content and the description of the first record header
+    records, description = [], ''
+    length = gc = 0
+    with open_fasta(path) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                header = line[1:].strip().decode(errors='replace')
+                name, _, text = header.partition(' ')
+                if not records:
+                    description = text
+                records.append({'id': name, 'length': 0})
+            elif records:
+                sequence = line.strip().upper()
+                records[-1]['length'] += len(sequence)
+                length += len(sequence)
+                gc += sequence.count(b'G') + sequence.count(b'C')
+    return {'records': records, 'length': length, 'gc_content': round(gc / length, 4) if length else 0.0,
+            'description': description}
+
+
+def build_nucmer_index(reference_path, prefix):
+    ###nucmer --save writes the suffix array of the reference, jobs --load it instead of rebuilding it.
+    ###built in a temporary folder and checked by aligning the start of the reference against it, so
+    ###an index this nucmer cannot load never reaches a job
+    folder = os.path.dirname(prefix)
+    workdir = tempfile.mkdtemp(prefix='.nucmer-', dir=folder)
+    try:
+        saved = os.path.join(workdir, os.path.basename(prefix))
+        result = subprocess.run(['nucmer', '--save', saved, reference_path], capture_output=True, text=True)
+        if result.returncode != 0:
+            raise OSError(f'nucmer --save failed: {result.stderr.strip()}')
+        files = os.listdir(workdir)
+
+        probe = os.path.join(workdir, 'probe.fasta')
+        with open_fasta(reference_path) as f, open(probe, 'wb') as out:
+            out.write(b'>probe\n')
+            written = 0
+            for line in f:
+                if line.startswith(b'>'):
+                    if written:
+                        break
+                    continue
+                out.write(line.strip() + b'\n')
+                written += len(line.strip())
+                if written >= PROBE_BASES:
+                    break
+        result = subprocess.run(['nucmer', '--prefix', 'probe', '--load', saved, probe], cwd=workdir,
+                                capture_output=True, text=True)
+        if result.returncode != 0 or not os.path.exists(os.path.join(workdir, 'probe.delta')):
+            raise OSError(f'nucmer --load failed: {result.stderr.strip()}')
+
+        for name in files:
+            os.replace(os.path.join(workdir, name), os.path.join(folder, name))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class ReferenceRegistry:
+    ###the reference fasta files of `references_dir` with their sha256 and metadata. everything derived
+    ###from a reference lives in `index_dir`/<sha256>/ (meta.json, the nucmer suffix array), so a changed
+    ###file gets new indexes and an unchanged one is prepared once, not at every start or job.
+    ###the `hot` most recently used references keep their in-memory indexes (k-mer anchors, features)
+    ###loaded: every use touches them in those lru caches of 8, so with `hot` below that a hot reference
+    ###is only evicted by more than 8 - hot other references loaded since its last use
+    def __init__(self, references_dir, index_dir, hot=4, nucmer_index=True):
+        self.references_dir = references_dir
+        self.index_dir = index_dir
+        self.hot = max(1, min(hot, 8))
+        self.nucmer_index = nucmer_index
+        self._entries = {}
+        self._protein_only = []
+        self._used = OrderedDict()
+        self._building = set()
+        self._failed = {}
+        self._warmed = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _folder(self, sha256):
+        return os.path.join(self.index_dir, sha256)
+
+    def _load_entry(self, filename, stat):
+        path = os.path.join(self.references_dir, filename)
+        sha256 = file_digest(path)
+        folder = self._folder(sha256)
+        meta_path = os.path.join(folder, 'meta.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get('version') != INDEX_VERSION:
+                raise ValueError('old index version')
+        except (OSError, ValueError):
+            meta = dict(reference_metadata(path), version=INDEX_VERSION)
+            os.makedirs(folder, exist_ok=True)
+            with open(f'{meta_path}.part', 'w') as f:
+                json.dump(meta, f)
+            os.replace(f'{meta_path}.part', meta_path)
+        return {'name': reference_name(filename), 'file': filename, 'sha256': sha256, 'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns, 'records': meta['records'], 'length': meta['length'],
+                'gc_content': meta['gc_content'], 'description': meta['description'],
+                'proteins': os.path.isfile(os.path.join(self.references_dir, f'{reference_name(filename)}.faa'))}
+
+    def scan(self):
+        ###a directory listing plus a stat per file; only new or changed files are hashed and parsed
+        entries = {}
+        filenames = sorted(os.listdir(self.references_dir))
+        for filename in filenames:
+            if not reference_name(filename):
+                continue
+            stat = os.stat(os.path.join(self.references_dir, filename))
+            entry = self._entries.get(filename)
+            if entry is None or (entry['size'], entry['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+                try:
+                    entry = self._load_entry(filename, stat)
+                except OSError as e:
+                    print(f'Could not register reference {filename}: {e}', flush=True)
+                    continue
+            entries[filename] = entry
+        ###proteins without a fasta can still be annotated against, they are listed but get no indexes
+        names = {entry['name'] for entry in entries.values()}
+        protein_only = [filename[:-len('.faa')] for filename in filenames
+                        if filename.endswith('.faa') and filename[:-len('.faa')] not in names]
+        with self._lock:
+            self._entries = entries
+            self._protein_only = protein_only
+        return list(entries.values())
+
+    def get(self, filename):
+        with self._lock:
+            return self._entries.get(filename)
+
+    def nucmer_prefix(self, filename):
+        ###prefix to pass to nucmer --load, None while the index is missing (the job aligns without it)
+        entry = self.get(filename)
+        if entry is None or not self.nucmer_index:
+            return None
+        ###a file changed since the last scan must not get the index of its old content
+        try:
+            stat = os.stat(os.path.join(self.references_dir, filename))
+        except OSError:
+            return None
+        if (stat.st_size, stat.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+            return None
+        prefix = os.path.join(self._folder(entry['sha256']), 'nucmer')
+        return prefix if os.path.exists(f'{prefix}.ok') else None
+
+    def _build(self, entries):
+        ###one after the other, a burst of nucmer --save runs would compete with the jobs
+        for entry in entries:
+            prefix = os.path.join(self._folder(entry['sha256']), 'nucmer')
+            try:
+                if self.nucmer_index and not os.path.exists(f'{prefix}.ok'):
+                    started = time.perf_counter()
+                    build_nucmer_index(os.path.join(self.references_dir, entry['file']), prefix)
+                    with open(f'{prefix}.ok', 'w') as f:
+                        f.write(f'{time.perf_counter() - started:.3f}\n')
+            except OSError as e:
+                ###not retried for this checksum, jobs align against the fasta
+                print(f"Could not index reference {entry['file']}: {e}", flush=True)
+                with self._lock:
+                    self._failed[entry['sha256']] = str(e)
+            finally:
+                with self._lock:
+                    self._building.discard(entry['sha256'])
+        self.warm()
+
+    def prepare(self):
+        ###registers the references and builds the missing persisted indexes in the background,
+        ###then loads the hot ones; called at startup and then every rescan interval
+        entries = self.scan()
+        with self._lock:
+            pending = [entry for entry in entries if self.nucmer_index and entry['sha256'] not in self._building
+                       and entry['sha256'] not in self._failed
+                       and not os.path.exists(os.path.join(self._folder(entry['sha256']), 'nucmer.ok'))]
+            self._building.update(entry['sha256'] for entry in pending)
+            start = pending or not self._warmed
+            self._warmed = True
+        self.prune()
+        if start:
+            threading.Thread(target=self._build, args=(pending,), daemon=True).start()
+
+    def start(self, interval):
+        ###prepare now and again every `interval` seconds, so references dropped into the folder
+        ###get registered without a restart
+        threading.Thread(target=self._loop, args=(interval,), name='reference-registry', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, interval):
+        while not self._stop.is_set():
+            try:
+                self.prepare()
+            except Exception as e:
+                print(f'Reference scan failed: {e}', flush=True)
+            self._stop.wait(interval)
+
+    def prune(self):
+        ###index folders of references that are gone or changed
+        with self._lock:
+            current = {entry['sha256'] for entry in self._entries.values()} | self._building
+        try:
+            names = os.listdir(self.index_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if len(name) == 64 and name not in current:
+                shutil.rmtree(os.path.join(self.index_dir, name), ignore_errors=True)
+
+    def use(self, filename):
+        ###marks a reference as used by a job and loads its in-memory indexes (a cache hit unless it
+        ###was cold), which also makes them the most recent entries of the lru caches
+        with self._lock:
+            self._used.pop(filename, None)
+            self._used[filename] = time.time()
+            while len(self._used) > self.hot:
+                self._used.popitem(last=False)
+        self._load(filename)
+
+    def _load(self, filename):
+        path = os.path.join(self.references_dir, filename)
+        try:
+            load_reference_index(path)
+            load_feature_index(path)
+        except (OSError, ValueError) as e:
+            print(f'Could not load the indexes of reference {filename}: {e}', flush=True)
+            return False
+        return True
+
+    def warm(self, filenames=None):
+        ###loads the in-memory indexes (k-mer anchors for the fast path, features for annotation)
+        ###and reads the nucmer index once, so the first job does not pay for it
+        if filenames is None:
+            ###the recently used ones, or at startup the first few
+            with self._lock:
+                filenames = list(self._used)
+            filenames = filenames or [entry['file'] for entry in self.scan()][:self.hot]
+        for filename in filenames:
+            if not self._load(filename):
+                continue
+            prefix = self.nucmer_prefix(filename)
+            if not prefix:
+                continue
+            folder = os.path.dirname(prefix)
+            try:
+                for name in os.listdir(folder):
+                    if name.startswith('nucmer'):
+                        with open(os.path.join(folder, name), 'rb') as f:
+                            while f.read(CHUNK_SIZE):
+                                pass
+            except OSError as e:
+                print(f'Could not warm reference {filename}: {e}', flush=True)
+
+    def status(self, entry):
+        with self._lock:
+            hot = entry['file'] in self._used
+            error = self._failed.get(entry['sha256'])
+        return {'nucmer_index': self.nucmer_prefix(entry['file']) is not None, 'index_error': error, 'hot': hot}
+
+    def list(self):
+        ###what the last scan found, a read never scans, builds or prunes
+        with self._lock:
+            entries = list(self._entries.values())
+            protein_only = list(self._protein_only)
+        return [dict(entry, **self.status(entry)) for entry in entries] + \
+            [{'name': name, 'file': None, 'proteins': True, 'description': ''} for name in protein_only]
@@ -0,0 +1,194 @@
+import io
+import json
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from compressed import open_fasta
+
+
+K = 21
+SKETCH_SIZE = 1000
+REFERENCE_SUFFIXES = ('.fasta', '.fa', '.fna', '.fasta.gz', '.fa.gz', '.fna.gz')
+
+###2-bit codes for ACGT (both cases), 4 for everything else (N, IUPAC codes, gaps)
+CODES = np.full(256, 4, dtype=np.uint8)
+for code, letters in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for letter in letters:
+        CODES[ord(letter)] = code
+
+
+def read_named_records(path):
+    ###(record id, sequence) of a (possibly gzipped) fasta, sequences as upper-case bytes
+    records = []
+    with open_fasta(path) as f:
+        for line in f:
+            if line.startswith(b'>'):
+                records.append((line[1:].split(maxsplit=1)[0].decode() if len(line) > 1 else '', []))
+            elif records:
+                records[-1][1].append(line.strip())
+    return [(name, b''.join(chunks).upper()) for name, chunks in records]
+
+
+def read_records(path):
+    return [sequence for _, sequence in read_named_records(path)]
+
+
+def _mix64(values):
+    ###murmur3 finalizer, spreads k-mer codes uniformly over 64 bits (uint64 arithmetic wraps)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ (values >> np.uint64(33))
+
+
+def packed_kmers(sequence, k=K):
+    ###(forward, reverse complement, valid) 2-bit packed k-mers starting at every position, k <= 32 so
+    ###a k-mer fits a uint64; valid is False where the k-mer holds an ambiguous base. k-mers are built by
+    ###doubling (2L-mers from pairs of L-mers) and assembled from the binary digits of k, a handful of
+    ###array passes instead of one per base
+    codes = CODES[np.frombuffer(sequence, dtype=np.uint8)]
+    count = codes.size - k + 1
+    if count <= 0:
+        empty = np.empty(0, dtype=np.uint64)
+        return empty, empty, np.empty(0, dtype=bool)
+    invalid = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = invalid[k:] - invalid[:-k] == 0
+    block_forward = np.where(codes > 3, 0, codes).astype(np.uint64)
+    block_reverse = np.uint64(3) - block_forward
+    block_length, forward, reverse, length = 1, None, None, 0
+    remaining = k
+    while True:
+        if remaining & 1:
+            if forward is None:
+                forward, reverse, length = block_forward, block_reverse, block_length
+            else:
+                ###the accumulated k-mer followed by the block that starts right after it
+                size = codes.size - length - block_length + 1
+                shift = np.uint64(2 * block_length)
+                forward = (forward[:size] << shift) | block_forward[length:length + size]
+                reverse = reverse[:size] | (block_reverse[length:length + size] << np.uint64(2 * length))
+                length += block_length
+        remaining >>= 1
+        if not remaining:
+            break
+        shift = np.uint64(2 * block_length)
+        block_forward = (block_forward[:-block_length] << shift) | block_forward[block_length:]
+        block_reverse = block_reverse[:-block_length] | (block_reverse[block_length:] << shift)
+        block_length *= 2
+    return forward, reverse, valid
+
+
+def kmer_hashes(sequence, k=K):
+    ###hashes of all canonical k-mers (min of forward and reverse complement) without an ambiguous base
+    forward, reverse, valid = packed_kmers(sequence, k)
+    return _mix64(np.minimum(forward, reverse)[valid])
+
+
+def sketch(records, k=K, size=SKETCH_SIZE):
+    ###bottom-`size` minhash sketch: the smallest distinct k-mer hashes over all records, sorted
+    hashes = np.concatenate([kmer_hashes(sequence, k) for sequence in records] or [np.empty(0, dtype=np.uint64)])
+    if hashes.size > 2 * size:
+        smallest = np.unique(np.partition(hashes, 2 * size)[:2 * size])
+        if smallest.size >= size:
+            return smallest[:size]
+    return np.unique(hashes)[:size]
+
+
+def compare(query, reference, k=K, size=SKETCH_SIZE):
+    ###mash: jaccard estimated on the bottom sketch of the union, distance -1/k ln(2j / (1 + j))
+    union = np.union1d(query, reference)[:size]
+    if not union.size:
+        return {'jaccard': 0.0, 'distance': 1.0, 'identity': 0.0, 'shared_hashes': 0, 'sketch_size': 0}
+    shared = int(np.count_nonzero(np.intersect1d(query, reference, assume_unique=True) <= union[-1]))
+    jaccard = shared / union.size
+    distance = 1.0 if shared == 0 else min(1.0, -math.log(2 * jaccard / (1 + jaccard)) / k)
+    return {'jaccard': round(jaccard, 4), 'distance': round(distance, 6), 'identity': round(1 - distance, 6),
+            'shared_hashes': shared, 'sketch_size': int(union.size)}
+
+
+def reference_name(filename):
+    for suffix in REFERENCE_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return None
+
+
+class SketchIndex:
+    ###sketches of every reference fasta in `references_dir`, kept in memory and in `cache_path`
+    ###(an npz keyed by file size / mtime and the sketch parameters), so a restart only sketches
+    ###references that were added or changed; refresh() is a directory listing when nothing did
+    def __init__(self, references_dir, cache_path, k=K, size=SKETCH_SIZE):
+        self.references_dir = references_dir
+        self.cache_path = cache_path
+        self.k = k
+        self.size = size
+        self._sketches = {}
+        self._meta = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with np.load(self.cache_path) as cached:
+                meta = json.loads(str(cached['meta']))
+                sketches = {filename: cached[f'sketch_{index}'] for index, filename in enumerate(meta)}
+        except (OSError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f'Ignoring sketch cache {self.cache_path}: {e}', flush=True)
+            return
+        self._meta, self._sketches = meta, sketches
+
+    def _save_cache(self):
+        arrays = {f'sketch_{index}': self._sketches[filename] for index, filename in enumerate(self._meta)}
+        buffer = io.BytesIO()
+        np.savez(buffer, meta=np.array(json.dumps(self._meta)), **arrays)
+        partial_path = f'{self.cache_path}.part'
+        with open(partial_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.replace(partial_path, self.cache_path)
+
+    def refresh(self):
+        files = {}
+        for filename in sorted(os.listdir(self.references_dir)):
+            if reference_name(filename):
+                stat = os.stat(os.path.join(self.references_dir, filename))
+                files[filename] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'k': self.k,
+                                   'sketch_size': self.size}
+        with self._lock:
+            if files == self._stamp:
+                return
+            changed = False
+            for filename, meta in files.items():
+                if self._meta.get(filename) != meta:
+                    self._sketches[filename] = sketch(read_records(os.path.join(self.references_dir, filename)),
+                                                      self.k, self.size)
+                    self._meta[filename] = meta
+                    changed = True
+            for filename in set(self._meta) - set(files):
+                del self._meta[filename], self._sketches[filename]
+                changed = True
+            if changed:
+                try:
+                    self._save_cache()
+                except OSError as e:
+                    print(f'Could not write sketch cache {self.cache_path}: {e}', flush=True)
+            self._stamp = files
+
+    def classify(self, path):
+        ###references ranked by mash distance to the genome at `path`, closest first
+        started = time.perf_counter()
+        self.refresh()
+        query = sketch(read_records(path), self.k, self.size)
+        with self._lock:
+            sketches = dict(self._sketches)
+        ranking = [dict(compare(query, reference_sketch, self.k, self.size), reference=reference_name(filename),
+                        file=filename)
+                   for filename, reference_sketch in sketches.items()]
+        ranking.sort(key=lambda entry: (entry['distance'], -entry['shared_hashes'], entry['reference']))
+        return ranking, time.perf_counter() - started
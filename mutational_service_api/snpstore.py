@@ -0,0 +1,213 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+import numpy as np
+
+
+###file layout (little endian):
+###  header  MAGIC, version, row count, names-table length (bytes), names json (padded to 8 bytes)
+###  columns pos_ref u32[n] | pos_query u32[n] | ref_name u16[n] | query_name u16[n] | ref_base u8[n] | query_base u8[n]
+###rows are sorted by (ref_name, pos_ref) so a range on one reference is two binary searches
+MAGIC = b'SNPC'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+###columns a page can be sorted by
+SORT_FIELDS = ('pos_ref', 'ref_base', 'pos_query', 'query_base', 'ref_name', 'query_name')
+
+
+def _padded(length):
+    return (length + 7) & ~7
+
+
+class SnpStoreWriter:
+    def __init__(self, path):
+        self.path = path
+        self.names = {}
+        self.pos_ref = array('I')
+        self.pos_query = array('I')
+        self.ref_name = array('H')
+        self.query_name = array('H')
+        self.ref_base = bytearray()
+        self.query_base = bytearray()
+        self._sorted = True
+        self._last_key = None
+
+    def _name_index(self, name):
+        index = self.names.get(name)
+        if index is None:
+            index = self.names[name] = len(self.names)
+        return index
+
+    def add(self, record):
+        ###record is a compact tuple from pipeline.iter_snps
+        pos_ref, ref_base, pos_query, query_base, ref_name, query_name = record
+        ref_index = self._name_index(ref_name)
+        key = (ref_index, pos_ref)
+        if self._last_key is not None and key < self._last_key:
+            self._sorted = False
+        self._last_key = key
+        self.pos_ref.append(pos_ref)
+        self.pos_query.append(pos_query)
+        self.ref_name.append(ref_index)
+        self.query_name.append(self._name_index(query_name))
+        self.ref_base += ref_base[:1].encode('ascii')
+        self.query_base += query_base[:1].encode('ascii')
+
+    def __len__(self):
+        return len(self.pos_ref)
+
+    def close(self):
+        columns = [self.pos_ref, self.pos_query, self.ref_name, self.query_name, self.ref_base, self.query_base]
+        if not self._sorted:
+            ###show-snps -r already sorts by reference position, this only matters for other producers
+            order = sorted(range(len(self)), key=lambda row: (self.ref_name[row], self.pos_ref[row], self.pos_query[row]))
+            columns = [type(column)(column.typecode, (column[row] for row in order)) if isinstance(column, array)
+                       else bytearray(column[row] for row in order) for column in columns]
+
+        names = json.dumps(sorted(self.names, key=self.names.get)).encode()
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self), len(names)))
+            f.write(names.ljust(_padded(len(names)), b' '))
+            for column in columns:
+                f.write(column.tobytes() if isinstance(column, array) else bytes(column))
+        return len(self)
+
+
+def write_snp_store(records, path):
+    writer = SnpStoreWriter(path)
+    for record in records:
+        writer.add(record)
+    return writer.close()
+
+
+class SnpStore:
+    ###read side: the file is memory-mapped and every column is a typed memoryview over the map,
+    ###nothing is parsed or copied until rows are actually requested
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, names_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a snp store')
+        offset = HEADER.size
+        self.names = json.loads(self._map[offset:offset + names_length])
+        self._name_index = {name: index for index, name in enumerate(self.names)}
+        offset += _padded(names_length)
+
+        view = memoryview(self._map)
+        self.count_all = count
+        self.pos_ref, offset = view[offset:offset + 4 * count].cast('I'), offset + 4 * count
+        self.pos_query, offset = view[offset:offset + 4 * count].cast('I'), offset + 4 * count
+        self.ref_name, offset = view[offset:offset + 2 * count].cast('H'), offset + 2 * count
+        self.query_name, offset = view[offset:offset + 2 * count].cast('H'), offset + 2 * count
+        self.ref_base, offset = view[offset:offset + count], offset + count
+        self.query_base = view[offset:offset + count]
+
+    def ref_names(self):
+        return sorted({self.names[index] for index in set(self.ref_name)}) if self.count_all else []
+
+    def bounds(self, ref_name=None, start=None, end=None):
+        ###row slice [lo, hi) for one reference and an inclusive 1-based position range
+        if ref_name is None:
+            if start is not None or end is not None:
+                raise ValueError('a position range needs a ref_name')
+            return 0, self.count_all
+        index = self._name_index.get(ref_name)
+        if index is None:
+            return 0, 0
+        lo = bisect_left(self.ref_name, index)
+        hi = bisect_right(self.ref_name, index, lo)
+        if start is not None:
+            lo = bisect_left(self.pos_ref, start, lo, hi)
+        if end is not None:
+            hi = bisect_right(self.pos_ref, end, lo, hi)
+        return lo, hi
+
+    def count(self, ref_name=None, start=None, end=None):
+        lo, hi = self.bounds(ref_name, start, end)
+        return hi - lo
+
+    def record(self, row):
+        return (self.pos_ref[row], chr(self.ref_base[row]), self.pos_query[row], chr(self.query_base[row]),
+                self.names[self.ref_name[row]], self.names[self.query_name[row]])
+
+    def rows(self, lo, hi):
+        for row in range(lo, hi):
+            yield self.record(row)
+
+    def column(self, field):
+        ###a column as a numpy array over the map (no copy); name columns as the alphabetical rank of
+        ###the name, so they sort by name
+        if field in ('ref_name', 'query_name'):
+            ranks = np.empty(len(self.names), dtype=np.int64)
+            ranks[np.argsort(np.array(self.names, dtype=str), kind='stable')] = np.arange(len(self.names))
+            return ranks[np.frombuffer(getattr(self, field), dtype=np.uint16)]
+        dtype = {'pos_ref': np.uint32, 'pos_query': np.uint32, 'ref_base': np.uint8, 'query_base': np.uint8}[field]
+        return np.frombuffer(getattr(self, field), dtype=dtype)
+
+    def select(self, ref_name=None, start=None, end=None, ref_base=None, query_base=None, sort=None,
+               descending=False):
+        ###row numbers matching the filters, in the requested order (ties keep the store order);
+        ###without a ref_name the position range applies to every reference
+        if sort is not None and sort not in SORT_FIELDS:
+            raise ValueError(f'cannot sort by {sort}')
+        for base in (ref_base, query_base):
+            if base is not None and len(base) != 1:
+                raise ValueError(f'invalid base: {base}')
+        if ref_name is not None:
+            lo, hi = self.bounds(ref_name, start, end)
+            rows = np.arange(lo, hi)
+        else:
+            rows = np.arange(self.count_all)
+            if start is not None or end is not None:
+                positions = self.column('pos_ref')
+                mask = np.ones(self.count_all, dtype=bool)
+                if start is not None:
+                    mask &= positions >= start
+                if end is not None:
+                    mask &= positions <= end
+                rows = rows[mask]
+        for field, base in (('ref_base', ref_base), ('query_base', query_base)):
+            if base is not None and rows.size:
+                rows = rows[self.column(field)[rows] == ord(base.upper())]
+        if sort is not None and rows.size:
+            keys = self.column(sort)[rows].astype(np.int64)
+            rows = rows[np.lexsort((rows, -keys if descending else keys))]
+        elif descending:
+            rows = rows[::-1]
+        return rows
+
+    def query(self, ref_name=None, start=None, end=None, offset=0, limit=100, ref_base=None, query_base=None,
+              sort=None, descending=False):
+        ###one page, returns (total matching rows, records of the page). a range on one reference in
+        ###store order is two binary searches, anything else is a numpy scan of the mapped columns
+        offset, limit = max(offset, 0), max(limit, 0)
+        ###the store order is pos_ref order only within one reference, the references themselves
+        ###come in the order they were first seen
+        single = ref_name is not None or not self.count_all or self.ref_name[0] == self.ref_name[-1]
+        in_order = sort is None or (sort == 'pos_ref' and single)
+        if ref_base is None and query_base is None and in_order and not descending and \
+                (ref_name is not None or (start is None and end is None)):
+            lo, hi = self.bounds(ref_name, start, end)
+            page_lo = min(hi, lo + offset)
+            page_hi = min(hi, page_lo + limit)
+            return hi - lo, list(self.rows(page_lo, page_hi))
+        rows = self.select(ref_name, start, end, ref_base, query_base, sort, descending)
+        return len(rows), [self.record(int(row)) for row in rows[offset:offset + limit]]
+
+
+@lru_cache(maxsize=32)
+def _open_store(path, inode, mtime_ns):
+    return SnpStore(path)
+
+
+def open_store(path):
+    ###hot results stay mapped; a store is immutable once written so sharing it is safe, and the
+    ###key has the inode and mtime so a result evicted and computed again is mapped afresh
+    stat = os.stat(path)
+    return _open_store(path, stat.st_ino, stat.st_mtime_ns)
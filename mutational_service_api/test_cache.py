@@ -0,0 +1,117 @@
+import gzip
+import itertools
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import cache
+from cache import ResultCache, file_digest, result_key, sequence_digest
+
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.workdir.name, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_sequence_digest_ignores_wrapping_case_and_compression(self):
+        plain = self.write('a.fasta', b'>r1 some description\nACGTAC\nGT\n>r2\nTTTT\n')
+        digests = {sequence_digest(plain),
+                   sequence_digest(self.write('b.fasta', b'>r1\nacgtacgt\n\n>r2 other\nTT\nTT\n')),
+                   sequence_digest(self.write('c.fasta.gz', b'>r1\nACGTACGT\n>r2\nTTTT\n'))}
+        self.assertEqual(len(digests), 1)
+        self.assertNotEqual(sequence_digest(plain), sequence_digest(self.write('d.fasta', b'>r1\nACGTACGA\n>r2\nTTTT\n')))
+
+    def test_digests_are_memoized_until_the_file_changes(self):
+        path = self.write('ref.fasta', b'>r1\nACGT\n')
+        first = file_digest(path)
+        hits = cache._file_digest.cache_info().hits
+        self.assertEqual(file_digest(path), first)
+        self.assertEqual(cache._file_digest.cache_info().hits, hits + 1)
+        ###same size, new mtime: hashed again
+        self.write('ref.fasta', b'>r1\nACGA\n')
+        os.utime(path, ns=(1, 1))
+        self.assertNotEqual(file_digest(path), first)
+
+    def test_result_key_depends_on_every_input(self):
+        query = self.write('q.fasta', b'>q\nACGT\n')
+        reference = self.write('r.fasta', b'>r\nACGT\n')
+        key = result_key(query, reference, {'nucmer': []})
+        self.assertEqual(key, result_key(self.write('q2.fasta', b'>q\nAC\nGT\n'), reference, {'nucmer': []}))
+        self.assertNotEqual(key, result_key(query, reference, {'nucmer': ['--maxmatch']}))
+        self.assertNotEqual(key, result_key(query, query, {'nucmer': []}))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        ###a clock that moves on every call, so access order never ties
+        clock = mock.patch('cache.time.time', side_effect=itertools.count(1000))
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def cache(self, max_bytes):
+        return ResultCache(os.path.join(self.workdir.name, 'cache'), max_bytes)
+
+    def put(self, results, key, size):
+        ###result.json of about `size` bytes
+        results.put(key, {'padding': 'x' * (size - 15)})
+        return os.path.getsize(results.entry_path(key, 'result.json'))
+
+    def test_artifacts_are_moved_into_the_entry(self):
+        results = self.cache(10 ** 6)
+        artifact = os.path.join(self.workdir.name, 'out.delta')
+        with open(artifact, 'w') as f:
+            f.write('delta')
+        results.put('k', {'snps': []}, {'out.delta': artifact, 'missing.txt': None})
+        self.assertEqual(results.get('k'), {'snps': []})
+        self.assertFalse(os.path.exists(artifact))
+        self.assertTrue(os.path.exists(results.entry_path('k', 'out.delta')))
+        self.assertIsNone(results.get('other'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        results = self.cache(250)
+        self.put(results, 'a', 100)
+        self.put(results, 'b', 100)
+        ###a read makes a the most recent one
+        self.assertIsNotNone(results.get('a'))
+        self.put(results, 'c', 100)
+        self.assertIsNone(results.get('b'))
+        self.assertIsNotNone(results.get('a'))
+        self.assertIsNotNone(results.get('c'))
+
+    def test_an_oversized_entry_survives_its_own_put(self):
+        results = self.cache(250)
+        self.put(results, 'a', 100)
+        self.put(results, 'big', 400)
+        self.assertIsNotNone(results.get('big'))
+        self.assertIsNone(results.get('a'))
+        ###and goes first once something newer arrives
+        self.put(results, 'c', 100)
+        self.assertIsNone(results.get('big'))
+        self.assertIsNotNone(results.get('c'))
+
+    def test_the_index_survives_a_restart(self):
+        results = self.cache(250)
+        self.put(results, 'a', 100)
+        self.put(results, 'b', 100)
+        reopened = self.cache(250)
+        self.put(reopened, 'c', 100)
+        self.assertIsNone(reopened.get('a'))
+        self.assertIsNotNone(reopened.get('b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from cohort import Cohort, CohortStore
+
+
+def sample(sample_id, positions):
+    return sample_id, sample_id, [(position, 'A', position, 'G', 'ref', 'query') for position in positions]
+
+
+class CohortTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def expected_distances(self, samples):
+        variants = [set(positions) for _, positions in samples]
+        return np.array([[len(a ^ b) for b in variants] for a in variants])
+
+    def test_incremental_additions_match_a_full_rebuild(self):
+        rng = np.random.default_rng(7)
+        samples = [(f's{index}', rng.choice(200, size=20, replace=False).tolist()) for index in range(23)]
+        cohort = Cohort(self.workdir.name)
+        ###uneven batches, so the buffer grows several times
+        for start, stop in ((0, 1), (1, 4), (4, 5), (5, 17), (17, 23)):
+            self.assertEqual(cohort.add_samples([sample(*entry) for entry in samples[start:stop]]), stop - start)
+        expected = self.expected_distances(samples)
+        np.testing.assert_array_equal(cohort.distances(), expected)
+        np.testing.assert_array_equal(cohort.distances(5, 9), expected[5:9])
+        self.assertEqual(cohort.shared.shape, (23, 23))
+        np.testing.assert_array_equal(cohort.sizes(), [20] * 23)
+
+    def test_nearest(self):
+        cohort = Cohort(self.workdir.name)
+        cohort.add_samples([sample('a', [1, 2, 3]), sample('b', [1, 2]), sample('c', [7, 8, 9]),
+                            sample('d', [1, 2, 3, 4])])
+        self.assertEqual(cohort.nearest(2), [[(1, 1), (3, 1)], [(0, 1), (3, 2)], [(1, 5), (0, 6)],
+                                             [(0, 1), (1, 2)]])
+        self.assertEqual(cohort.nearest(10, 2, 3), [[(1, 5), (0, 6), (3, 7)]])
+
+    def test_duplicates_are_skipped_and_the_journal_replays(self):
+        cohort = Cohort(self.workdir.name)
+        self.assertEqual(cohort.add_samples([sample('a', [1, 2]), sample('a', [5])]), 1)
+        self.assertEqual(cohort.add_samples([sample('a', [1]), sample('b', [2, 3])]), 1)
+        reloaded = Cohort(self.workdir.name)
+        self.assertEqual(reloaded.samples, cohort.samples)
+        np.testing.assert_array_equal(reloaded.distances(), [[0, 2], [2, 0]])
+
+    def test_clusters(self):
+        cohort = Cohort(self.workdir.name)
+        cohort.add_samples([sample('a', [1, 2]), sample('b', [1, 2, 3]), sample('c', [50, 60, 70])])
+        clusters = cohort.clusters(threshold=1)
+        self.assertEqual([[member['id'] for member in cluster] for cluster in clusters], [['a', 'b'], ['c']])
+
+    def test_store_rejects_bad_names(self):
+        store = CohortStore(self.workdir.name)
+        for name in ('../escape', '.', '..', '.hidden', 'a/b', ''):
+            self.assertIsNone(store.get(name, create=True), name)
+        ###a link out of the cohorts directory is not followed
+        outside = os.path.join(self.workdir.name, 'outside')
+        os.makedirs(os.path.join(outside, 'cohorts'))
+        store = CohortStore(os.path.join(outside, 'cohorts'))
+        os.symlink(self.workdir.name, os.path.join(outside, 'cohorts', 'linked'))
+        self.assertIsNone(store.get('linked', create=True))
+        self.assertIsNone(store.get('missing'))
+        self.assertIs(store.get('mpox', create=True), store.get('mpox'))
+
+
+if __name__ == '__main__':
+    unittest.main()
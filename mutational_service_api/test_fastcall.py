@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+import unittest
+
+from fastcall import Fallback, call_snps
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REFERENCE = os.path.join(ROOT, 'references', 'NC_003310.fasta')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from genomes import read_reference, synthetic_genome, write_fasta  # noqa: E402
+
+
+class FastPathTest(unittest.TestCase):
+    ###the fast path either returns exactly the planted differences or raises Fallback, never a
+    ###different answer; the synthetic genomes come from the benchmark suite
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def call(self, records):
+        path = os.path.join(self.workdir.name, 'query.fasta')
+        write_fasta(records, path)
+        return call_snps(REFERENCE, path)
+
+    def assertExactOrFallback(self, **kwargs):
+        records, truth, reference_id = synthetic_genome(REFERENCE, **kwargs)
+        try:
+            snps, alignment = self.call(records)
+        except Fallback:
+            return False
+        expected = sorted((pos_ref, ref_base, pos_query, query_base, reference_id, query_name)
+                          for pos_ref, ref_base, pos_query, query_base, query_name in truth)
+        self.assertEqual(sorted(snps), expected)
+        self.assertEqual(alignment['differences'], len(expected))
+        return True
+
+    def test_substitutions_are_exact(self):
+        ###this seed is one the benchmarks rely on not falling back
+        self.assertTrue(self.assertExactOrFallback(seed=13, snp_rate=0.005, indel_rate=0))
+
+    def test_contigs_are_exact_or_fall_back(self):
+        self.assertExactOrFallback(seed=13, snp_rate=0.002, indel_rate=0, contigs=4)
+
+    def test_small_indels_are_exact_or_fall_back(self):
+        for seed in range(5):
+            with self.subTest(seed=seed):
+                self.assertExactOrFallback(seed=seed, snp_rate=0.001, indel_rate=0.0002)
+
+    def test_unambiguous_indels_are_exact(self):
+        ###random single-base indels mostly land in homopolymers and fall back, these two do not:
+        ###the indel base differs from both of its neighbours
+        reference_id, reference = read_reference(REFERENCE)
+        unambiguous = [position for position in range(1, len(reference) - 1)
+                       if len({reference[position - 1], reference[position], reference[position + 1]}) == 3]
+        deleted = next(position for position in unambiguous if position >= 50000)
+        inserted = next(position for position in unambiguous if position >= 120000)
+        base = next(base for base in 'ACGT' if base not in reference[inserted - 1:inserted + 1])
+        query = reference[:deleted] + reference[deleted + 1:inserted] + base + reference[inserted:]
+        snps, _ = self.call([('query', query)])
+        self.assertEqual(snps, [(deleted + 1, reference[deleted], deleted, '.', reference_id, 'query'),
+                                (inserted, '.', inserted, base, reference_id, 'query')])
+
+    def test_divergent_genome_falls_back(self):
+        records, _, _ = synthetic_genome(REFERENCE, seed=1, snp_rate=0.05, indel_rate=0)
+        with self.assertRaises(Fallback):
+            self.call(records)
+
+    def test_reverse_complement_falls_back(self):
+        records, _, _ = synthetic_genome(REFERENCE, seed=1, snp_rate=0.001, indel_rate=0)
+        complement = str.maketrans('ACGT', 'TGCA')
+        with self.assertRaises(Fallback):
+            self.call([(name, sequence.translate(complement)[::-1]) for name, sequence in records])
+
+    def test_short_or_ambiguous_contig_falls_back(self):
+        records, _, _ = synthetic_genome(REFERENCE, seed=1, snp_rate=0, indel_rate=0)
+        name, sequence = records[0]
+        for query in ([(name, sequence[:500])], [(name, sequence[:5000] + 'N' + sequence[5001:10000])]):
+            with self.subTest(length=len(query[0][1])):
+                with self.assertRaises(Fallback):
+                    self.call(query)
+
+
+if __name__ == '__main__':
+    unittest.main()
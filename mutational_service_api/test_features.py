@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from features import FeatureIndex, annotate_snps, read_faa_features, store_substitutions
+from pipeline import snp_dict
+from snpstore import SnpStore, write_snp_store
+
+###1..9 is atg aaa tgg (M K W) on the + strand, 13..21 reads atg gcc cag (M A Q) on the - strand
+SEQUENCE = 'ATGAAATGG' + 'CCC' + 'CTGGGCCAT' + 'GGGGGGGGG'
+FEATURES = [
+    {'seq_id': 'ref1', 'start': 1, 'end': 9, 'strand': '+', 'gene': 'plus', 'locus_tag': 'T1', 'product': 'p1',
+     'protein_id': 'P1'},
+    {'seq_id': 'ref1', 'start': 13, 'end': 21, 'strand': '-', 'gene': None, 'locus_tag': 'T2', 'product': 'p2',
+     'protein_id': 'P2'},
+]
+
+
+def snp(pos_ref, query_base, ref_name='ref1.1'):
+    ref_base = SEQUENCE[pos_ref - 1] if query_base != '.' else '.'
+    return snp_dict((pos_ref, ref_base, pos_ref, query_base, ref_name, 'query1'))
+
+
+class AnnotateSnpsTest(unittest.TestCase):
+    def setUp(self):
+        self.index = FeatureIndex(FEATURES, {'ref1': SEQUENCE})
+
+    def consequence(self, *snps):
+        return [(item['effect'], item['aa_change'], item['consequences'][0]['alt_codon'])
+                for item in annotate_snps(list(snps), self.index)]
+
+    def test_plus_strand_effects(self):
+        self.assertEqual(self.consequence(snp(6, 'G')), [('synonymous', 'K2K', 'AAG')])
+        self.assertEqual(self.consequence(snp(8, 'C')), [('missense', 'W3S', 'TCG')])
+        ###stop gained
+        self.assertEqual(self.consequence(snp(4, 'T')), [('nonsense', 'K2*', 'TAA')])
+        [annotated] = annotate_snps([snp(8, 'C')], self.index)
+        self.assertEqual((annotated['gene'], annotated['consequences'][0]['codon_position']), ('plus', 2))
+
+    def test_minus_strand_is_read_reverse_complemented(self):
+        self.assertEqual(self.consequence(snp(21, 'C')), [('missense', 'M1V', 'GTG')])
+        self.assertEqual(self.consequence(snp(15, 'A')), [('nonsense', 'Q3*', 'TAG')])
+        [annotated] = annotate_snps([snp(16, 'A')], self.index)
+        consequence = annotated['consequences'][0]
+        ###no gene name, the locus tag stands in
+        self.assertEqual(annotated['gene'], 'T2')
+        self.assertEqual((consequence['codon_number'], consequence['codon_position'], consequence['ref_codon']),
+                         (2, 3, 'GCC'))
+
+    def test_substitutions_in_one_codon_are_combined(self):
+        self.assertEqual(self.consequence(snp(7, 'A'), snp(8, 'A')), [('missense', 'W3K', 'AAG')] * 2)
+
+    def test_intergenic_and_indels(self):
+        [intergenic, deletion] = annotate_snps([snp(11, 'A'), snp(5, '.')], self.index)
+        self.assertEqual((intergenic['effect'], intergenic['gene'], intergenic['consequences']),
+                         ('intergenic', None, []))
+        self.assertEqual((deletion['effect'], deletion['aa_change']), ('frameshift', None))
+
+    def test_codon_split_over_two_batches(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = os.path.join(workdir, 'result.snps')
+            snps = [snp(4, 'T'), snp(7, 'A'), snp(8, 'A'), snp(15, 'A')]
+            write_snp_store([tuple(item[field] for field in ('pos_ref', 'ref_base', 'pos_query', 'query_base',
+                                                              'ref_name', 'query_name')) for item in snps], path)
+            store = SnpStore(path)
+            first, second = snps[:2], snps[2:]
+            annotate_snps(first, self.index, store_substitutions(store, first))
+            annotate_snps(second, self.index, store_substitutions(store, second))
+            self.assertEqual([item['aa_change'] for item in snps], ['K2*', 'W3K', 'W3K', 'Q3*'])
+            ###the batch alone only sees its own half of codon 3
+            self.assertEqual(annotate_snps([snp(7, 'A')], self.index)[0]['aa_change'], 'W3R')
+
+
+class ReadFeaturesTest(unittest.TestCase):
+    def test_ncbi_protein_headers(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.faa') as f:
+            f.write('>lcl|NC_1.1_prot_NP_1.1_1 [gene=abc] [protein=capsid] [location=complement(13..21)]\nMAQ\n'
+                    '>lcl|NC_1.1_prot_NP_2.1_2 [gene=def] [location=join(1..5,8..12)]\nMK\n')
+            f.flush()
+            [feature] = read_faa_features(f.name)
+        self.assertEqual((feature['seq_id'], feature['start'], feature['end'], feature['strand'], feature['gene'],
+                          feature['product']), ('NC_1.1', 13, 21, '-', 'abc', 'capsid'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import filecmp
+import os
+import threading
+import unittest
+
+from prometheus_client import CollectorRegistry
+
+from governor import Governor, QueueFull
+from jobs import JobQueue
+from metrics import watch_governor
+
+
+class GovernorTest(unittest.TestCase):
+    def test_full_line_is_turned_away(self):
+        ###what the services answer with 429 and a Retry-After
+        governor = Governor(slots=4, max_queue=2, job_slots=2)
+        governor.admit()
+        governor.admit()
+        with self.assertRaises(QueueFull) as raised:
+            governor.admit()
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertEqual(governor.status()['rejected'], 1)
+        self.assertEqual(governor.status()['waiting'], 2)
+
+    def test_group_is_admitted_all_or_nothing(self):
+        governor = Governor(slots=4, max_queue=3, job_slots=2)
+        governor.admit()
+        with self.assertRaises(QueueFull):
+            governor.admit(3)
+        self.assertEqual(governor.status()['waiting'], 1)
+        governor.admit(2)
+        self.assertEqual(governor.status()['waiting'], 3)
+
+    def test_grants_are_bounded_by_job_slots_and_limit(self):
+        governor = Governor(slots=5, max_queue=4, job_slots=2)
+        governor.admit(3)
+        self.assertEqual(governor.acquire(), 2)
+        self.assertEqual(governor.acquire(limit=1), 1)
+        self.assertEqual(governor.acquire(), 2)
+        self.assertEqual(governor.status()['free_slots'], 0)
+        self.assertEqual(governor.status()['running'], 3)
+
+    def test_acquire_waits_for_a_release(self):
+        governor = Governor(slots=1, max_queue=2, job_slots=1)
+        governor.admit(2)
+        granted = governor.acquire()
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (governor.acquire(), acquired.set()))
+        waiter.start()
+        self.assertFalse(acquired.wait(0.1))
+        governor.release(granted, seconds=10)
+        self.assertTrue(acquired.wait(5))
+        waiter.join()
+
+    def test_share(self):
+        governor = Governor(slots=8, max_queue=10, job_slots=4)
+        self.assertEqual([governor.share(count) for count in (1, 2, 3, 8, 20)], [4, 4, 2, 1, 1])
+
+    def test_retry_after_follows_the_job_durations(self):
+        governor = Governor(slots=1, max_queue=1, job_slots=1)
+        governor.admit()
+        governor.release(governor.acquire(), seconds=100)
+        governor.admit()
+        with self.assertRaises(QueueFull) as raised:
+            governor.admit()
+        self.assertEqual(raised.exception.retry_after, 200)
+
+    def test_rejections_are_exposed_as_a_counter(self):
+        governor = Governor(slots=1, max_queue=1, job_slots=1)
+        registry = CollectorRegistry()
+        watch_governor(governor, registry)
+        governor.admit()
+        for count in (1, 2):
+            with self.assertRaises(QueueFull):
+                governor.admit(count)
+        self.assertEqual(registry.get_sample_value('mutation_governor_rejected_total'), 3)
+
+    def test_services_share_the_same_copy(self):
+        ###each service is its own build context, so the module is copied; the copies must not drift
+        here = os.path.dirname(os.path.abspath(__file__))
+        annotation = os.path.join(os.path.dirname(here), 'annotation_service_api')
+        for name in ('governor.py', 'lifecycle.py', 'compressed.py', 'procstats.py'):
+            with self.subTest(module=name):
+                self.assertTrue(filecmp.cmp(os.path.join(here, name), os.path.join(annotation, name), shallow=False))
+
+
+class ComparisonBudgetTest(unittest.TestCase):
+    ###a comparison queues one job per reference as a group, each capped at an equal share of the slots
+    def queue(self, runner, slots=4, max_queue=3):
+        governor = Governor(slots=slots, max_queue=max_queue, job_slots=slots)
+        job_queue = JobQueue(runner, max_workers=4, governor=governor)
+        self.addCleanup(job_queue._executor.shutdown)
+        return job_queue, governor
+
+    def test_group_jobs_run_side_by_side_on_their_share(self):
+        together = threading.Barrier(3, timeout=5)
+
+        def runner(job):
+            ###only passes once all three alignments are running at the same time
+            together.wait()
+            return {'reference': job.params['reference']}
+        job_queue, governor = self.queue(runner)
+        share = governor.share(3)
+        jobs = job_queue.submit_group([{'reference': f'ref{index}.fasta', 'max_threads': share} for index in range(3)])
+        for job in jobs:
+            job_queue.wait(job, timeout=5)
+        self.assertEqual([(job.status, job.threads) for job in jobs], [('done', 1)] * 3)
+        self.assertEqual(governor.status()['free_slots'], 4)
+
+    def test_group_larger_than_the_line_is_not_queued_at_all(self):
+        job_queue, governor = self.queue(lambda job: {})
+        with self.assertRaises(QueueFull):
+            job_queue.submit_group([{'reference': f'ref{index}.fasta'} for index in range(4)])
+        self.assertEqual(job_queue.counts(), {'queued': 0, 'running': 0, 'done': 0, 'failed': 0})
+        self.assertEqual((governor.status()['waiting'], governor.status()['rejected']), (0, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
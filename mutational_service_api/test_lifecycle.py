@@ -0,0 +1,104 @@
+import os
+import tempfile
+import time
+import unittest
+
+from lifecycle import PINS_DIR, UploadsJanitor, pick_scratch_dir, pin, purge_scratch, unpin
+
+
+class UploadsJanitorTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.root = self.workdir.name
+        self.now = time.time()
+
+    def write(self, name, size, age):
+        ###an artifact of `size` bytes last touched `age` seconds ago
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        os.utime(path, (self.now - age, self.now - age))
+        return path
+
+    def janitor(self, max_bytes=10 ** 6, ttl_seconds=3600, **kwargs):
+        return UploadsJanitor(self.root, max_bytes, ttl_seconds, **kwargs)
+
+    def remaining(self):
+        return sorted(os.path.relpath(os.path.join(dirpath, name), self.root)
+                      for dirpath, _, filenames in os.walk(self.root) for name in filenames
+                      if PINS_DIR not in dirpath)
+
+    def test_expired_artifacts_go_and_other_files_stay(self):
+        self.write('old.fasta', 100, age=7200)
+        self.write('output_job1/annotated_genome.gff', 100, age=7200)
+        ###a directory is as old as the newest thing in it, itself included
+        os.utime(os.path.join(self.root, 'output_job1'), (self.now - 7200, self.now - 7200))
+        self.write('fresh.fasta.gz', 100, age=10)
+        self.write('result_cache/ab/result.json', 100, age=7200)
+        stats = self.janitor().sweep()
+        self.assertEqual(self.remaining(), ['fresh.fasta.gz', 'result_cache/ab/result.json'])
+        self.assertEqual((stats['removed'], stats['freed_bytes'], stats['volume_bytes']),
+                         ({'ttl': 2, 'quota': 0}, 200, 200))
+
+    def test_least_recently_used_artifacts_go_until_the_volume_fits(self):
+        self.write('a.fasta', 100, age=30)
+        self.write('b.fasta', 100, age=20)
+        self.write('annotation_archives/c.zip', 100, age=10)
+        ###counts towards the quota, but is never removed here
+        self.write('result_cache/ab/result.json', 100, age=40)
+        stats = self.janitor(max_bytes=250).sweep()
+        self.assertEqual(self.remaining(), ['annotation_archives/c.zip', 'result_cache/ab/result.json'])
+        self.assertEqual((stats['removed'], stats['volume_bytes']), ({'ttl': 0, 'quota': 2}, 200))
+
+    def test_pinned_artifacts_are_kept(self):
+        self.write('genome.fasta', 100, age=7200)
+        self.write('annotation_archives/job.zip', 100, age=7200)
+        pin(self.root, 'genome.fasta', 'job1')
+        pin(self.root, 'annotation_archives/job.zip', 'job2')
+        stats = self.janitor(max_bytes=0).sweep()
+        self.assertEqual(self.remaining(), ['annotation_archives/job.zip', 'genome.fasta'])
+        self.assertEqual(stats['pinned'], 2)
+        unpin(self.root, 'genome.fasta', 'job1')
+        unpin(self.root, 'genome.fasta', 'job1')
+        self.janitor(max_bytes=0).sweep()
+        self.assertEqual(self.remaining(), ['annotation_archives/job.zip'])
+
+    def test_stale_pins_are_dropped(self):
+        pin(self.root, 'genome.fasta', 'job1')
+        pin(self.root, 'genome.fasta', 'job2')
+        stale = os.path.join(self.root, PINS_DIR, 'genome.fasta@job1')
+        os.utime(stale, (self.now - 200, self.now - 200))
+        janitor = self.janitor(pin_ttl=100)
+        self.assertEqual(janitor.pinned(self.now), {'genome.fasta'})
+        self.assertFalse(os.path.exists(stale))
+        unpin(self.root, 'genome.fasta', 'job2')
+        self.assertEqual(janitor.pinned(self.now), set())
+
+    def test_sweep_reports_to_the_hook(self):
+        sweeps = []
+        janitor = self.janitor(on_sweep=sweeps.append)
+        stats = janitor.sweep()
+        self.assertEqual(sweeps, [stats])
+        self.assertIs(janitor.last_sweep, stats)
+
+
+class ScratchTest(unittest.TestCase):
+    def test_purge_only_removes_this_service_prefix(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            for name in ('mutation_1', 'mutation_2', 'annotation_1'):
+                os.makedirs(os.path.join(scratch, name, 'nested'))
+            purge_scratch(scratch, 'mutation_')
+            self.assertEqual(os.listdir(scratch), ['annotation_1'])
+            purge_scratch(os.path.join(scratch, 'missing'), 'mutation_')
+
+    def test_pick_falls_back_when_missing_or_full(self):
+        with tempfile.TemporaryDirectory() as preferred:
+            self.assertEqual(pick_scratch_dir(preferred, '/fallback', 0), preferred)
+            self.assertEqual(pick_scratch_dir(preferred, '/fallback', 1 << 62), '/fallback')
+            self.assertEqual(pick_scratch_dir(os.path.join(preferred, 'missing'), '/fallback', 0), '/fallback')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from jobs import Job, JobFailed
+from pipeline import call_snps_files, call_snps_piped, delta_alignment, iter_snps, parse_snps_file, snp_dict
+from snpstore import SnpStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS_DIR = os.path.join(ROOT, 'benchmarks', 'stubs')
+PARAMS = {'delta-filter': ['-1'], 'show-snps': ['-Clr']}
+
+###show-snps -Clr as the stand-in replays it
+RECORDING = '''/data/references/ref.fasta /app/uploads/query.fasta
+NUCMER
+
+[P1]  [SUB]  [SUB]  [P2]  |  [BUFF]  [DIST]  |  [LEN R]  [LEN Q]  |  [FRM]  [TAGS]
+=============================================================================================
+    120   A G   118   |  20   120  |  5000  4998  |  1  1  ref1\tquery1
+    300   . T   299   |  30   300  |  5000  4998  |  1  1  ref1\tquery1
+    451   C .   449   |  25   451  |  5000  4998  |  1  1  ref1\tquery1
+'''
+EXPECTED = [(120, 'A', 118, 'G', 'ref1', 'query1'), (300, '.', 299, 'T', 'ref1', 'query1'),
+            (451, 'C', 449, '.', 'ref1', 'query1')]
+
+
+class IterSnpsTest(unittest.TestCase):
+    def test_query_base_comes_before_the_query_position(self):
+        ###[P1] [SUB] [SUB] [P2]: the baseline parser swapped the query base and the query position
+        self.assertEqual(list(iter_snps(RECORDING.splitlines(keepends=True))), EXPECTED)
+
+    def test_tab_separated_output(self):
+        ###show-snps -T has no | columns
+        line = '120\tA\tG\t118\t20\t120\t5000\t4998\t1\t1\tref1\tquery1\n'
+        self.assertEqual(list(iter_snps([line])), [EXPECTED[0]])
+
+    def test_headers_and_short_lines_are_skipped(self):
+        lines = ['/a.fasta /b.fasta\n', 'NUCMER\n', '\n', '[P1] [SUB]\n', '=====\n', '1 A G\n']
+        self.assertEqual(list(iter_snps(lines)), [])
+
+    def test_records_as_dicts(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.snps') as f:
+            f.write(RECORDING)
+            f.flush()
+            self.assertEqual(parse_snps_file(f.name)[0], snp_dict(EXPECTED[0]))
+        self.assertEqual(snp_dict(EXPECTED[0]), {'pos_ref': 120, 'ref_base': 'A', 'pos_query': 118,
+                                                 'query_base': 'G', 'ref_name': 'ref1', 'query_name': 'query1'})
+
+
+class PipelineTest(unittest.TestCase):
+    ###delta-filter and show-snps are the benchmark stand-ins: the first passes the delta through,
+    ###the second replays the recording named after the query's first record
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.path = lambda name: os.path.join(self.workdir.name, name)
+        with open(self.path('query.fasta'), 'w') as f:
+            f.write('>query1\nACGT\n')
+        with open(self.path('query1.snps'), 'w') as f:
+            f.write(RECORDING)
+        with open(self.path('out.delta'), 'w') as f:
+            f.write(f"{self.path('ref.fasta')} {self.path('query.fasta')}\nNUCMER\n")
+        environment = mock.patch.dict(os.environ, {'PATH': f"{STUBS_DIR}{os.pathsep}{os.environ['PATH']}",
+                                                   'BENCH_RECORDINGS': self.workdir.name})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.job = Job({}, SimpleNamespace(changed=threading.Condition()))
+
+    def test_piped_chain_fills_the_store_and_the_copy(self):
+        count = call_snps_piped(self.job, PARAMS, self.path('out.delta'), self.workdir.name,
+                                self.path('piped.snpc'), snps_copy=self.path('copy.snps'))
+        self.assertEqual(count, 3)
+        store = SnpStore(self.path('piped.snpc'))
+        self.assertEqual(list(store.rows(0, store.count_all)), EXPECTED)
+        with open(self.path('copy.snps')) as f:
+            self.assertEqual(f.read(), RECORDING)
+        self.assertEqual([self.job.stages[name]['status'] for name in ('delta-filter', 'show-snps')], ['done', 'done'])
+
+    def test_piped_and_file_chains_agree(self):
+        call_snps_piped(self.job, PARAMS, self.path('out.delta'), self.workdir.name, self.path('piped.snpc'))
+        count, _ = call_snps_files(self.job, PARAMS, self.path('out.delta'), self.workdir.name,
+                                   self.path('files.snpc'))
+        self.assertEqual(count, 3)
+        piped, files = SnpStore(self.path('piped.snpc')), SnpStore(self.path('files.snpc'))
+        self.assertEqual(list(piped.rows(0, piped.count_all)), list(files.rows(0, files.count_all)))
+
+    def test_show_snps_failure_fails_the_job(self):
+        os.remove(self.path('query1.snps'))
+        with self.assertRaises(JobFailed) as raised:
+            call_snps_piped(self.job, PARAMS, self.path('out.delta'), self.workdir.name, self.path('piped.snpc'))
+        self.assertIn('no recording for query1', raised.exception.error['stderr'])
+        self.assertEqual(self.job.stages['show-snps']['status'], 'failed')
+        self.assertEqual(self.job.stages['delta-filter']['status'], 'done')
+
+
+class DeltaAlignmentTest(unittest.TestCase):
+    def test_coverage_and_identity(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            query_path = os.path.join(workdir, 'query.fasta')
+            with open(query_path, 'w') as f:
+                f.write('>q1\n' + 'A' * 500 + '\n>q2\n' + 'C' * 300 + '\n')
+            delta_path = os.path.join(workdir, 'out.delta')
+            with open(delta_path, 'w') as f:
+                ###two overlapping alignments of q1 (1..100 and 90..190) and one reverse one of q2
+                f.write(f'/data/references/ref.fasta {query_path}\nNUCMER\n'
+                        '>r1 q1 1000 500\n1 100 1 100 2 2 0\n0\n150 250 90 190 1 1 0\n-5\n0\n'
+                        '>r1 q2 1000 300\n300 201 1 100 0 0 0\n0\n')
+            summary = delta_alignment(delta_path, query_path)
+        self.assertEqual((summary['query_bases'], summary['aligned_bases']), (800, 290))
+        self.assertEqual(summary['aligned_fraction'], round(290 / 800, 6))
+        self.assertEqual(summary['identity'], round(1 - 3 / 301, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
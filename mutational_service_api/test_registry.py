@@ -0,0 +1,111 @@
+import os
+import random
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import fastcall
+from registry import ReferenceRegistry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+###the benchmark suite's nucmer stand-in understands --save and --load
+STUBS_DIR = os.path.join(ROOT, 'benchmarks', 'stubs')
+
+
+def write_reference(path, seed, length=3000, header='ref1 test virus'):
+    rng = random.Random(seed)
+    sequence = ''.join(rng.choice('ACGT') for _ in range(length))
+    with open(path, 'w') as f:
+        f.write(f'>{header}\n')
+        for start in range(0, length, 70):
+            f.write(sequence[start:start + 70] + '\n')
+    return sequence
+
+
+class ReferenceRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.references = os.path.join(self.workdir.name, 'references')
+        self.indexes = os.path.join(self.workdir.name, 'indexes')
+        os.makedirs(self.references)
+        os.makedirs(self.indexes)
+        self.sequence = write_reference(os.path.join(self.references, 'ref1.fasta'), seed=1)
+        ###proteins only, annotation can use it but there is nothing to align against
+        with open(os.path.join(self.references, 'proteins.faa'), 'w') as f:
+            f.write('>p1 hypothetical protein\nMKV\n')
+        path = mock.patch.dict(os.environ, {'PATH': f"{STUBS_DIR}{os.pathsep}{os.environ['PATH']}"})
+        path.start()
+        self.addCleanup(path.stop)
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def registry(self, **kwargs):
+        return ReferenceRegistry(self.references, self.indexes, **kwargs)
+
+    def wait_for_index(self, registry, filename):
+        deadline = time.time() + 10
+        while registry.nucmer_prefix(filename) is None:
+            self.assertLess(time.time(), deadline, 'the nucmer index was not built')
+            time.sleep(0.05)
+        return registry.nucmer_prefix(filename)
+
+    def test_scan_records_metadata(self):
+        registry = self.registry(nucmer_index=False)
+        [entry] = registry.scan()
+        gc = sum(base in 'GC' for base in self.sequence) / len(self.sequence)
+        self.assertEqual((entry['name'], entry['file'], entry['length']), ('ref1', 'ref1.fasta', 3000))
+        self.assertEqual(entry['records'], [{'id': 'ref1', 'length': 3000}])
+        self.assertEqual(entry['description'], 'test virus')
+        self.assertAlmostEqual(entry['gc_content'], gc, places=4)
+        self.assertFalse(entry['proteins'])
+        self.assertEqual(len(entry['sha256']), 64)
+
+    def test_list_includes_protein_only_references(self):
+        registry = self.registry(nucmer_index=False)
+        registry.scan()
+        listed = {entry['name']: entry for entry in registry.list()}
+        self.assertEqual(set(listed), {'ref1', 'proteins'})
+        self.assertIsNone(listed['proteins']['file'])
+        self.assertTrue(listed['proteins']['proteins'])
+
+    def test_list_does_not_scan(self):
+        registry = self.registry(nucmer_index=False)
+        registry.scan()
+        write_reference(os.path.join(self.references, 'ref2.fasta'), seed=2, header='ref2')
+        self.assertNotIn('ref2', [entry['name'] for entry in registry.list()])
+        registry.scan()
+        self.assertIn('ref2', [entry['name'] for entry in registry.list()])
+
+    def test_nucmer_index_is_built_and_dropped_when_the_reference_changes(self):
+        registry = self.registry()
+        registry.prepare()
+        prefix = self.wait_for_index(registry, 'ref1.fasta')
+        old_folder = os.path.dirname(prefix)
+        self.assertTrue(os.path.exists(f'{prefix}.sa'))
+
+        ###new content: the old index no longer applies, even before the next scan
+        write_reference(os.path.join(self.references, 'ref1.fasta'), seed=3, length=3100)
+        self.assertIsNone(registry.nucmer_prefix('ref1.fasta'))
+        registry.prepare()
+        new_prefix = self.wait_for_index(registry, 'ref1.fasta')
+        self.assertNotEqual(os.path.dirname(new_prefix), old_folder)
+        self.assertFalse(os.path.exists(old_folder))
+
+    def test_use_keeps_the_hot_references_loaded(self):
+        write_reference(os.path.join(self.references, 'ref2.fasta'), seed=2, header='ref2')
+        registry = self.registry(hot=1, nucmer_index=False)
+        registry.scan()
+        registry.use('ref1.fasta')
+        registry.use('ref2.fasta')
+        self.assertEqual({entry['name']: entry['hot'] for entry in registry.list() if entry['file']},
+                         {'ref1': False, 'ref2': True})
+        ###the job's reference was loaded by use(), so the fast path finds it cached
+        misses = fastcall._load_reference_index.cache_info().misses
+        fastcall.load_reference_index(os.path.join(self.references, 'ref2.fasta'))
+        self.assertEqual(fastcall._load_reference_index.cache_info().misses, misses)
+
+
+if __name__ == '__main__':
+    unittest.main()
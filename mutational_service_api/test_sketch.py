@@ -0,0 +1,125 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import sketch
+from sketch import SketchIndex, compare, kmer_hashes, packed_kmers, reference_name
+
+COMPLEMENT = bytes.maketrans(b'ACGT', b'TGCA')
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def mutate(rng, sequence, rate):
+    return ''.join(rng.choice('ACGT'.replace(base, '')) if rng.random() < rate else base for base in sequence)
+
+
+def naive_kmers(sequence, k):
+    ###one k-mer at a time, as a reader of the doubling in packed_kmers would check it
+    codes = {ord(base): code for code, base in enumerate('ACGT')}
+    forward, reverse, valid = [], [], []
+    for start in range(len(sequence) - k + 1):
+        kmer = sequence[start:start + k]
+        valid.append(all(base in codes for base in kmer))
+        value = reverse_value = 0
+        for base in kmer:
+            code = codes.get(base, 0)
+            value = (value << 2) | code
+        for base in kmer.translate(COMPLEMENT)[::-1]:
+            reverse_value = (reverse_value << 2) | codes.get(base, 3)
+        forward.append(value)
+        reverse.append(reverse_value)
+    return forward, reverse, valid
+
+
+class KmerTest(unittest.TestCase):
+    def test_packed_kmers_match_a_naive_scan(self):
+        rng = random.Random(1)
+        sequence = (random_sequence(rng, 40) + 'N' + random_sequence(rng, 30)).encode()
+        for k in (1, 2, 5, 21, 32):
+            with self.subTest(k=k):
+                forward, reverse, valid = packed_kmers(sequence, k)
+                expected_forward, expected_reverse, expected_valid = naive_kmers(sequence, k)
+                self.assertEqual(valid.tolist(), expected_valid)
+                self.assertEqual(forward[valid].tolist(), np.array(expected_forward, dtype=np.uint64)[valid].tolist())
+                self.assertEqual(reverse[valid].tolist(), np.array(expected_reverse, dtype=np.uint64)[valid].tolist())
+        self.assertEqual(packed_kmers(b'ACGT', 5)[0].size, 0)
+
+    def test_hashes_are_strand_independent(self):
+        sequence = random_sequence(random.Random(2), 500).encode()
+        reverse_complement = sequence.translate(COMPLEMENT)[::-1]
+        self.assertEqual(set(kmer_hashes(sequence).tolist()), set(kmer_hashes(reverse_complement).tolist()))
+
+    def test_sketch_is_the_bottom_of_all_hashes(self):
+        rng = random.Random(3)
+        records = [random_sequence(rng, 3000).encode(), random_sequence(rng, 500).encode()]
+        everything = np.unique(np.concatenate([kmer_hashes(record) for record in records]))
+        self.assertEqual(sketch.sketch(records, size=100).tolist(), everything[:100].tolist())
+        self.assertEqual(sketch.sketch([b'ACGT'], size=100).size, 0)
+
+    def test_compare(self):
+        rng = random.Random(4)
+        genome = random_sequence(rng, 20000)
+        query = sketch.sketch([genome.encode()])
+        self.assertEqual(compare(query, query)['distance'], 0.0)
+        close = compare(query, sketch.sketch([mutate(rng, genome, 0.01).encode()]))
+        far = compare(query, sketch.sketch([mutate(rng, genome, 0.05).encode()]))
+        self.assertLess(close['distance'], far['distance'])
+        ###mash distance estimates the per-base divergence
+        self.assertAlmostEqual(close['distance'], 0.01, delta=0.005)
+        unrelated = compare(query, sketch.sketch([random_sequence(rng, 20000).encode()]))
+        self.assertEqual((unrelated['distance'], unrelated['shared_hashes']), (1.0, 0))
+
+
+class SketchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.references = os.path.join(self.workdir.name, 'references')
+        os.makedirs(self.references)
+        self.cache_path = os.path.join(self.workdir.name, 'sketches.npz')
+        rng = random.Random(5)
+        self.genome = random_sequence(rng, 20000)
+        self.write('close.fasta', mutate(rng, self.genome, 0.01))
+        self.write('far.fa', mutate(rng, self.genome, 0.08))
+        self.write('other.fna', random_sequence(rng, 20000))
+        self.write('notes.txt', 'not a reference')
+        self.query = self.write('query.fasta', self.genome, directory=self.workdir.name)
+
+    def write(self, filename, sequence, directory=None):
+        path = os.path.join(directory or self.references, filename)
+        with open(path, 'w') as f:
+            f.write(f'>{filename}\n{sequence}\n')
+        return path
+
+    def test_references_are_ranked_closest_first(self):
+        ranking, _ = SketchIndex(self.references, self.cache_path).classify(self.query)
+        self.assertEqual([entry['reference'] for entry in ranking], ['close', 'far', 'other'])
+        self.assertEqual(ranking[0]['file'], 'close.fasta')
+        self.assertEqual(ranking[-1]['shared_hashes'], 0)
+        self.assertEqual((reference_name('a.fasta.gz'), reference_name('notes.txt')), ('a', None))
+
+    def test_cache_only_sketches_what_changed(self):
+        SketchIndex(self.references, self.cache_path).refresh()
+        with mock.patch('sketch.sketch', wraps=sketch.sketch) as sketched:
+            index = SketchIndex(self.references, self.cache_path)
+            index.refresh()
+            self.assertEqual(sketched.call_count, 0)
+            ###the query is closest to this reference now
+            self.write('far.fa', self.genome)
+            os.remove(os.path.join(self.references, 'other.fna'))
+            ranking, _ = index.classify(self.query)
+            ###far.fa and the query
+            self.assertEqual(sketched.call_count, 2)
+        self.assertEqual([entry['reference'] for entry in ranking], ['far', 'close'])
+        self.assertEqual(ranking[0]['distance'], 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+
+from snpstore import SnpStore, open_store, write_snp_store
+
+
+###two references, the one first seen sorts last by name, so store order and name order differ
+RECORDS = [
+    (5, 'A', 5, 'G', 'zeta', 'contig1'),
+    (9, 'C', 9, 'T', 'zeta', 'contig1'),
+    (12, 'A', 11, '.', 'zeta', 'contig1'),
+    (1, 'G', 1, 'A', 'alpha', 'contig2'),
+    (7, 'T', 7, 'C', 'alpha', 'contig2'),
+    (9, 'A', 9, 'G', 'alpha', 'contig2'),
+]
+
+
+class SnpStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.workdir.name, 'result.snps')
+        write_snp_store(RECORDS, path)
+        self.store = SnpStore(path)
+
+    def tearDown(self):
+        self.workdir.cleanup()
+
+    def page(self, **kwargs):
+        return self.store.query(**kwargs)[1]
+
+    def test_default_order_is_store_order(self):
+        self.assertEqual(self.page(), RECORDS)
+
+    def test_pos_ref_sort_spans_references(self):
+        ###ties keep the store order
+        self.assertEqual([(record[0], record[4]) for record in self.page(sort='pos_ref')],
+                         [(1, 'alpha'), (5, 'zeta'), (7, 'alpha'), (9, 'zeta'), (9, 'alpha'), (12, 'zeta')])
+        self.assertEqual([record[0] for record in self.page(sort='pos_ref', descending=True)], [12, 9, 9, 7, 5, 1])
+
+    def test_pos_ref_sort_on_one_reference(self):
+        self.assertEqual(self.page(ref_name='alpha', sort='pos_ref'), RECORDS[3:])
+        self.assertEqual(self.page(ref_name='zeta', start=6, end=12), RECORDS[1:3])
+
+    def test_name_sort_is_alphabetical(self):
+        self.assertEqual([record[4] for record in self.page(sort='ref_name')], ['alpha'] * 3 + ['zeta'] * 3)
+
+    def test_pages_are_consistent_slices(self):
+        everything = self.page(sort='pos_ref', limit=100)
+        pages = [self.page(sort='pos_ref', offset=offset, limit=4) for offset in (0, 4, 8)]
+        self.assertEqual(sum(pages, []), everything)
+        self.assertEqual(self.store.query(sort='pos_ref', offset=4, limit=4)[0], len(RECORDS))
+
+    def test_filters(self):
+        self.assertEqual(self.page(ref_base='a'), [RECORDS[0], RECORDS[2], RECORDS[5]])
+        self.assertEqual(self.page(query_base='.'), [RECORDS[2]])
+        self.assertEqual(self.page(start=6, end=9), [RECORDS[1], RECORDS[4], RECORDS[5]])
+        self.assertEqual(self.store.query(ref_name='missing'), (0, []))
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            self.store.query(sort='gene')
+        with self.assertRaises(ValueError):
+            self.store.query(ref_base='AC')
+        with self.assertRaises(ValueError):
+            self.store.count(start=1)
+
+    def test_unsorted_input_is_stored_sorted(self):
+        path = os.path.join(self.workdir.name, 'unsorted.snps')
+        write_snp_store(reversed(RECORDS), path)
+        store = SnpStore(path)
+        self.assertEqual(store.query(ref_name='alpha')[1], RECORDS[3:])
+        ###alpha is seen first here, so it wins the tie at 9
+        self.assertEqual(store.query(sort='pos_ref')[1], [RECORDS[3], RECORDS[0], RECORDS[4], RECORDS[5],
+                                                          RECORDS[1], RECORDS[2]])
+
+    def test_open_store_maps_a_replaced_result_again(self):
+        path = os.path.join(self.workdir.name, 'entry.snps')
+        write_snp_store(RECORDS, path)
+        self.assertIs(open_store(path), open_store(path))
+        self.assertEqual(open_store(path).count_all, len(RECORDS))
+        ###the cache moves a fresh result over the evicted one's path
+        replacement = os.path.join(self.workdir.name, 'fresh.snps')
+        write_snp_store(RECORDS[:2], replacement)
+        os.replace(replacement, path)
+        self.assertEqual(list(open_store(path).rows(0, 2)), RECORDS[:2])
+        self.assertEqual(open_store(path).count_all, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()